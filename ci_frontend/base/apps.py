@@ -1,5 +1,26 @@
 from django.apps import AppConfig
+from django.db.models.signals import (post_save,
+                                      post_delete,
+                                      )
+
+
+def _invalidate_search_index(sender, **kwargs):
+    """
+    Any add/edit/delete of a company (admin, shell, scripts) makes the type-ahead index stale
+    """
+    from .search_index import search_index
+    search_index.mark_stale()
 
 
 class BaseConfig(AppConfig):
     name = 'base'
+
+    def ready(self):
+        # The index itself is built on process start up from wsgi.py/asgi.py, doing DB work in
+        # ready() is discouraged by Django as it also runs for manage.py migrate
+        post_save.connect(_invalidate_search_index,
+                          sender='base.CommonStock',
+                          dispatch_uid='base_commonstock_search_index_save')
+        post_delete.connect(_invalidate_search_index,
+                            sender='base.CommonStock',
+                            dispatch_uid='base_commonstock_search_index_delete')
@@ -0,0 +1,363 @@
+# This file will define the client used to talk to the backend REST API server
+import logging
+import random
+import threading
+import time
+from collections import namedtuple
+import requests
+from django.conf import settings
+from requests import HTTPError, Timeout, ConnectionError, RequestException
+from requests.exceptions import ChunkedEncodingError
+from requests.adapters import HTTPAdapter
+from .packet_schema import loads
+from .instrumentation import (metrics,
+                              timed,
+                              )
+
+logger = logging.getLogger(__name__)
+
+CI_BACKEND_REST_API_END_POINT = 'http://127.0.0.1:5000/security/'
+
+
+# packet (None if unknown or not modified), validators for the next conditional request, not_modified
+# when the backend answered 304 and partial when only the years since since_year were sent
+BackendResponse = namedtuple('BackendResponse', ['packet', 'validators', 'not_modified', 'partial'])
+
+
+class BackendUnavailable(Exception):
+    """
+    Raised without calling the backend when the circuit breaker is open or when the retries ran out
+    of time, callers should treat it like a failed fetch
+    """
+
+
+# What a call to the backend raises when it is down or too slow, after the retries
+BACKEND_FAILURES = (BackendUnavailable, Timeout, ConnectionError, HTTPError, ChunkedEncodingError)
+
+
+class CircuitBreaker:
+    """
+    Classic 3 state circuit breaker shared by all the threads of a process
+     - closed: calls go through, consecutive failures are counted
+     - open: after failure_threshold consecutive failures calls fail fast for reset_seconds
+     - half open: after reset_seconds a single trial call is let through, success closes the
+       circuit and failure opens it again
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self,
+                 failure_threshold: int,
+                 reset_seconds: float):
+        """
+        :param failure_threshold: consecutive failures which open the circuit
+        :type failure_threshold: int
+        :param reset_seconds: time the circuit stays open before a trial call
+        :type reset_seconds: float
+        """
+        self.failure_threshold: int = failure_threshold
+        self.reset_seconds: float = reset_seconds
+        self.state: str = self.CLOSED
+        self._failures: int = 0
+        self._opened_at: float = 0.0
+        self._trial_in_flight: bool = False
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        """
+        :return: True if the caller may call the backend now
+        :rtype: bool
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.error("Backend circuit opened after %s failures", self._failures)
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+
+class BackendClient:
+    """
+    Client for the backend REST API server. All the calls of a process go through one pooled keep
+    alive requests.Session. Failed calls are retried with exponential backoff and full jitter until
+    max_attempts or the total deadline is reached, whichever comes first, and a circuit breaker
+    makes callers fail fast while the backend is down
+    e.g
+        packet = backend_client.get_packet('10-k', 'msft')
+    """
+
+    def __init__(self,
+                 base_url: str = CI_BACKEND_REST_API_END_POINT,
+                 timeout: float = 1.0,
+                 pool_size: int = 20,
+                 max_attempts: int = 5,
+                 backoff_base: float = 0.1,
+                 backoff_max: float = 2.0,
+                 deadline: float = 4.0,
+                 breaker: CircuitBreaker = None,
+                 since_year_param: str = None):
+        """
+        :param base_url: end point of the backend e.g http://127.0.0.1:5000/security/
+        :type base_url: str
+        :param timeout: connect/read timeout of a single attempt
+        :type timeout: float
+        :param pool_size: max kept alive connections to the backend
+        :type pool_size: int
+        :param max_attempts: max attempts per call including the first one
+        :type max_attempts: int
+        :param backoff_base: backoff before the 2nd attempt, doubled for every attempt after that
+        :type backoff_base: float
+        :param backoff_max: cap on a single backoff
+        :type backoff_max: float
+        :param deadline: total time budget of a call including all the retries
+        :type deadline: float
+        :param breaker: circuit breaker for the backend, a new one is created if not given
+        :type breaker: CircuitBreaker
+        :param since_year_param: query parameter the backend filters the fiscal years with, e.g 'since',
+                                 None if the backend always sends every year
+        :type since_year_param: str
+        """
+        self.base_url: str = base_url
+        self.timeout: float = timeout
+        self.pool_size: int = pool_size
+        self.max_attempts: int = max_attempts
+        self.backoff_base: float = backoff_base
+        self.backoff_max: float = backoff_max
+        self.deadline: float = deadline
+        self.breaker: CircuitBreaker = breaker or CircuitBreaker(failure_threshold=5,
+                                                                  reset_seconds=30.0)
+        self.since_year_param: str = since_year_param
+        self._session: requests.Session = None
+        self._session_lock = threading.Lock()
+        self._in_flight: int = 0
+        self._in_flight_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> 'BackendClient':
+        config = getattr(settings, 'CI_BACKEND', dict())
+        return cls(base_url=config.get('BASE_URL', CI_BACKEND_REST_API_END_POINT),
+                   timeout=config.get('TIMEOUT_SECONDS', 1.0),
+                   pool_size=config.get('POOL_SIZE', 20),
+                   max_attempts=config.get('MAX_ATTEMPTS', 5),
+                   backoff_base=config.get('BACKOFF_BASE_SECONDS', 0.1),
+                   backoff_max=config.get('BACKOFF_MAX_SECONDS', 2.0),
+                   deadline=config.get('DEADLINE_SECONDS', 4.0),
+                   breaker=CircuitBreaker(failure_threshold=config.get('BREAKER_FAILURE_THRESHOLD', 5),
+                                          reset_seconds=config.get('BREAKER_RESET_SECONDS', 30.0)),
+                   since_year_param=config.get('SINCE_YEAR_PARAM'))
+
+    @property
+    def in_flight(self) -> int:
+        """
+        Backend requests of this process waiting for an answer, used by the admission control
+        :rtype: int
+        """
+        return self._in_flight
+
+    def _track_in_flight(self, change: int):
+        with self._in_flight_lock:
+            self._in_flight += change
+
+    @property
+    def session(self) -> requests.Session:
+        # Created lazily so forked worker processes do not share the parent's sockets
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1,
+                                          pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+        return self._session
+
+    @staticmethod
+    def is_retriable(exception: Exception) -> bool:
+        """
+        Takes in exception type from function to compare and retry if it meets the exception
+        type. Of the error statuses only 429 and 5xx are worth retrying, the other 4xx will not change
+        :param exception: requests.Exception
+        :type exception: Exception
+        :return: True or False
+        :rtype: bool
+        """
+        if isinstance(exception, HTTPError):
+            response = exception.response
+            return response is None or response.status_code == 429 or response.status_code >= 500
+        return isinstance(exception, (Timeout, ConnectionError, ChunkedEncodingError))
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Full jitter exponential backoff, a random time between 0 and base * 2^attempt capped to
+        backoff_max so the retries of many workers do not hit the backend in lock step
+        :param attempt: number of attempts done so far, starting at 1
+        :type attempt: int
+        :rtype: float
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1))))
+
+    def url_for(self,
+                form_type: str,
+                security_name: str) -> str:
+        # for eg : 10-k form it will look like http://127.0.0.1:5000/security/10-k/msft/
+        return self.base_url + form_type + '/' + security_name + '/'
+
+    def get_packet(self,
+                   form_type: str,
+                   security_name: str) -> dict:
+        """
+        Pulls the packet for the security from the backend with retries
+        :param form_type: SEC form type like e.g '10-k'
+        :type form_type: str
+        :param security_name: ticker or listing symbol like 'aapl'
+        :type security_name: str
+        :exception: BackendUnavailable if the circuit is open or the deadline ran out, else the last
+                    connection error once all the attempts failed
+        :return: packet or None if the backend does not know the security
+        :rtype: dict
+        """
+        return self.fetch_packet(form_type, security_name).packet
+
+    def fetch_packet(self,
+                     form_type: str,
+                     security_name: str,
+                     validators: dict = None,
+                     since_year: int = None) -> BackendResponse:
+        """
+        Conditional version of get_packet. The validators of the packet we already have are sent as
+        If-None-Match/If-Modified-Since so an unchanged packet costs a 304 with no body, and when the
+        backend takes a since year parameter only the years from since_year on are asked for
+        :param form_type: SEC form type like e.g '10-k'
+        :type form_type: str
+        :param security_name: ticker or listing symbol like 'aapl'
+        :type security_name: str
+        :param validators: {'etag': .., 'last_modified': ..} returned with the packet we have, None for none
+        :type validators: dict
+        :param since_year: first fiscal year wanted, ignored if the backend has no since year parameter
+        :type since_year: int
+        :exception: same as get_packet
+        :return: packet and validators, see BackendResponse
+        :rtype: BackendResponse
+        """
+        final_url = self.url_for(form_type, security_name)
+        headers = dict()
+        if validators and validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators and validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        params = dict()
+        if since_year is not None and self.since_year_param:
+            params[self.since_year_param] = since_year
+        response = self._get(final_url, headers, params)
+        if response is None:
+            return BackendResponse(None, None, False, False)
+        received = {'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified')}
+        if response.status_code == 304:
+            metrics.incr('ci_backend_not_modified_total')
+            # a 304 may leave out the validators, keep the ones we sent
+            return BackendResponse(None,
+                                   {key: value or (validators or dict()).get(key) for key, value in received.items()},
+                                   True,
+                                   False)
+        with timed('decode'):
+            packet = loads(response.content)
+        return BackendResponse(packet, received, False, bool(params))
+
+    def _get(self,
+             final_url: str,
+             headers: dict,
+             params: dict) -> 'requests.Response or None':
+        """
+        GET with retries, full jitter backoff, the total deadline and the circuit breaker
+        :exception: BackendUnavailable if the circuit is open, the deadline ran out or the call failed in a way
+                    retrying will not fix, else the last retriable error once all the attempts failed
+        :return: response with a status below 400, None if the backend does not know the URL (404)
+        :rtype: requests.Response
+        """
+        give_up_at = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            if not self.breaker.allow_request():
+                metrics.incr('ci_backend_fail_fast_total')
+                raise BackendUnavailable(f"circuit open, not calling {final_url}")
+            attempt += 1
+            metrics.incr('ci_backend_attempts_total')
+            if attempt > 1:
+                metrics.incr('ci_backend_retries_total')
+            time_left = give_up_at - time.monotonic()
+            settled = False
+            try:
+                with timed('backend'):
+                    self._track_in_flight(1)
+                    try:
+                        response = self.session.get(final_url,
+                                                    headers=headers,
+                                                    params=params,
+                                                    timeout=min(self.timeout, max(time_left, 0.01)))
+                    finally:
+                        self._track_in_flight(-1)
+                # 404 is an unknown security, any other error status (throttled, refused ..) is a failed call
+                # and must not be cached as "not found"
+                if response.status_code >= 400 and response.status_code != 404:
+                    response.raise_for_status()
+                self.breaker.record_success()
+                settled = True
+            except RequestException as failed:
+                self.breaker.record_failure()
+                settled = True
+                if not self.is_retriable(failed):
+                    logger.error("Call to %s failed: %s", final_url, failed)
+                    raise BackendUnavailable(f"call to {final_url} failed: {failed}") from failed
+                wait = self.backoff(attempt)
+                if attempt >= self.max_attempts:
+                    logger.error("Giving up on %s after %s attempts: %s", final_url, attempt, failed)
+                    raise failed
+                if time.monotonic() + wait >= give_up_at:
+                    raise BackendUnavailable(f"deadline of {self.deadline}s reached for {final_url}") from failed
+                logger.warning("Attempt %s for %s failed, retrying in %.3fs: %s",
+                               attempt, final_url, wait, failed)
+                time.sleep(wait)
+                continue
+            finally:
+                # Anything else raised still counts as a failure, a half open trial is never left in flight
+                if not settled:
+                    self.breaker.record_failure()
+            if response.status_code == 404:
+                logger.info("Backend does not know %s", final_url)
+                return None
+            return response
+
+
+# One client (connection pool + circuit breaker) per process
+backend_client = BackendClient.from_settings()
+
+
+def _circuit_samples() -> list:
+    return [('ci_backend_circuit_open', 'gauge', {}, int(backend_client.breaker.state != CircuitBreaker.CLOSED)),
+            ('ci_backend_in_flight', 'gauge', {}, backend_client.in_flight)]
+
+
+metrics.add_collector(_circuit_samples)
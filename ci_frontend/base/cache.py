@@ -0,0 +1,480 @@
+# This file will define the caches used by the base app to avoid repeated backend calls
+import hashlib
+import logging
+import sys
+import threading
+import time
+from collections import (OrderedDict,
+                         namedtuple,
+                         )
+import pandas as pd
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+from .backend import (BACKEND_FAILURES,
+                      BackendUnavailable,
+                      )
+from .instrumentation import metrics
+from .single_flight import single_flight
+
+logger = logging.getLogger(__name__)
+
+# value plus the wall clock times (time.time()) after which it is stale and then unusable, wall
+# clock is used instead of monotonic as the entries are shared between processes. validators are
+# whatever the loader needs to make a conditional request later e.g {'etag': '"abc"'}
+CacheEntry = namedtuple('CacheEntry', ['value', 'stored_at', 'fresh_until', 'stale_until', 'validators'],
+                        defaults=(None,))
+
+
+class LRUCache:
+    """
+    Thread safe in-process least recently used cache bounded by number of entries and/or by the
+    total size of the values as reported by the sizeof function
+    e.g
+        lru = LRUCache(max_entries=2)
+        lru.set('a', 1)
+        lru.get('a') -> 1
+        html_lru = LRUCache(max_bytes=1024 * 1024, sizeof=len)
+    """
+
+    def __init__(self,
+                 max_entries: int = None,
+                 max_bytes: int = None,
+                 sizeof: 'callable returning the size of a value' = None):
+        """
+        :param max_entries: max number of entries kept, the least recently used one is evicted first
+        :type max_entries: int
+        :param max_bytes: max total size of the values kept, needs sizeof
+        :type max_bytes: int
+        :param sizeof: function returning the size of a value in bytes e.g sys.getsizeof
+        :type sizeof: callable
+        """
+        if max_bytes is not None and sizeof is None:
+            raise ValueError("max_bytes needs a sizeof function")
+        self.max_entries: int = max_entries
+        self.max_bytes: int = max_bytes
+        self.sizeof = sizeof
+        self.total_bytes: int = 0
+        self._data: OrderedDict = OrderedDict()
+        self._sizes: dict = dict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        size = self.sizeof(value) if self.sizeof is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Would evict everything else and still not fit, do not cache it at all
+            return
+        with self._lock:
+            self._pop(key)
+            self._data[key] = value
+            self._sizes[key] = size
+            self.total_bytes += size
+            self._evict()
+
+    def _pop(self, key):
+        if key in self._data:
+            del self._data[key]
+            self.total_bytes -= self._sizes.pop(key)
+
+    def _evict(self):
+        while self._data and ((self.max_entries is not None and len(self._data) > self.max_entries) or
+                              (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+            key, _ = self._data.popitem(last=False)
+            self.total_bytes -= self._sizes.pop(key)
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.total_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class CacheStats:
+    """
+    Hit/miss counters for a cache, the increments are done under a lock as they are bumped by
+    all the request threads
+    """
+    COUNTERS = ('hits', 'shared_hits', 'stale_hits', 'misses', 'refreshes', 'refresh_errors', 'not_modified',
+                'negative_hits', 'failure_hits')
+
+    def __init__(self,
+                 counters: tuple = COUNTERS):
+        """
+        :param counters: names of the counters the cache bumps, only those are exported
+        :type counters: tuple
+        """
+        self._lock = threading.Lock()
+        self._counts: dict = dict.fromkeys(counters, 0)
+
+    def incr(self, counter: str):
+        with self._lock:
+            self._counts[counter] += 1
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+        # shared_hits is a subset of hits/stale_hits, it counts the lookups the local tier missed.
+        # not_modified counts the loads answered by the loader with the cached value. negative_hits is the
+        # subset of hits answered by a cached "not found", failure_hits the misses failed at once by a
+        # recent backend failure
+        lookups = counts['hits'] + counts.get('stale_hits', 0) + counts['misses']
+        counts['hit_ratio'] = (lookups - counts['misses']) / lookups if lookups else 0.0
+        return counts
+
+
+class PacketCache:
+    """
+    Read through cache for the packets returned by the backend REST API server keyed by
+    (form_type, security_name). There are 2 tiers
+     1. In-process LRU, bounded by number of packets
+     2. Optional shared tier which is any Django cache alias (file based, memcached, redis) so
+        every worker process sees the packets fetched by the others
+    An entry is fresh for ttl seconds, after that it is still served for stale_ttl seconds while a
+    background thread refreshes it from the backend (stale-while-revalidate). Past that the caller
+    waits for the backend like on a miss
+    The loader is given the cached entry (None on a miss) so it can make a conditional request with
+    the validators stored with it, and returns (value, validators). Returning the cached value as it
+    is renews the entry without storing a new copy
+    A None value ("not found") is cached for negative_ttl seconds and a partial value (fewer than
+    partial_below items, e.g fiscal years) for partial_ttl seconds, so the unknown and the thin securities
+    do not cost a backend call on every request but are looked up again soon. A load which failed
+    because the backend is down is remembered for failure_ttl seconds only in this process, the misses of
+    the key raise BackendUnavailable at once meanwhile instead of waiting for the retries again
+    e.g
+        packet = packet_cache.get_or_load(('10-k', 'msft'), loader_function)
+    Cached packets are shared between requests and must be treated as read only
+    """
+    KEY_PREFIX = 'ci:packet'
+
+    def __init__(self,
+                 local_max_entries: int,
+                 ttl: float,
+                 stale_ttl: float,
+                 shared_alias: str = None,
+                 negative_ttl: float = 0,
+                 partial_ttl: float = None,
+                 partial_below: int = 0,
+                 failure_ttl: float = 0):
+        """
+        :param local_max_entries: size bound of the in-process LRU tier
+        :type local_max_entries: int
+        :param ttl: seconds an entry is served without a refresh
+        :type ttl: float
+        :param stale_ttl: seconds after ttl during which a stale entry is served while refreshing
+        :type stale_ttl: float
+        :param shared_alias: Django cache alias for the shared tier, None to disable it
+        :type shared_alias: str
+        :param negative_ttl: seconds a None value is cached, 0 to never cache it
+        :type negative_ttl: float
+        :param partial_ttl: seconds a partial value is fresh, ttl if None
+        :type partial_ttl: float
+        :param partial_below: a value with fewer items than this is partial, 0 for none
+        :type partial_below: int
+        :param failure_ttl: seconds a failed load is remembered, 0 to retry on every miss
+        :type failure_ttl: float
+        """
+        self.ttl: float = ttl
+        self.stale_ttl: float = stale_ttl
+        self.local = LRUCache(max_entries=local_max_entries)
+        self.shared_alias: str = shared_alias
+        self.negative_ttl: float = negative_ttl
+        self.partial_ttl: float = partial_ttl
+        self.partial_below: int = partial_below
+        self.failure_ttl: float = failure_ttl
+        # key -> time.monotonic() until which its loads fail at once
+        self._failed_until = LRUCache(max_entries=local_max_entries)
+        self.stats = CacheStats()
+        self._refreshing: set = set()
+        self._refreshing_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> 'PacketCache':
+        config = getattr(settings, 'CI_PACKET_CACHE', dict())
+        return cls(local_max_entries=config.get('LOCAL_MAX_ENTRIES', 256),
+                   ttl=config.get('TTL_SECONDS', 24 * 60 * 60),
+                   stale_ttl=config.get('STALE_SECONDS', 7 * 24 * 60 * 60),
+                   shared_alias=config.get('SHARED_CACHE_ALIAS'),
+                   negative_ttl=config.get('NEGATIVE_TTL_SECONDS', 0),
+                   partial_ttl=config.get('PARTIAL_TTL_SECONDS'),
+                   partial_below=config.get('PARTIAL_BELOW_ENTRIES', 0),
+                   failure_ttl=config.get('FAILURE_TTL_SECONDS', 0))
+
+    @property
+    def shared(self) -> 'Django cache or None':
+        if not self.shared_alias:
+            return None
+        try:
+            return caches[self.shared_alias]
+        except InvalidCacheBackendError:
+            logger.error("Shared cache alias %s is not configured in CACHES", self.shared_alias)
+            return None
+
+    def _shared_key(self, key: tuple) -> str:
+        return ':'.join((self.KEY_PREFIX,) + tuple(str(part) for part in key))
+
+    def _lookup(self, key: tuple) -> 'CacheEntry or None':
+        entry = self.local.get(key)
+        if entry is not None:
+            return entry
+        return self._lookup_shared(key)
+
+    def _lookup_shared(self, key: tuple) -> 'CacheEntry or None':
+        shared = self.shared
+        if shared is None:
+            return None
+        entry = shared.get(self._shared_key(key))
+        if entry is not None:
+            self.stats.incr('shared_hits')
+            self.local.set(key, entry)
+        return entry
+
+    def _fresh_in_shared(self, key: tuple) -> 'CacheEntry or None':
+        # another worker process may have loaded the key while this one waited for the lock
+        entry = self._lookup_shared(key)
+        if entry is not None and time.time() < entry.fresh_until:
+            return entry
+        return None
+
+    def peek(self, key: tuple) -> 'CacheEntry or None':
+        """
+        Cached entry with its freshness times, the backend is never called
+        :param key: (form_type, security_name)
+        :type key: tuple
+        :rtype: CacheEntry
+        """
+        return self._lookup(key)
+
+    def set(self, key: tuple, value, ttl: float = None, validators: dict = None, stale_ttl: float = None):
+        """
+        Stores the value in both the tiers
+        :param key: (form_type, security_name)
+        :type key: tuple
+        :param value: packet returned by the backend
+        :type value: dict
+        :param ttl: overrides the default freshness of the entry
+        :type ttl: float
+        :param validators: kept with the value for the next conditional load e.g {'etag': '"abc"'}
+        :type validators: dict
+        :param stale_ttl: overrides the default stale period of the entry
+        :type stale_ttl: float
+        :return: None
+        :rtype: None
+        """
+        ttl = self.ttl if ttl is None else ttl
+        stale_ttl = self.stale_ttl if stale_ttl is None else stale_ttl
+        now = time.time()
+        entry = CacheEntry(value, now, now + ttl, now + ttl + stale_ttl, validators)
+        self.local.set(key, entry)
+        shared = self.shared
+        if shared is not None:
+            shared.set(self._shared_key(key), entry, timeout=ttl + stale_ttl)
+
+    def is_partial(self, value) -> bool:
+        return value is not None and len(value) < self.partial_below
+
+    def delete(self, key: tuple):
+        self.local.delete(key)
+        shared = self.shared
+        if shared is not None:
+            shared.delete(self._shared_key(key))
+
+    def load(self,
+             key: tuple,
+             loader: 'callable returning (value, validators)',
+             previous: CacheEntry = None):
+        """
+        Calls the loader now and stores what it returns, a None value only for negative_ttl
+        :param key: (form_type, security_name)
+        :type key: tuple
+        :param loader: function taking the cached entry or None and returning (value, validators)
+        :type loader: callable
+        :param previous: cached entry given to the loader, looked up if not given
+        :type previous: CacheEntry
+        :return: freshly loaded value
+        """
+        if previous is None:
+            previous = self._lookup(key)
+        value, validators = loader(previous)
+        if value is None:
+            if self.negative_ttl:
+                # no stale period, once expired the next lookup asks the backend again
+                self.set(key, None, ttl=self.negative_ttl, stale_ttl=0)
+            return None
+        if previous is not None and value is previous.value:
+            self.stats.incr('not_modified')
+        if self.is_partial(value) and self.partial_ttl is not None:
+            self.set(key, value, ttl=self.partial_ttl, validators=validators)
+        else:
+            self.set(key, value, validators=validators)
+        return value
+
+    def get_or_load(self,
+                    key: tuple,
+                    loader: 'callable returning (value, validators)'):
+        """
+        Returns the cached value for the key calling the loader only on a miss or a fully expired
+        entry. A None returned by the loader is cached for negative_ttl only
+        :param key: (form_type, security_name)
+        :type key: tuple
+        :param loader: function taking the cached entry or None and returning (value, validators)
+        :type loader: callable
+        :exception: what the loader raises, BackendUnavailable within failure_ttl of a failed load
+        :return: cached or freshly loaded value
+        """
+        entry = self._lookup(key)
+        now = time.time()
+        if entry is not None and now < entry.fresh_until:
+            self.stats.incr('hits')
+            if entry.value is None:
+                self.stats.incr('negative_hits')
+            return entry.value
+        if entry is not None and now < entry.stale_until:
+            self.stats.incr('stale_hits')
+            self._refresh_in_background(key, loader)
+            return entry.value
+        self.stats.incr('misses')
+        failed_until = self._failed_until.get(key)
+        if failed_until is not None and time.monotonic() < failed_until:
+            self.stats.incr('failure_hits')
+            raise BackendUnavailable(f"loading {key} failed less than {self.failure_ttl}s ago")
+        # one load per key at a time, across the threads and the worker processes
+        return single_flight.do((self.KEY_PREFIX,) + tuple(key),
+                                lambda: self._load_once(key, loader, entry),
+                                across_processes=True)
+
+    def _load_once(self,
+                   key: tuple,
+                   loader: 'callable returning (value, validators)',
+                   previous: CacheEntry):
+        entry = self._fresh_in_shared(key)
+        if entry is not None:
+            return entry.value
+        # an expired entry still in a tier is given to the loader for a conditional request
+        try:
+            return self.load(key, loader, previous=previous)
+        except BACKEND_FAILURES:
+            if self.failure_ttl:
+                self._failed_until.set(key, time.monotonic() + self.failure_ttl)
+            raise
+
+    def _refresh_in_background(self,
+                               key: tuple,
+                               loader: 'callable returning (value, validators)'):
+        with self._refreshing_lock:
+            if key in self._refreshing:
+                # Somebody is already refreshing this key, no need to hit the backend twice
+                return
+            self._refreshing.add(key)
+        threading.Thread(target=self._refresh,
+                         args=(key, loader),
+                         name=f"packet-refresh-{key}",
+                         daemon=True).start()
+
+    def _refresh(self,
+                 key: tuple,
+                 loader: 'callable returning (value, validators)'):
+        try:
+            with single_flight.process_lock((self.KEY_PREFIX,) + tuple(key), timeout=0) as acquired:
+                # skipped when another worker process is refreshing or has just refreshed the key
+                if (acquired or not single_flight.lock_dir) and self._fresh_in_shared(key) is None:
+                    if self.load(key, loader) is not None:
+                        self.stats.incr('refreshes')
+        except Exception as ex:
+            # Keep serving the stale entry, the next lookup after it expires will retry
+            self.stats.incr('refresh_errors')
+            logger.warning("Background refresh of %s failed: %s", key, ex)
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.discard(key)
+
+
+class ChartCache:
+    """
+    In-process cache of the rendered plotly HTML <div> strings. Serializing a figure is the most CPU
+    heavy part of a page so the output is kept keyed by
+    (security_name, form_type, field_name, digest of the plotted series). The digest makes sure a
+    new packet with different numbers never serves an old chart. Bounded by the total size of the
+    cached HTML, least recently used charts are evicted first
+    e.g
+        key = ChartCache.make_key('msft', '10-k', 'goodwill', series)
+        div = chart_cache.get(key)
+    """
+
+    def __init__(self,
+                 max_bytes: int):
+        """
+        :param max_bytes: memory budget for the cached HTML
+        :type max_bytes: int
+        """
+        self.lru = LRUCache(max_bytes=max_bytes,
+                            sizeof=sys.getsizeof)
+        # rendered charts never go stale, they are only hit or missed
+        self.stats = CacheStats(counters=('hits', 'misses'))
+
+    @classmethod
+    def from_settings(cls) -> 'ChartCache':
+        config = getattr(settings, 'CI_CHART_CACHE', dict())
+        return cls(max_bytes=config.get('MAX_BYTES', 64 * 1024 * 1024))
+
+    @staticmethod
+    def series_digest(series: 'Pandas series') -> str:
+        """
+        Content hash of the index and values of the series (or data frame), computed vectorized by pandas
+        :rtype: str
+        """
+        row_hashes = pd.util.hash_pandas_object(series, index=True).values
+        return hashlib.blake2b(row_hashes.tobytes(), digest_size=16).hexdigest()
+
+    @classmethod
+    def make_key(cls,
+                 security_name: str,
+                 form_type: str,
+                 field_name: str,
+                 series: 'Pandas series') -> tuple:
+        return security_name, form_type, field_name, cls.series_digest(series)
+
+    def get(self, key: tuple) -> 'str or None':
+        div = self.lru.get(key)
+        self.stats.incr('misses' if div is None else 'hits')
+        return div
+
+    def set(self, key: tuple, div: str):
+        self.lru.set(key, div)
+
+
+# One cache per process, the shared tier (if configured) is common to all the processes
+packet_cache = PacketCache.from_settings()
+chart_cache = ChartCache.from_settings()
+
+
+def _cache_samples() -> list:
+    """
+    Hit/miss counters of the caches for /metrics, grouped by metric family
+    """
+    counts = {cache_name: stats.as_dict()
+              for cache_name, stats in (('packet', packet_cache.stats), ('chart', chart_cache.stats))}
+    samples = [('ci_cache_events_total', 'counter', {'cache': cache_name, 'event': event}, count)
+               for cache_name, cache_counts in counts.items()
+               for event, count in cache_counts.items() if event != 'hit_ratio']
+    samples.extend(('ci_cache_hit_ratio', 'gauge', {'cache': cache_name}, cache_counts['hit_ratio'])
+                   for cache_name, cache_counts in counts.items())
+    samples.append(('ci_chart_cache_bytes', 'gauge', {}, chart_cache.lru.total_bytes))
+    return samples
+
+
+metrics.add_collector(_cache_samples)
@@ -0,0 +1,142 @@
+# This file will define the plotly chart rendering, done inline or in the worker processes of the render pool
+# Nothing Django related is imported here so the spawned workers start fast and without settings
+import logging
+import threading
+from concurrent.futures import (ProcessPoolExecutor,
+                                TimeoutError as FutureTimeoutError,
+                                )
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import numpy as np
+from plotly import graph_objs as go
+from plotly.offline import plot
+
+logger = logging.getLogger(__name__)
+
+
+def render_scatter_div(field_name: str,
+                       x: 'numpy array',
+                       y: 'numpy array') -> 'HTML <div> string':
+    """
+    Plotly HTML <div> of a single field, the same chart whether it runs inline or in a worker
+    :param field_name: name of the field, used as the trace name and the title
+    :type field_name: str
+    :param x: fiscal years
+    :type x: numpy array
+    :param y: values of the field
+    :type y: numpy array
+    :return: HTML <div> string without plotly.js
+    :rtype: str
+    """
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=x,
+                             y=y,
+                             name=field_name,
+                             opacity=0.8,
+                             line_color='deepskyblue'))
+    fig.layout.update(title_text=field_name,
+                      xaxis_rangeslider_visible=False)
+    return plot(fig,
+                output_type='div',
+                include_plotlyjs=False)
+
+
+class ChartRenderPool:
+    """
+    Bounded pool of worker processes rendering the chart <div>s so the plotly figure building and JSON
+    serialization of a many field report runs on every core instead of under the GIL of one process.
+    Only the field name and 2 plain NumPy arrays are sent to a worker (pickled as raw buffers), never the
+    data frame. Every failure (no workers configured, pool broken by a killed worker) falls back to
+    rendering inline in the calling thread. A chart still queued after timeout seconds (every worker busy)
+    is taken back and rendered inline, one a worker already started is waited for so it is never rendered
+    twice
+    The calling thread blocks on the result without holding the GIL, so the request threads (or the
+    chart threads of a streamed report) each keep one worker busy
+    e.g
+        div = chart_render_pool.render('assets', x, y)
+    """
+
+    def __init__(self,
+                 processes: int = 0,
+                 timeout: float = 10.0):
+        """
+        :param processes: worker processes, 0 renders every chart inline
+        :type processes: int
+        :param timeout: seconds a chart waits for a free worker before it is rendered inline
+        :type timeout: float
+        """
+        self.processes: int = processes
+        self.timeout: float = timeout
+        self._executor: ProcessPoolExecutor = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> 'ChartRenderPool':
+        # imported here so the workers importing this module do not need Django
+        from django.conf import settings
+        config = getattr(settings, 'CI_CHART_RENDER', dict())
+        return cls(processes=config.get('PROCESSES', 0),
+                   timeout=config.get('TIMEOUT_SECONDS', 10.0))
+
+    @property
+    def enabled(self) -> bool:
+        return self.processes > 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    # spawn, forking a process with running threads (cache refresh, warmer) can dead lock
+                    self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                         mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def _reset(self, executor: ProcessPoolExecutor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def render(self,
+               field_name: str,
+               x: 'array like',
+               y: 'array like') -> 'HTML <div> string':
+        """
+        :param field_name: name of the field, used as the trace name and the title
+        :type field_name: str
+        :param x: fiscal years
+        :type x: array like
+        :param y: values of the field
+        :type y: array like
+        :return: HTML <div> string
+        :rtype: str
+        """
+        x = np.asarray(x)
+        y = np.asarray(y)
+        if not self.enabled:
+            return render_scatter_div(field_name, x, y)
+        executor = self._get_executor()
+        try:
+            future = executor.submit(render_scatter_div, field_name, x, y)
+            try:
+                return future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                if not future.cancel():
+                    # a worker is already on it, rendering inline as well would only double the work of a
+                    # machine that is already slow
+                    logger.warning("Chart worker slow on %s, still waiting for it", field_name)
+                    return future.result()
+                logger.warning("Chart workers busy, rendering %s inline", field_name)
+        except BrokenProcessPool as bp:
+            logger.error("Chart worker pool broken, starting a new one: %s", bp)
+            self._reset(executor)
+        except RuntimeError as re:
+            # submit() after shutdown, e.g while the interpreter exits
+            logger.warning("Chart worker pool unavailable, rendering %s inline: %s", field_name, re)
+        return render_scatter_div(field_name, x, y)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
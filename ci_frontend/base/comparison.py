@@ -0,0 +1,135 @@
+# This file will define the multi company comparison built on top of DivGenerator
+import logging
+import pandas as pd
+from plotly.offline import plot
+from plotly import graph_objs as go
+from .cache import (chart_cache,
+                    ChartCache,
+                    )
+from .services import (DivGenerator,
+                       generate_data_frames_concurrently,
+                       )
+
+logger = logging.getLogger(__name__)
+
+
+class BatchComparison:
+    """
+    Compares many securities on the same fields. All the packets are fetched concurrently, then aligned
+    into a single data frame indexed by fiscal year with (field, security) column levels, and one chart
+    per field is drawn with one line per security
+    e.g
+        comparison = BatchComparison([('10-k', 'msft'), ('10-k', 'aapl')],
+                                     ['accountspayablecurrent'])
+        await comparison.load()
+        div = comparison.create_div_from_financial_paramter('accountspayablecurrent')
+    """
+
+    def __init__(self,
+                 securities: 'list of (form_type, security_name)',
+                 fields: list):
+        """
+        :param securities: (form_type, security_name) of every security to compare
+        :type securities: list
+        :param fields: column names of DivGenerator.data_frame to compare on
+        :type fields: list
+        """
+        self.securities: list = list(securities)
+        self.fields: list = list(fields)
+        self.failed: dict = dict()
+        self.data_frame: 'DataFrame Pandas' = None
+
+    async def load(self):
+        """
+        Fetches all the securities concurrently and aligns them, the securities which could not be
+        loaded are kept in self.failed with the reason instead of failing the whole comparison
+        :return: None
+        :rtype: None
+        """
+        generators = [DivGenerator(form_type, security_name)
+                      for form_type, security_name in self.securities]
+        results = await generate_data_frames_concurrently(generators)
+        loaded = []
+        for generator, result in zip(generators, results):
+            if isinstance(result, Exception):
+                logger.warning("Unable to load %s for the comparison: %r", generator.security_name, result)
+                self.failed[generator.security_name] = repr(result)
+            else:
+                loaded.append(generator)
+        self.data_frame = self.align(loaded, self.fields)
+
+    @staticmethod
+    def align(generators: 'list of DivGenerator',
+              fields: list) -> 'Pandas data frame':
+        """
+        Puts the requested fields of every security side by side, rows are the union of the fiscal years
+        and a year missing for a security is NaN. Columns with no data at all are dropped
+        :param generators: loaded DivGenerator objects
+        :type generators: list
+        :param fields: column names to keep
+        :type fields: list
+        :return: frame indexed by fiscal year with (field, security) columns
+        :rtype: Pandas data frame
+        """
+        frames = dict()
+        for generator in generators:
+            frame = generator.data_frame.reindex(columns=fields)
+            frame.index = pd.to_numeric(frame.index, errors='coerce')
+            frames[generator.security_name] = frame.apply(pd.to_numeric, errors='coerce')
+        if not frames:
+            columns = pd.MultiIndex.from_product([fields, []], names=['field', 'security'])
+            return pd.DataFrame(columns=columns)
+        aligned = pd.concat(frames, axis=1, names=['security', 'field'])
+        # A field none of the securities reported is of no use on a chart
+        aligned = aligned.dropna(axis=1, how='all')
+        aligned = aligned.swaplevel(axis=1).sort_index(axis=1).sort_index()
+        aligned.index.name = 'fiscal_year'
+        return aligned
+
+    def create_div_from_financial_paramter(self,
+                                           field_name: str) -> 'HTML <div> string':
+        """
+        Returns an HTML <div> with one line per security for the field
+        :param field_name: This is the field caller wants a graph div for
+        :type field_name: str
+        :return: HTML <div> string
+        :rtype: str
+        """
+        if field_name not in self.data_frame.columns.get_level_values('field'):
+            raise ValueError
+        field_frame = self.data_frame[field_name]
+        cache_key = ChartCache.make_key(','.join(field_frame.columns),
+                                        'compare',
+                                        field_name,
+                                        field_frame)
+        plot_div = chart_cache.get(cache_key)
+        if plot_div is not None:
+            return plot_div
+        fig = go.Figure()
+        for security_name in field_frame.columns:
+            fig.add_trace(go.Scatter(x=field_frame.index,
+                                     y=field_frame[security_name],
+                                     name=security_name,
+                                     opacity=0.8))
+        fig.layout.update(title_text=field_name,
+                          xaxis_rangeslider_visible=False)
+        plot_div = plot(fig,
+                        output_type='div',
+                        include_plotlyjs=False)
+        chart_cache.set(cache_key, plot_div)
+        return plot_div
+
+    def create_divs(self) -> list:
+        """
+        The <div>s of every field compared, in the order of self.fields. The fields none of the securities
+        has are left out
+        :return: HTML <div> strings
+        :rtype: list
+        """
+        divs = []
+        for field_name in self.fields:
+            try:
+                divs.append(self.create_div_from_financial_paramter(field_name))
+            except ValueError:
+                logger.warning("Field %s not found for any of %s", field_name, self.securities)
+        return divs
@@ -0,0 +1,12 @@
+# This file will define the template context processors of the base app
+from django.urls import reverse
+from .plotly_bundle import plotly_bundle
+
+
+def plotly_js(request) -> dict:
+    """
+    URL of the locally served plotly.js, versioned so it can be cached by the browsers for good
+    e.g {{ plotly_js_url }} -> /base/plotly/4.11.0/plotly.min.js
+    :rtype: dict
+    """
+    return {'plotly_js_url': reverse('plotly_js', args=[plotly_bundle.version])}
@@ -0,0 +1,119 @@
+# This file will define the year windowing and the shape preserving downsampling of the charted series
+import numpy as np
+import pandas as pd
+
+DOWNSAMPLE_METHODS = ('lttb', 'minmax')
+
+
+def lttb_indices(y: 'numpy array',
+                 max_points: int) -> 'numpy array':
+    """
+    Largest-Triangle-Three-Buckets, keeps the first and last points and from every bucket in between the
+    point making the largest triangle with the point kept before it and the mean of the next bucket, so
+    peaks and trends survive. The points are taken as evenly spaced (fiscal periods) and the bucket means
+    are computed for all the buckets at once, only the pick per bucket is a loop
+    :param y: values without NaN
+    :type y: numpy array
+    :param max_points: number of points kept, a smaller budget than 3 keeps 3 points
+    :type max_points: int
+    :return: sorted positions of the points kept
+    :rtype: numpy array
+    """
+    count = len(y)
+    max_points = max(max_points, 3)
+    if max_points >= count:
+        return np.arange(count)
+    x = np.arange(count, dtype='f8')
+    y = np.asarray(y, dtype='f8')
+    # bucket i covers [edges[i], edges[i + 1]), the first and last points are buckets of their own
+    edges = np.linspace(1, count - 1, max_points - 1).astype(np.int64)
+    starts = np.append(edges[:-1], count - 1)
+    sizes = np.diff(np.append(starts, count))
+    mean_x = np.add.reduceat(x, starts) / sizes
+    mean_y = np.add.reduceat(y, starts) / sizes
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = count - 1
+    previous = 0
+    for bucket in range(max_points - 2):
+        start, end = starts[bucket], starts[bucket + 1]
+        bucket_x = x[start:end]
+        bucket_y = y[start:end]
+        # twice the triangle area, the factor does not change the argmax
+        area = np.abs((x[previous] - mean_x[bucket + 1]) * (bucket_y - y[previous]) -
+                      (x[previous] - bucket_x) * (mean_y[bucket + 1] - y[previous]))
+        previous = start + int(np.argmax(area))
+        selected[bucket + 1] = previous
+    return selected
+
+
+def min_max_indices(y: 'numpy array',
+                    max_points: int) -> 'numpy array':
+    """
+    Keeps the lowest and the highest point of max_points / 2 equal buckets, fully vectorized. Cheaper than
+    LTTB and never drops an extreme value
+    :param y: values without NaN
+    :type y: numpy array
+    :param max_points: number of points kept, a smaller budget than 2 keeps 2 points
+    :type max_points: int
+    :return: sorted positions of the points kept
+    :rtype: numpy array
+    """
+    count = len(y)
+    max_points = max(max_points, 2)
+    if max_points >= count:
+        return np.arange(count)
+    buckets = max_points // 2
+    bucket_ids = np.arange(count) * buckets // count
+    # sorted by bucket then by value, the first and last of a bucket are its min and max
+    order = np.lexsort((np.asarray(y, dtype='f8'), bucket_ids))
+    firsts = np.searchsorted(bucket_ids[order], np.arange(buckets), side='left')
+    lasts = np.searchsorted(bucket_ids[order], np.arange(buckets), side='right') - 1
+    return np.unique(np.concatenate((order[firsts], order[lasts])))
+
+
+def window_years(series: 'Pandas series',
+                 start_year: int = None,
+                 end_year: int = None) -> 'Pandas series':
+    """
+    Part of the series indexed by fiscal years between start_year and end_year, both included
+    :rtype: Pandas series
+    """
+    if start_year is None and end_year is None:
+        return series
+    years = pd.to_numeric(pd.Series(series.index, index=series.index), errors='coerce')
+    mask = years.notna()
+    if start_year is not None:
+        mask &= years >= start_year
+    if end_year is not None:
+        mask &= years <= end_year
+    return series[mask.to_numpy()]
+
+
+def downsample(series: 'Pandas series',
+               max_points: int = None,
+               method: str = 'lttb') -> 'Pandas series':
+    """
+    Series reduced to at most max_points points with a shape preserving method, the missing values are
+    dropped first as they are not drawn anyway. Short series are returned as they are, a budget below the
+    minimum of the method (3 points for LTTB, 2 for min-max) is raised to it
+    e.g
+        downsample(data_frame['assets'], max_points=200)
+    :param series: values indexed by fiscal period
+    :type series: Pandas series
+    :param max_points: point budget of the chart, None for no budget
+    :type max_points: int
+    :param method: 'lttb' or 'minmax'
+    :type method: str
+    :return: the kept points with their index
+    :rtype: Pandas series
+    """
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(f"unknown downsampling method {method}")
+    if not max_points or len(series) <= max_points:
+        return series
+    values = pd.to_numeric(series, errors='coerce').dropna()
+    if len(values) <= max_points:
+        return values
+    pick = lttb_indices if method == 'lttb' else min_max_indices
+    return values.iloc[pick(values.to_numpy(), max_points)]
@@ -0,0 +1,71 @@
+# This file will define the compact JSON figure specs drawn by the browser with plotly.js
+import base64
+import numpy as np
+
+# Little endian numpy dtype for every typed array name understood by figure-spec.js
+TYPED_ARRAY_DTYPES = {
+    'f8': '<f8',
+    'i4': '<i4',
+}
+
+
+def encode_array(values: 'array like',
+                 dtype: str) -> dict:
+    """
+    Packs the values into a base64 encoded typed array, a lot smaller and faster to produce than a
+    JSON list of numbers
+    e.g
+        encode_array([2018, 2019], 'i4') -> {'dtype': 'i4', 'bdata': '4gcAAOMHAAA='}
+    :param values: numbers to pack, NaN is kept for float arrays
+    :type values: array like
+    :param dtype: one of TYPED_ARRAY_DTYPES
+    :type dtype: str
+    :return: dict decoded by figure-spec.js
+    :rtype: dict
+    """
+    array = np.ascontiguousarray(values, dtype=TYPED_ARRAY_DTYPES[dtype])
+    return {'dtype': dtype,
+            'bdata': base64.b64encode(array.tobytes()).decode('ascii')}
+
+
+def encode_axis(values: 'array like') -> 'dict or list':
+    """
+    Fiscal years are packed as int32, anything which is not a whole number (e.g dates) is sent as
+    a plain list
+    :rtype: dict or list
+    """
+    try:
+        array = np.asarray(values, dtype='float64')
+    except (TypeError, ValueError):
+        return [str(value) for value in values]
+    if np.isfinite(array).all() and (array == np.round(array)).all():
+        return encode_array(array, 'i4')
+    return encode_array(array, 'f8')
+
+
+def scatter_spec(x: 'array like',
+                 y: 'array like',
+                 name: str,
+                 title: str) -> dict:
+    """
+    Minimal plotly figure with a single line, same look as the one built by
+    DivGenerator.create_div_from_financial_paramter
+    :param x: x axis values e.g fiscal years
+    :type x: array like
+    :param y: y axis values
+    :type y: array like
+    :param name: name of the trace
+    :type name: str
+    :param title: title of the chart
+    :type title: str
+    :return: {'data': [...], 'layout': {...}}
+    :rtype: dict
+    """
+    return {'data': [{'type': 'scatter',
+                      'name': name,
+                      'x': encode_axis(x),
+                      'y': encode_array(y, 'f8'),
+                      'opacity': 0.8,
+                      'line': {'color': 'deepskyblue'}}],
+            'layout': {'title': {'text': title},
+                       'xaxis': {'rangeslider': {'visible': False}}}}
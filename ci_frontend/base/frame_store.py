@@ -0,0 +1,256 @@
+# This file will define the local on-disk columnar store of the per security data frames
+import fcntl
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from .packet_schema import fiscal_year_index
+
+logger = logging.getLogger(__name__)
+
+
+class FrameSnapshot:
+    """
+    Data frame of a security read from the FrameStore, the values are a read only memory map of the
+    values file so loading costs a mmap() and a json.load of the small meta file, no copy and no parsing
+    """
+
+    def __init__(self,
+                 data_frame: 'Pandas data frame',
+                 constants: dict,
+                 checked_at: float):
+        """
+        :param data_frame: years x fields float64 frame backed by the memory map
+        :type data_frame: DataFrame
+        :param constants: non numeric columns which are the same every year e.g {'ticker': 'msft'}
+        :type constants: dict
+        :param checked_at: epoch time the snapshot was last compared with the backend
+        :type checked_at: float
+        """
+        self.data_frame: 'Pandas data frame' = data_frame
+        self.constants: dict = constants
+        self.checked_at: float = checked_at
+
+    def age(self) -> float:
+        return time.time() - self.checked_at
+
+
+class FrameStore:
+    """
+    Stores the numeric columns of the data frame of every (form_type, security) on local disk as a row major
+    float64 matrix, one row per fiscal year
+        <root>/<form_type>/<security>/values.f8   raw little endian float64, rows x len(fields)
+        <root>/<form_type>/<security>/meta.json   {"fields": [..], "years": [..], "rows": n, ...}
+    The meta file is replaced atomically after the values are written, readers only map the first "rows"
+    rows so they never see a half written year. New fiscal years are appended in place, a new field, an out
+    of order year or a stored year whose values changed (an amended filing) rewrites the values file
+    e.g
+        frame_store.update('10-k', 'msft', data_frame)
+        snapshot = frame_store.load('10-k', 'msft')
+        snapshot.data_frame['assets']
+    """
+    VALUES_FILE = 'values.f8'
+    META_FILE = 'meta.json'
+    LOCK_FILE = '.lock'
+    DTYPE = np.dtype('<f8')
+
+    def __init__(self,
+                 root: str,
+                 max_age: float = 24 * 60 * 60):
+        """
+        :param root: directory of the store, created on first write
+        :type root: str
+        :param max_age: seconds a snapshot is used before it is compared with the backend again
+        :type max_age: float
+        """
+        self.root: str = str(root)
+        self.max_age: float = max_age
+
+    @classmethod
+    def from_settings(cls) -> 'FrameStore or None':
+        config = getattr(settings, 'CI_FRAME_STORE', dict())
+        if not config.get('ROOT'):
+            return None
+        return cls(root=config['ROOT'],
+                   max_age=config.get('MAX_AGE_SECONDS', 24 * 60 * 60))
+
+    def _path(self, form_type: str, security_name: str) -> str:
+        return os.path.join(self.root, form_type, security_name)
+
+    @contextmanager
+    def _locked(self, path: str):
+        # one writer per security across all the worker processes
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, self.LOCK_FILE), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_meta(self, path: str) -> 'dict or None':
+        try:
+            with open(os.path.join(path, self.META_FILE)) as meta_file:
+                return json.load(meta_file)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, path: str, meta: dict):
+        temp_path = os.path.join(path, self.META_FILE + '.tmp')
+        with open(temp_path, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(temp_path, os.path.join(path, self.META_FILE))
+
+    def load(self,
+             form_type: str,
+             security_name: str) -> 'FrameSnapshot or None':
+        """
+        :param form_type: SEC form type like e.g '10-k'
+        :type form_type: str
+        :param security_name: lower case ticker symbol like 'msft'
+        :type security_name: str
+        :return: memory mapped snapshot or None if the security was never stored
+        :rtype: FrameSnapshot
+        """
+        path = self._path(form_type, security_name)
+        meta = self._read_meta(path)
+        if meta is None or not meta['rows']:
+            return None
+        values = np.memmap(os.path.join(path, self.VALUES_FILE),
+                           dtype=self.DTYPE,
+                           mode='r',
+                           shape=(meta['rows'], len(meta['fields'])))
+        data_frame = pd.DataFrame(values,
+                                  index=fiscal_year_index(meta['years']),
+                                  columns=meta['fields'],
+                                  copy=False)
+        return FrameSnapshot(data_frame, meta.get('constants', dict()), meta['checked_at'])
+
+    def load_many(self,
+                  form_type: str,
+                  security_names: list) -> dict:
+        """
+        Snapshots of many securities for cross company analytics, the ones never stored are left out
+        :rtype: dict
+        """
+        snapshots = ((security_name, self.load(form_type, security_name)) for security_name in security_names)
+        return {security_name: snapshot for security_name, snapshot in snapshots if snapshot is not None}
+
+    def stamp(self,
+              form_type: str,
+              security_name: str) -> 'int or None':
+        """
+        Changes every time the snapshot of the security is updated, None if it was never stored
+        :rtype: int
+        """
+        try:
+            return os.stat(os.path.join(self._path(form_type, security_name), self.META_FILE)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def securities(self, form_type: str) -> list:
+        try:
+            return sorted(os.listdir(os.path.join(self.root, form_type)))
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def _split_columns(data_frame: 'Pandas data frame') -> tuple:
+        numeric = data_frame.select_dtypes(include='number')
+        constants = {column: data_frame[column].iloc[-1]
+                     for column in data_frame.columns.difference(numeric.columns)
+                     if data_frame[column].nunique(dropna=False) == 1}
+        return numeric, constants
+
+    def update(self,
+               form_type: str,
+               security_name: str,
+               data_frame: 'Pandas data frame') -> int:
+        """
+        Brings the stored snapshot in line with a data frame built from a fresh packet. The new years are
+        appended, the years of the packet already stored are replaced when their values changed and the
+        stored years the packet does not have are kept
+        :param form_type: SEC form type like e.g '10-k'
+        :type form_type: str
+        :param security_name: lower case ticker symbol like 'msft'
+        :type security_name: str
+        :param data_frame: fiscal years x fields, as built by DivGenerator
+        :type data_frame: DataFrame
+        :return: number of years written, new or changed
+        :rtype: int
+        """
+        numeric, constants = self._split_columns(data_frame)
+        years = [str(year) for year in numeric.index]
+        numeric = numeric.astype(self.DTYPE).set_axis(pd.Index(years, dtype=object), axis=0)
+        path = self._path(form_type, security_name)
+        with self._locked(path):
+            meta = self._read_meta(path)
+            stored_years = meta['years'] if meta else []
+            known_years = set(stored_years)
+            new_years = [year for year in years if year not in known_years]
+            old = self.load(form_type, security_name) if meta else None
+            changed_years = self._changed_years(old, numeric, meta) if old is not None else []
+            rewrite = (meta is None or
+                       changed_years or
+                       not set(numeric.columns).issubset(meta['fields']) or
+                       (stored_years and new_years and min(new_years) < stored_years[-1]))
+            if rewrite:
+                fields = list(meta['fields']) if meta else []
+                fields += [column for column in numeric.columns if column not in set(fields)]
+                merged = numeric
+                if old is not None:
+                    # the packet values win, the stored years and fields it does not have are kept
+                    merged = numeric.combine_first(old.data_frame.rename(index=str))
+                merged = merged.reindex(columns=fields).sort_index()
+                temp_path = os.path.join(path, self.VALUES_FILE + '.tmp')
+                merged.to_numpy(dtype=self.DTYPE).tofile(temp_path)
+                os.replace(temp_path, os.path.join(path, self.VALUES_FILE))
+                meta = {'fields': fields,
+                        'years': list(merged.index),
+                        'rows': len(merged)}
+                written = len(new_years) + len(changed_years)
+            else:
+                appended = numeric.loc[new_years]
+                rows = appended.reindex(columns=meta['fields']).to_numpy(dtype=self.DTYPE)
+                with open(os.path.join(path, self.VALUES_FILE), 'r+b') as values_file:
+                    # anything past the committed rows is a left over of a failed write
+                    values_file.seek(meta['rows'] * len(meta['fields']) * self.DTYPE.itemsize)
+                    values_file.write(rows.tobytes())
+                    values_file.truncate()
+                meta['years'] = stored_years + new_years
+                meta['rows'] = len(meta['years'])
+                written = len(new_years)
+            meta['constants'] = {key: (value.item() if hasattr(value, 'item') else value)
+                                 for key, value in constants.items()}
+            meta['checked_at'] = time.time()
+            self._write_meta(path, meta)
+        if written:
+            logger.info("Stored %s new or changed years for %s %s", written, form_type, security_name)
+        return written
+
+    @staticmethod
+    def _changed_years(old: FrameSnapshot,
+                       numeric: 'Pandas data frame',
+                       meta: dict) -> list:
+        """
+        Stored years the fresh data frame has other values for, e.g an amended filing. Only the values sent
+        are compared, a field missing from the packet keeps its stored value
+        :rtype: list
+        """
+        stored = old.data_frame.rename(index=str)
+        stored_years = set(stored.index)
+        overlap = [year for year in numeric.index if year in stored_years]
+        columns = [column for column in numeric.columns if column in set(meta['fields'])]
+        if not overlap or not columns:
+            return []
+        fresh = numeric.loc[overlap, columns].to_numpy(dtype='f8')
+        kept = stored.loc[overlap, columns].to_numpy(dtype='f8')
+        changed = ~np.isnan(fresh) & (fresh != kept)
+        return [year for year, year_changed in zip(overlap, changed.any(axis=1)) if year_changed]
+
+
+frame_store = FrameStore.from_settings()
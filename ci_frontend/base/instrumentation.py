@@ -0,0 +1,189 @@
+# This file will define the light weight timing instrumentation and the Prometheus metrics of the base app
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets, +Inf is implicit
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (stage, seconds) recorded during the current request, set by middleware.TimingMiddleware
+_request_timings: contextvars.ContextVar = contextvars.ContextVar('ci_request_timings', default=None)
+
+
+class Histogram:
+    """
+    Cumulative Prometheus style histogram, one observe() is a bisect and 3 increments under a lock
+    """
+
+    def __init__(self,
+                 buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets: tuple = buckets
+        self.counts: list = [0] * (len(buckets) + 1)
+        self.total: float = 0.0
+        self.count: int = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += value
+            self.count += 1
+
+    def snapshot(self) -> tuple:
+        """
+        :return: (cumulative counts per bucket including +Inf, sum, count)
+        :rtype: tuple
+        """
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.total, self.count
+        cumulative = []
+        running = 0
+        for bucket_count in counts:
+            running += bucket_count
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+class MetricsRegistry:
+    """
+    Process wide registry of the histograms and counters, rendered in the Prometheus text format by the
+    /metrics view. Every metric is identified by its name and a tuple of (label, value) pairs
+    e.g
+        metrics.observe('ci_stage_seconds', 0.02, stage='fetch')
+        metrics.incr('ci_backend_retries_total')
+    Collectors are functions called at render time returning extra (name, type, labels, value) samples,
+    used for the numbers other modules keep anyway like the cache hit counters
+    """
+
+    def __init__(self):
+        self._histograms: dict = dict()
+        self._counters: dict = dict()
+        self._help: dict = dict()
+        self._collectors: list = []
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        histogram.observe(value)
+
+    def incr(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def add_collector(self, collector: 'callable returning a list of samples'):
+        with self._lock:
+            self._collectors.append(collector)
+
+    @staticmethod
+    def _format_labels(labels: tuple) -> str:
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                   for _, value in labels)
+        return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + '}'
+
+    def _family(self, families: dict, name: str, metric_type: str) -> list:
+        """
+        Lines of the metric family, started with its HELP/TYPE header the first time it is seen
+        """
+        lines = families.get(name)
+        if lines is None:
+            lines = families[name] = []
+            if name in self._help:
+                lines.append(f'# HELP {name} {self._help[name]}')
+            lines.append(f'# TYPE {name} {metric_type}')
+        return lines
+
+    def render(self) -> str:
+        """
+        :return: every metric in the Prometheus text exposition format 0.0.4, the samples of a family are
+                 kept together whichever collector returned them
+        :rtype: str
+        """
+        families = dict()
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            collectors = list(self._collectors)
+        for (name, labels), histogram in histograms:
+            lines = self._family(families, name, 'histogram')
+            cumulative, total, count = histogram.snapshot()
+            for bound, bucket_count in zip(histogram.buckets + ('+Inf',), cumulative):
+                lines.append(f'{name}_bucket{self._format_labels(labels + (("le", bound),))} {bucket_count}')
+            lines.append(f'{name}_sum{self._format_labels(labels)} {total}')
+            lines.append(f'{name}_count{self._format_labels(labels)} {count}')
+        for (name, labels), value in counters:
+            self._family(families, name, 'counter').append(f'{name}{self._format_labels(labels)} {value}')
+        for collector in collectors:
+            for name, metric_type, labels, value in collector():
+                self._family(families, name, metric_type).append(
+                    f'{name}{self._format_labels(tuple(sorted(labels.items())))} {value}')
+        return '\n'.join(line for lines in families.values() for line in lines) + '\n'
+
+
+metrics = MetricsRegistry()
+metrics.describe('ci_request_seconds', 'Time spent serving a request per view')
+metrics.describe('ci_stage_seconds', 'Time spent per stage of a request (db, fetch, backend, dataframe, plot ..)')
+metrics.describe('ci_backend_attempts_total', 'Calls made to the backend REST API server including retries')
+metrics.describe('ci_backend_retries_total', 'Backend calls retried after a failure')
+metrics.describe('ci_backend_not_modified_total', 'Conditional backend calls answered with 304 Not Modified')
+metrics.describe('ci_rate_limited_total', 'Requests refused with 429 per budget and scope (client or global)')
+metrics.describe('ci_shed_total', 'Reports refused by the admission control, served stale or with a 503')
+
+
+def start_request_timings() -> 'contextvars token':
+    """
+    Called by the middleware when a request comes in, the stages timed until reset_request_timings()
+    are reported in the Server-Timing header
+    """
+    return _request_timings.set([])
+
+
+def request_timings() -> list:
+    """
+    :return: (stage, seconds) recorded for the current request, empty outside of a request
+    :rtype: list
+    """
+    return _request_timings.get() or []
+
+
+def reset_request_timings(token: 'contextvars token'):
+    _request_timings.reset(token)
+
+
+def record_stage(stage: str, seconds: float):
+    """
+    Records the time spent in a stage in the stage histogram and in the current request timings
+    """
+    metrics.observe('ci_stage_seconds', seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def timed(stage: str):
+    """
+    Times the block as the stage
+    e.g
+        with timed('plot'):
+            plot_div = plot(fig, output_type='div')
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
@@ -0,0 +1,99 @@
+# This file will define the bulk loader for the CommonStock table
+import csv
+import logging
+from django.db import transaction
+from .models import CommonStock
+from .search_index import search_index
+
+logger = logging.getLogger(__name__)
+
+
+class CommonStockLoader:
+    """
+    Brings the CommonStock table in line with a list of companies (e.g the S&P 500 constituents CSV or a
+    dump of every SEC filer). The rows are diffed against the table and only the differences are written
+    with bulk_create/bulk_update/delete inside one transaction, so searches keep seeing the old list until
+    the new one is committed and there is never a window with an empty table
+    e.g
+        counts = CommonStockLoader().sync(CommonStockLoader.read_csv('scripts/constituents_csv.csv'))
+        counts -> {'created': 3, 'updated': 1, 'deleted': 2, 'unchanged': 499}
+    """
+    BATCH_SIZE = 500
+    # Columns read from the CSV, see the constituents_csv file header
+    CSV_COLUMNS = ('Symbol', 'Name', 'Sector')
+
+    def __init__(self,
+                 batch_size: int = BATCH_SIZE):
+        """
+        :param batch_size: rows per INSERT/UPDATE statement
+        :type batch_size: int
+        """
+        self.batch_size: int = batch_size
+
+    @classmethod
+    def read_csv(cls,
+                 csv_path: str) -> 'iterator of dict':
+        """
+        Streams the CSV file one row at a time, the header row is used to find the columns
+        :param csv_path: path of the CSV with at least the Symbol, Name and Sector columns
+        :type csv_path: str
+        :return: dicts with the symbol, Name and Sector keys
+        :rtype: iterator
+        """
+        with open(csv_path, newline='') as csv_file:
+            for row in csv.DictReader(csv_file, delimiter=','):
+                symbol, name, sector = (row[column].strip() for column in cls.CSV_COLUMNS)
+                if symbol:
+                    yield {'symbol': symbol, 'Name': name, 'Sector': sector}
+
+    def sync(self,
+             rows: 'iterable of dict') -> dict:
+        """
+        Applies the inserts/updates/deletes needed to make the table match the rows. The case-folded
+        symbol is the key (unique in the table), a symbol repeated in the rows keeps its last values
+        :param rows: dicts with the symbol, Name and Sector keys
+        :type rows: iterable
+        :return: number of rows created, updated, deleted and unchanged
+        :rtype: dict
+        """
+        wanted = {CommonStock.normalize_text(row['symbol']): row for row in rows}
+        counts = dict.fromkeys(('created', 'updated', 'deleted', 'unchanged'), 0)
+        with transaction.atomic():
+            to_update = []
+            to_delete = []
+            existing = set()
+            for stock in CommonStock.objects.only('id', 'symbol', 'Name', 'Sector').order_by('id').iterator():
+                symbol_key = CommonStock.normalize_text(stock.symbol)
+                if symbol_key not in wanted:
+                    to_delete.append(stock.id)
+                    continue
+                existing.add(symbol_key)
+                row = wanted[symbol_key]
+                if (stock.symbol, stock.Name, stock.Sector) != (row['symbol'], row['Name'], row['Sector']):
+                    stock.symbol = row['symbol']
+                    stock.Name = row['Name']
+                    stock.Sector = row['Sector']
+                    stock.normalize()
+                    to_update.append(stock)
+                else:
+                    counts['unchanged'] += 1
+            to_create = [CommonStock(**row) for symbol_key, row in wanted.items() if symbol_key not in existing]
+            # bulk_create does not call save(), fill the search key columns here
+            for stock in to_create:
+                stock.normalize()
+            for start in range(0, len(to_delete), self.batch_size):
+                # no post_delete signal per row (nothing references the table), the search index is told
+                # once below
+                CommonStock.objects.filter(id__in=to_delete[start:start + self.batch_size])._raw_delete(
+                    CommonStock.objects.db)
+            CommonStock.objects.bulk_update(to_update,
+                                            ['symbol', 'Name', 'Sector', 'symbol_key', 'name_key'],
+                                            batch_size=self.batch_size)
+            CommonStock.objects.bulk_create(to_create, batch_size=self.batch_size)
+            # none of the bulk operations send the model signals, tell the search index once committed
+            transaction.on_commit(search_index.mark_stale)
+        counts['created'] = len(to_create)
+        counts['updated'] = len(to_update)
+        counts['deleted'] = len(to_delete)
+        logger.info("CommonStock table synced %s", counts)
+        return counts
@@ -0,0 +1,55 @@
+# This file will define the middleware of the base app
+import time
+from django.conf import settings
+from django.db import connection
+from .instrumentation import (metrics,
+                              timed,
+                              request_timings,
+                              reset_request_timings,
+                              start_request_timings,
+                              )
+
+
+class TimingMiddleware:
+    """
+    Times every request and the stages it went through (DB queries, packet fetch, backend calls and their
+    retries, data frame build, plotly serialization ..). The totals feed the ci_request_seconds and
+    ci_stage_seconds histograms of /metrics and the per stage times of the request are sent back in a
+    Server-Timing header, e.g
+        Server-Timing: db;dur=0.41, fetch;dur=23.10, backend;dur=22.87, dataframe;dur=2.05, total;dur=31.02
+    The cost per request is a few perf_counter calls and histogram increments so it can stay on in production
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.server_timing: bool = getattr(settings, 'CI_SERVER_TIMING_HEADER', True)
+
+    @staticmethod
+    def _time_query(execute, sql, params, many, context):
+        with timed('db'):
+            return execute(sql, params, many, context)
+
+    def __call__(self, request):
+        token = start_request_timings()
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(self._time_query):
+                response = self.get_response(request)
+            total = time.perf_counter() - start
+            view_name = request.resolver_match.url_name if request.resolver_match else 'unresolved'
+            metrics.observe('ci_request_seconds', total, view=view_name or 'unnamed')
+            if self.server_timing:
+                response['Server-Timing'] = self._server_timing(request_timings(), total)
+        finally:
+            reset_request_timings(token)
+        return response
+
+    @staticmethod
+    def _server_timing(timings: list, total: float) -> str:
+        # a stage hit more than once (e.g 2 charts) is reported as the sum of its times
+        per_stage = dict()
+        for stage, seconds in timings:
+            per_stage[stage] = per_stage.get(stage, 0.0) + seconds
+        entries = [f'{stage};dur={seconds * 1000:.2f}' for stage, seconds in per_stage.items()]
+        entries.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(entries)
@@ -0,0 +1,39 @@
+# Generated by Django 3.1.1 on 2026-10-18 11:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommonStock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('symbol', models.CharField(default='None', max_length=100)),
+                ('Name', models.CharField(default='None', max_length=200)),
+                ('Sector', models.CharField(default='None', max_length=100)),
+                ('form_type', models.CharField(default='10-k', max_length=25)),
+            ],
+            options={
+                'db_table': 'commonstock',
+            },
+        ),
+        migrations.CreateModel(
+            name='Project',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=100)),
+                ('description', models.TextField()),
+                ('url', models.URLField()),
+                ('tools', models.CharField(max_length=100)),
+                ('pub_date', models.DateTimeField()),
+                ('img_name', models.CharField(max_length=100)),
+            ],
+        ),
+    ]
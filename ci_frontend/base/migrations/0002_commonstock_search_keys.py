@@ -0,0 +1,51 @@
+# Adds the case-folded key columns searched by the views instead of icontains
+
+from django.db import migrations, models
+
+
+def fill_search_keys(apps, schema_editor):
+    """
+    Fills symbol_key/name_key for the rows already in the table, when a symbol is listed more than once
+    (whatever its case) only the oldest row is kept so the unique index can be created
+    """
+    CommonStock = apps.get_model('base', 'CommonStock')
+    seen = set()
+    duplicates = []
+    stocks = []
+    for stock in CommonStock.objects.order_by('id').iterator():
+        stock.symbol_key = stock.symbol.strip().casefold()
+        stock.name_key = stock.Name.strip().casefold()
+        if stock.symbol_key in seen:
+            duplicates.append(stock.id)
+            continue
+        seen.add(stock.symbol_key)
+        stocks.append(stock)
+    CommonStock.objects.filter(id__in=duplicates).delete()
+    CommonStock.objects.bulk_update(stocks, ['symbol_key', 'name_key'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commonstock',
+            name='symbol_key',
+            field=models.CharField(default='', max_length=100),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='commonstock',
+            name='name_key',
+            field=models.CharField(db_index=True, default='', max_length=200),
+        ),
+        migrations.RunPython(fill_search_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='commonstock',
+            name='symbol_key',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+    ]
@@ -2,7 +2,9 @@
 from __future__ import unicode_literals
 
 from django.db import models
+from django.db.models import Q
 from django.forms import CharField
+from .search_index import search_index
 
 
 class Project(models.Model):
@@ -20,6 +22,44 @@ class Project(models.Model):
         return self.title
 
 
+# Highest code point, key + PREFIX_UPPER_BOUND is the upper bound of an index range scan for a prefix
+PREFIX_UPPER_BOUND = '\U0010ffff'
+
+
+class CommonStockQuerySet(models.QuerySet):
+    """
+    Searches run on the case-folded key columns. Exact and prefix lookups are B-tree range scans on the
+    indexed columns so they stay flat as the table grows. When nothing starts with the query the substring
+    matches are found with the trigrams of the in-memory search index and looked up by their unique symbol
+    key, there is no LIKE '%q%' scan
+    """
+
+    def search(self,
+               query: str) -> 'QuerySet':
+        """
+        Returns the companies matching the query, the first non empty of
+         1. exact symbol match
+         2. symbol or name prefix match
+         3. symbol or name substring match, for queries of at least 3 characters (see search_index)
+        :param query: symbol or company name typed by the user
+        :type query: str
+        :rtype: QuerySet
+        """
+        key = CommonStock.normalize_text(query)
+        if not key:
+            return self.none()
+        upper = key + PREFIX_UPPER_BOUND
+        for candidates in (self.filter(symbol_key=key),
+                           self.filter(Q(symbol_key__gte=key, symbol_key__lt=upper) |
+                                       Q(name_key__gte=key, name_key__lt=upper))):
+            candidates = candidates.order_by('symbol_key')
+            if candidates.exists():
+                return candidates
+        # the best ranked substring matches of the search index, capped like the type-ahead
+        symbol_keys = [CommonStock.normalize_text(hit.symbol) for hit in search_index.search(key)]
+        return self.filter(symbol_key__in=symbol_keys).order_by('symbol_key')
+
+
 class CommonStock(models.Model):
     """
     Defines the column field of the DB where all the S&P 500 companies are listed. This DB will be used
@@ -40,8 +80,40 @@ class CommonStock(models.Model):
     # which depend on 10-k form reports
     form_type = models.CharField(max_length=25,
                                  default='10-k')
+    # Case folded copies of symbol and Name kept in sync by normalize(), the searches run on these
+    # indexed columns instead of icontains. A symbol can only be listed once whatever its case
+    symbol_key = models.CharField(max_length=100,
+                                  unique=True)
+    name_key = models.CharField(max_length=200,
+                                default='',
+                                db_index=True)
+
+    objects = CommonStockQuerySet.as_manager()
+
     class Meta:
         db_table = "commonstock"
 
     def __str__(self):
         return self.symbol
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        """
+        e.g ' AAPL' -> 'aapl'
+        :rtype: str
+        """
+        return (text or '').strip().casefold()
+
+    def normalize(self):
+        """
+        Fills the key columns from symbol and Name, needed before bulk_create/bulk_update as those do
+        not call save()
+        :return: None
+        :rtype: None
+        """
+        self.symbol_key = self.normalize_text(self.symbol)
+        self.name_key = self.normalize_text(self.Name)
+
+    def save(self, *args, **kwargs):
+        self.normalize()
+        super().save(*args, **kwargs)
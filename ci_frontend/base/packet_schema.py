@@ -0,0 +1,175 @@
+# This file will define the typed conversion of the backend packets into compact pandas data frames
+# Nothing Django related is imported at module level so the fake backend script can share the field list
+import json
+import numpy as np
+import pandas as pd
+
+try:
+    # optional, parses the raw response bytes several times faster than the standard library
+    import orjson
+except ImportError:
+    orjson = None
+
+# Fields sent by the real backend for a 10-k packet, all of them amounts in USD
+FINANCIAL_FIELDS = (
+    'accountspayablecurrent', 'accountsreceivablenetcurrent', 'accruedincometaxescurrent',
+    'accruedincometaxesnoncurrent', 'accumulatedothercomprehensiveincomelossnetoftax', 'assets',
+    'assetscurrent', 'availableforsalesecuritiescurrent', 'cashandcashequivalentsatcarryingvalue',
+    'cashcashequivalentsandshortterminvestments', 'commonstocksincludingadditionalpaidincapital',
+    'contractwithcustomerliabilitycurrent', 'contractwithcustomerliabilitynoncurrent',
+    'deferredrevenuecurrent', 'deferredrevenuenoncurrent', 'deferredtaxassetsliabilitiesnetcurrent',
+    'deferredtaxliabilitiesnoncurrent', 'depositsreceivedforsecuritiesloanedatcarryingvalue',
+    'employeerelatedliabilitiescurrent', 'finitelivedintangibleassetsnet', 'goodwill', 'inventorynet',
+    'liabilities', 'liabilitiesandstockholdersequity', 'liabilitiescurrent', 'longtermdebtcurrent',
+    'longtermdebtnoncurrent', 'longterminvestments', 'operatingleaseliabilitynoncurrent',
+    'operatingleaserightofuseasset', 'otherassetscurrent', 'otherassetsnoncurrent',
+    'otherliabilitiescurrent', 'otherliabilitiesnoncurrent', 'propertyplantandequipmentnet',
+    'retainedearningsaccumulateddeficit', 'shorttermborrowings', 'shortterminvestments',
+    'stockholdersequity',
+)
+# Sent with every fiscal year of the packet, the strings repeat every year so they are categories
+BOOKKEEPING_DTYPES = {
+    'filing-type': 'category',
+    'filing-year': 'Int32',
+    'ticker': 'category',
+}
+
+
+def loads(raw: 'bytes or str'):
+    """
+    Decodes a JSON response body, straight from the raw bytes with orjson when it is installed
+    :param raw: body of the backend response
+    :type raw: bytes
+    :exception: ValueError if the body is not JSON
+    :return: decoded JSON
+    """
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def fiscal_year_index(years: 'iterable of str') -> 'Pandas index':
+    """
+    Index of the packet keys, integer fiscal years when every key is a year and the keys as they are
+    otherwise (e.g a quarterly packet keyed by '2019-Q3')
+    e.g
+        fiscal_year_index(['2018', '2019']) -> Index([2018, 2019], dtype='int64')
+    :rtype: Pandas index
+    """
+    years = list(years)
+    try:
+        return pd.Index(np.array(years, dtype=np.int64))
+    except (TypeError, ValueError, OverflowError):
+        return pd.Index(years, dtype=object)
+
+
+class PacketSchema:
+    """
+    Builds the data frame of a packet ({fiscal year: {field: value}}) one typed column at a time instead of
+    letting pandas infer the dtypes of a dict of dicts: the financial fields are float64, the bookkeeping
+    fields nullable integers or categories and the index holds integer fiscal years sorted oldest first.
+    Fields outside the schema are kept as float64 when they are numbers and as categories otherwise
+    With fields set, only those fields (and the bookkeeping ones) are converted, the rest of the packet is
+    never looked at
+    e.g
+        data_frame = packet_schema.to_data_frame(packet)
+    """
+
+    def __init__(self,
+                 dtypes: dict = None,
+                 fields: list = None):
+        """
+        :param dtypes: dtype per known field, FINANCIAL_FIELDS as float64 and BOOKKEEPING_DTYPES if None
+        :type dtypes: dict
+        :param fields: fields converted, every field of the packet if None
+        :type fields: list
+        """
+        if dtypes is None:
+            dtypes = dict.fromkeys(FINANCIAL_FIELDS, 'float64')
+            dtypes.update(BOOKKEEPING_DTYPES)
+        self.dtypes: dict = dtypes
+        self.fields: list = list(fields) if fields is not None else None
+
+    @classmethod
+    def from_settings(cls) -> 'PacketSchema':
+        # imported here so the scripts importing the field list do not need Django
+        from django.conf import settings
+        config = getattr(settings, 'CI_PACKET_SCHEMA', dict())
+        return cls(fields=config.get('FIELDS'))
+
+    def _field_names(self, rows: list) -> list:
+        if self.fields is not None:
+            return list(dict.fromkeys(self.fields + list(BOOKKEEPING_DTYPES)))
+        # union of the fields of every year in order of appearance, a field may be missing some years
+        names = dict()
+        for row in rows:
+            names.update(dict.fromkeys(row))
+        return list(names)
+
+    @staticmethod
+    def _column(values: list,
+                dtype: str) -> 'array like':
+        """
+        One column of the data frame, a missing value (None) is NaN/<NA>
+        :param values: value of the field for every year
+        :type values: list
+        :param dtype: 'float64', a pandas extension dtype e.g 'Int32' or None to pick one
+        :type dtype: str
+        :rtype: array like
+        """
+        if dtype == 'category':
+            return pd.Categorical(values)
+        if dtype is not None and dtype != 'float64':
+            try:
+                return pd.array(values, dtype=dtype)
+            except (TypeError, ValueError):
+                dtype = None
+        try:
+            # C speed, None -> NaN and numeric strings are parsed
+            return np.array(values, dtype='float64')
+        except (TypeError, ValueError):
+            pass
+        numbers = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce')
+        if dtype == 'float64' or numbers.notna().sum() >= sum(value is not None for value in values):
+            return numbers.to_numpy(dtype='float64')
+        return pd.Categorical(values)
+
+    def to_data_frame(self, packet: dict) -> 'Pandas data frame':
+        """
+        The float64 fields are converted together into a single 2-D block, one numpy call for the whole
+        packet and no block consolidation by pandas, the few other fields are added as typed columns
+        :param packet: {fiscal year: {field: value}} as sent by the backend
+        :type packet: dict
+        :exception: ValueError if the packet is not shaped like that
+        :return: fiscal years x fields, sorted by fiscal year
+        :rtype: Pandas data frame
+        """
+        if not isinstance(packet, dict) or not all(isinstance(row, dict) for row in packet.values()):
+            raise ValueError("the packet is not a dict of fiscal years each holding a dict of fields")
+        rows = list(packet.values())
+        names = self._field_names(rows)
+        index = fiscal_year_index(packet)
+        # fields outside the schema are expected to be amounts too, checked when the block fails
+        float_names = [name for name in names if self.dtypes.get(name, 'float64') == 'float64']
+        try:
+            block = np.array([[row.get(name) for name in float_names] for row in rows],
+                             dtype='float64').reshape(len(rows), len(float_names))
+        except (TypeError, ValueError):
+            # a value is not a number, every field is typed on its own
+            data_frame = pd.DataFrame({name: self._column([row.get(name) for row in rows], self.dtypes.get(name))
+                                       for name in names},
+                                      index=index)
+        else:
+            data_frame = pd.DataFrame(block,
+                                      index=index,
+                                      columns=float_names,
+                                      copy=False)
+            typed_names = set(float_names)
+            for name in (name for name in names if name not in typed_names):
+                data_frame[name] = self._column([row.get(name) for row in rows], self.dtypes[name])
+        if self.fields is not None:
+            # a field asked for but not sent by the backend is left out
+            data_frame = data_frame.loc[:, data_frame.notna().any().to_numpy()]
+        if not data_frame.index.is_monotonic_increasing:
+            data_frame = data_frame.sort_index(kind='stable')
+        return data_frame
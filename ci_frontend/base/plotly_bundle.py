@@ -0,0 +1,36 @@
+# This file will define the local copy of the plotly.js bundle served to the browsers
+import gzip
+import threading
+import plotly
+from plotly.offline import get_plotlyjs
+
+
+class PlotlyBundle:
+    """
+    plotly.js as shipped inside the installed plotly python package, read and gzipped once per
+    process as the bundle is a few MB
+    """
+
+    def __init__(self):
+        self.version: str = plotly.__version__
+        self._source: bytes = None
+        self._gzipped: bytes = None
+        self._lock = threading.Lock()
+
+    def source(self) -> bytes:
+        if self._source is None:
+            with self._lock:
+                if self._source is None:
+                    self._source = get_plotlyjs().encode('utf-8')
+        return self._source
+
+    def gzipped(self) -> bytes:
+        if self._gzipped is None:
+            source = self.source()
+            with self._lock:
+                if self._gzipped is None:
+                    self._gzipped = gzip.compress(source, compresslevel=9)
+        return self._gzipped
+
+
+plotly_bundle = PlotlyBundle()
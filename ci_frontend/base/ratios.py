@@ -0,0 +1,122 @@
+# This file will define the derived financial metrics computed from the DivGenerator data frame
+import logging
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from .cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class FinancialRatios:
+    """
+    Derived metrics per company per fiscal year computed from the raw fields of the backend packet. Every
+    metric is a whole column NumPy/pandas operation, there is no per row Python
+    e.g
+        metrics = FinancialRatios(obj.data_frame).compute()
+        metrics['current_ratio'] -> assetscurrent / liabilitiescurrent per year
+    The metrics are
+     - current_ratio = assetscurrent / liabilitiescurrent
+     - <field>_yoy_growth, <field>_cagr (since the first year) and <field>_rolling_3y for the TREND_FIELDS
+    A metric whose inputs are missing from the packet is left out. The 10-k packets are balance sheets
+    without revenue or cost of revenue, so there is no DSO/DPO
+    """
+    ROLLING_YEARS = 3
+    # Totals which stay positive and whose trend means something, growth of e.g deferred taxes or other
+    # assets only adds noise to the list of fields
+    TREND_FIELDS = ('accountspayablecurrent',
+                    'accountsreceivablenetcurrent',
+                    'assets',
+                    'assetscurrent',
+                    'cashandcashequivalentsatcarryingvalue',
+                    'inventorynet',
+                    'liabilities',
+                    'liabilitiescurrent',
+                    'propertyplantandequipmentnet',
+                    'stockholdersequity')
+    GROWTH_SUFFIX = '_yoy_growth'
+    CAGR_SUFFIX = '_cagr'
+    ROLLING_SUFFIX = '_rolling_3y'
+
+    def __init__(self,
+                 data_frame: 'Pandas data frame',
+                 fields: list = None):
+        """
+        :param data_frame: DivGenerator.data_frame, one row per fiscal year
+        :type data_frame: Pandas data frame
+        :param fields: raw fields to derive growth/CAGR/rolling metrics for, TREND_FIELDS if None
+        :type fields: list
+        """
+        self.data_frame = data_frame
+        self.fields: list = list(fields) if fields is not None else list(self.TREND_FIELDS)
+
+    def _numeric_frame(self) -> tuple:
+        """
+        Numeric columns as float64 sorted by fiscal year, the backend sends the years as strings
+        :return: (numeric frame, sorted fiscal years as a float64 array)
+        :rtype: tuple
+        """
+        numeric = self.data_frame.select_dtypes(include='number').astype('float64')
+        years = pd.to_numeric(numeric.index, errors='coerce')
+        return numeric.iloc[np.argsort(years, kind='stable')], np.sort(years)
+
+    @staticmethod
+    def _divide(numerator: 'Pandas series or data frame',
+                denominator: 'Pandas series or data frame') -> 'Pandas series or data frame':
+        # x/0 gives inf which is of no use on a chart
+        return (numerator / denominator).replace([np.inf, -np.inf], np.nan)
+
+    def compute(self) -> 'Pandas data frame':
+        """
+        Computes all the metrics
+        :return: frame with one column per metric indexed like the input data frame
+        :rtype: Pandas data frame
+        """
+        numeric, years = self._numeric_frame()
+        metrics = dict()
+        if {'assetscurrent', 'liabilitiescurrent'}.issubset(numeric.columns):
+            metrics['current_ratio'] = self._divide(numeric['assetscurrent'],
+                                                    numeric['liabilitiescurrent'])
+        frames = [pd.DataFrame(metrics, index=numeric.index)]
+        trend = numeric[[field_name for field_name in self.fields if field_name in numeric.columns]]
+        if len(trend) and len(trend.columns):
+            # growth of every field over the previous fiscal year
+            growth = self._divide(trend.diff(), trend.shift().abs())
+            frames.append(growth.add_suffix(self.GROWTH_SUFFIX))
+            # compound annual growth since the first year of the packet, whole frame at once. Only defined
+            # between 2 positive values
+            values = trend.values
+            elapsed = years - years[0]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cagr = np.power(values / values[0], 1.0 / elapsed[:, None]) - 1.0
+            cagr[(elapsed[:, None] == 0) | ~(values > 0) | ~(values[0] > 0)] = np.nan
+            frames.append(pd.DataFrame(cagr,
+                                       index=trend.index,
+                                       columns=trend.columns).add_suffix(self.CAGR_SUFFIX))
+            rolling = trend.rolling(self.ROLLING_YEARS, min_periods=self.ROLLING_YEARS).mean()
+            frames.append(rolling.add_suffix(self.ROLLING_SUFFIX))
+        return pd.concat(frames, axis=1).reindex(self.data_frame.index)
+
+
+class RatioCache:
+    """
+    Memoizes the metrics per packet digest (see DivGenerator.packet_digest), the same packet always
+    gives the same metrics so they are computed once per process
+    """
+
+    def __init__(self,
+                 max_entries: int):
+        self.lru = LRUCache(max_entries=max_entries)
+
+    def get_or_compute(self,
+                       digest: str,
+                       data_frame: 'Pandas data frame',
+                       fields: list = None) -> 'Pandas data frame':
+        metrics = self.lru.get(digest)
+        if metrics is None:
+            metrics = FinancialRatios(data_frame, fields).compute()
+            self.lru.set(digest, metrics)
+        return metrics
+
+
+ratio_cache = RatioCache(max_entries=getattr(settings, 'CI_RATIO_CACHE_ENTRIES', 512))
@@ -0,0 +1,401 @@
+# This file will define the cross company screener over every CommonStock held in the local frame store
+import logging
+import operator
+import re
+import threading
+import time
+import numpy as np
+from django.conf import settings
+from .frame_store import frame_store
+from .models import CommonStock
+from .services import DivGenerator
+
+logger = logging.getLogger(__name__)
+
+# <field>[.<transform>] <op> <number>[%] [for <n> years]
+# e.g accountsreceivablenetcurrent.yoy > 10% for 5 years
+CONDITION_PATTERN = re.compile(r'^\s*(?P<field>[a-z0-9_-]+)(?:\.(?P<transform>[a-z]+))?\s*'
+                               r'(?P<op>>=|<=|==|=|>|<)\s*'
+                               r'(?P<value>-?\d+(?:\.\d+)?)(?P<percent>%?)'
+                               r'(?:\s+for\s+(?P<years>\d+)(?:\s*y(?:ears?)?)?)?\s*$',
+                               re.IGNORECASE)
+OPERATORS = {'>': operator.gt,
+             '>=': operator.ge,
+             '<': operator.lt,
+             '<=': operator.le,
+             '=': operator.eq,
+             '==': operator.eq}
+TRANSFORMS = ('value', 'yoy')
+
+
+class Condition:
+    """
+    One filter of a screen, true for a company when the metric passes the test in each of the years
+    consecutive fiscal years ending with its latest year with data, a missing year breaks the streak
+    e.g
+        Condition.parse('accountsreceivablenetcurrent.yoy > 10% for 5 years')
+    """
+
+    def __init__(self,
+                 field: str,
+                 transform: str,
+                 op: str,
+                 value: float,
+                 years: int = 1):
+        """
+        :param field: column of the data frames e.g 'assets'
+        :type field: str
+        :param transform: 'value' for the field itself, 'yoy' for its growth over the previous fiscal year
+        :type transform: str
+        :param op: one of OPERATORS
+        :type op: str
+        :param value: threshold, a growth of 10% is 0.1
+        :type value: float
+        :param years: number of latest consecutive fiscal years the test must pass in
+        :type years: int
+        """
+        self.field: str = field
+        self.transform: str = transform
+        self.op: str = op
+        self.value: float = value
+        self.years: int = years
+
+    @classmethod
+    def parse(cls, text: str) -> 'Condition':
+        """
+        :exception: ValueError if the text is not a condition
+        :rtype: Condition
+        """
+        match = CONDITION_PATTERN.match(text)
+        if match is None:
+            raise ValueError(f"bad condition {text!r}, expected e.g 'assets.yoy > 10% for 3 years'")
+        transform = (match['transform'] or 'value').lower()
+        if transform not in TRANSFORMS:
+            raise ValueError(f"unknown transform {transform!r}, one of {', '.join(TRANSFORMS)}")
+        years = int(match['years'] or 1)
+        if years < 1:
+            raise ValueError("a condition needs at least 1 year")
+        value = float(match['value']) / (100 if match['percent'] else 1)
+        return cls(match['field'].lower(), transform, match['op'], value, years)
+
+    @property
+    def metric(self) -> str:
+        return self.field if self.transform == 'value' else f'{self.field}.{self.transform}'
+
+    def __repr__(self):
+        return f'{self.metric} {self.op} {self.value:g} for {self.years} years'
+
+
+class Panel:
+    """
+    Read only symbol x fiscal year x field float64 array of the whole universe, NaN where a company has no
+    data. Queries share it without locking, a refresh builds a new panel and swaps it in
+    """
+
+    def __init__(self,
+                 symbols: list,
+                 names: list,
+                 sectors: list,
+                 years: 'numpy array',
+                 fields: list,
+                 values: 'numpy array',
+                 stamps: dict):
+        """
+        :param symbols: lower case ticker symbols, one per row of values
+        :type symbols: list
+        :param names: company names in the order of symbols
+        :type names: list
+        :param sectors: sectors in the order of symbols
+        :type sectors: list
+        :param years: every fiscal year from the oldest to the latest, the 2nd axis of values
+        :type years: numpy array
+        :param fields: field names, the 3rd axis of values
+        :type fields: list
+        :param values: symbols x years x fields
+        :type values: numpy array
+        :param stamps: frame store stamp of every symbol loaded, None for the ones not in the store
+        :type stamps: dict
+        """
+        self.symbols: list = symbols
+        self.names: list = names
+        self.sectors: list = sectors
+        self.sector_keys: 'numpy array' = np.array([CommonStock.normalize_text(sector) for sector in sectors],
+                                                   dtype=object)
+        self.years: 'numpy array' = years
+        self.fields: list = fields
+        self.values: 'numpy array' = values
+        self.stamps: dict = stamps
+        self.symbol_rows: dict = {symbol: row for row, symbol in enumerate(symbols)}
+        self.year_positions: dict = {year: position for position, year in enumerate(years.tolist())}
+        self.field_positions: dict = {field: position for position, field in enumerate(fields)}
+        self.built_at: float = time.time()
+
+    def fill(self,
+             values: 'numpy array',
+             security_name: str,
+             frame: 'Pandas data frame'):
+        """
+        Writes the data frame of a company into its row of values, which has the axes of this panel
+        """
+        row = values[self.symbol_rows[security_name]]
+        row[:] = np.nan
+        row[np.ix_([self.year_positions[int(year)] for year in frame.index],
+                   [self.field_positions[field] for field in frame.columns])] = frame.to_numpy()
+
+    def covers(self, frame: 'Pandas data frame') -> bool:
+        return (all(field in self.field_positions for field in frame.columns) and
+                all(int(year) in self.year_positions for year in frame.index))
+
+    @property
+    def loaded(self) -> int:
+        # companies with at least one value, the others are not in the frame store or not yearly
+        return int((~np.isnan(self.values)).any(axis=(1, 2)).sum())
+
+    def metric(self,
+               field: str,
+               transform: str) -> 'numpy array':
+        """
+        :exception: ValueError if no company has the field
+        :return: symbols x years values of the metric
+        :rtype: numpy array
+        """
+        if field not in self.field_positions:
+            raise ValueError(f"unknown field {field!r}")
+        matrix = self.values[:, :, self.field_positions[field]]
+        if transform == 'yoy':
+            growth = np.full_like(matrix, np.nan)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                # a missing year leaves NaN for itself and the year after, evaluate() then breaks the streak
+                growth[:, 1:] = (matrix[:, 1:] - matrix[:, :-1]) / np.abs(matrix[:, :-1])
+            growth[~np.isfinite(growth)] = np.nan
+            return growth
+        return matrix
+
+    @staticmethod
+    def latest(matrix: 'numpy array') -> tuple:
+        """
+        :return: (last value with data, its position on the year axis) per symbol, NaN/-1 if none
+        :rtype: tuple
+        """
+        valid = ~np.isnan(matrix)
+        positions = matrix.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+        positions[~valid.any(axis=1)] = -1
+        return matrix[np.arange(len(matrix)), positions], positions
+
+    def evaluate(self, condition: Condition) -> 'numpy array':
+        """
+        :return: boolean mask of the symbols passing the condition
+        :rtype: numpy array
+        """
+        matrix = self.metric(condition.field, condition.transform)
+        _, latest = self.latest(matrix)
+        # the years consecutive positions of the year axis (one per fiscal year) ending at the latest
+        # year with data of each company, every one of them must have a value that passes
+        positions = np.arange(matrix.shape[1])
+        window = (positions <= latest[:, None]) & (positions > latest[:, None] - condition.years)
+        with np.errstate(invalid='ignore'):
+            passed = OPERATORS[condition.op](matrix, condition.value)
+        return (latest >= condition.years - 1) & (passed | ~window).all(axis=1)
+
+
+class Screener:
+    """
+    Screens every CommonStock of a form type on conditions over its fiscal years, e.g all the Information
+    Technology companies whose receivables grew more than 10% a year for 5 years
+        screener.screen(['accountsreceivablenetcurrent.yoy > 10% for 5 years'],
+                        sector='Information Technology',
+                        sort='-accountsreceivablenetcurrent.yoy')
+    The data comes from the local frame store only (filled by the reports and the cache warmer), the
+    companies never reported on or warmed are not screened and the backend is never called, the response
+    tells how many were left out. Yearly frames only, a packet keyed by quarter is left out too. It is kept
+    in memory as one Panel per form type, each condition is a handful of vectorized NumPy operations on a
+    symbols x years matrix. Every refresh_seconds the panel is compared with the store: only the companies
+    whose snapshot changed are read again, and the panel is rebuilt only when new years or fields show up
+    """
+
+    def __init__(self,
+                 refresh_seconds: float = 60.0,
+                 limit: int = 50):
+        """
+        :param refresh_seconds: min seconds between 2 checks of the frame store
+        :type refresh_seconds: float
+        :param limit: default max number of companies returned
+        :type limit: int
+        """
+        self.refresh_seconds: float = refresh_seconds
+        self.limit: int = limit
+        self._panels: dict = dict()
+        self._checked_at: dict = dict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> 'Screener':
+        config = getattr(settings, 'CI_SCREENER', dict())
+        return cls(refresh_seconds=config.get('REFRESH_SECONDS', 60.0),
+                   limit=config.get('LIMIT', 50))
+
+    @staticmethod
+    def _universe(form_type: str) -> list:
+        return list(CommonStock.objects.filter(form_type=form_type)
+                    .order_by('symbol_key')
+                    .values_list('symbol_key', 'Name', 'Sector'))
+
+    @staticmethod
+    def _frames(form_type: str,
+                security_names: list) -> dict:
+        """
+        Numeric fiscal years x fields data frames of the securities in the frame store
+        :rtype: dict
+        """
+        frames = dict()
+        for security_name, snapshot in frame_store.load_many(form_type, security_names).items():
+            data_frame = snapshot.data_frame
+            if data_frame.index.dtype.kind not in 'iu':
+                # e.g a quarterly packet keyed by '2019-Q3', the screen runs on fiscal years
+                logger.debug("Screener skips %s %s, not indexed by fiscal year", form_type, security_name)
+                continue
+            frames[security_name] = data_frame.drop(columns=list(DivGenerator.NON_CHARTABLE_FIELDS),
+                                                    errors='ignore')
+        return frames
+
+    def _build(self,
+               universe: list,
+               frames: dict,
+               stamps: dict) -> Panel:
+        known_years = {int(year) for frame in frames.values() for year in frame.index}
+        # one position per fiscal year even if no company has it, so a gap is a gap for every company
+        years = (np.arange(min(known_years), max(known_years) + 1, dtype=np.int64) if known_years
+                 else np.array([], dtype=np.int64))
+        fields = sorted({field for frame in frames.values() for field in frame.columns})
+        panel = Panel(symbols=[security_name for security_name, _, _ in universe],
+                      names=[name for _, name, _ in universe],
+                      sectors=[sector for _, _, sector in universe],
+                      years=years,
+                      fields=fields,
+                      values=np.full((len(universe), len(years), len(fields)), np.nan),
+                      stamps=stamps)
+        for security_name, frame in frames.items():
+            panel.fill(panel.values, security_name, frame)
+        return panel
+
+    def refresh(self, form_type: str) -> Panel:
+        """
+        Brings the panel of the form type in line with the frame store
+        :rtype: Panel
+        """
+        universe = self._universe(form_type)
+        stamps = {security_name: frame_store.stamp(form_type, security_name)
+                  for security_name, _, _ in universe}
+        panel = self._panels.get(form_type)
+        if panel is not None and [security_name for security_name, _, _ in universe] == panel.symbols:
+            changed = [security_name for security_name, stamp in stamps.items()
+                       if stamp != panel.stamps.get(security_name)]
+            if not changed:
+                return panel
+            frames = self._frames(form_type, changed)
+            if all(panel.covers(frame) for frame in frames.values()):
+                # same axes, the changed companies are written into a copy so running queries are not affected
+                values = panel.values.copy()
+                for security_name in changed:
+                    # removed from the store or no longer yearly
+                    values[panel.symbol_rows[security_name]] = np.nan
+                for security_name, frame in frames.items():
+                    panel.fill(values, security_name, frame)
+                logger.info("Screener panel %s refreshed %s companies", form_type, len(frames))
+                return Panel(panel.symbols, panel.names, panel.sectors, panel.years, panel.fields, values, stamps)
+        start = time.monotonic()
+        frames = self._frames(form_type, list(stamps))
+        panel = self._build(universe, frames, stamps)
+        logger.info("Screener panel %s built in %.3fs, %s of %s companies in the frame store",
+                    form_type, time.monotonic() - start, panel.loaded, len(universe))
+        return panel
+
+    def panel(self, form_type: str) -> Panel:
+        """
+        Panel of the form type, refreshed first if it was checked over refresh_seconds ago. Only one thread
+        refreshes, the others keep using the current panel meanwhile
+        :rtype: Panel
+        """
+        panel = self._panels.get(form_type)
+        due = time.monotonic() - self._checked_at.get(form_type, float('-inf')) >= self.refresh_seconds
+        if due and self._lock.acquire(blocking=panel is None):
+            try:
+                self._panels[form_type] = self.refresh(form_type)
+                self._checked_at[form_type] = time.monotonic()
+            finally:
+                self._lock.release()
+        return self._panels.get(form_type, panel)
+
+    def screen(self,
+               conditions: list,
+               form_type: str = '10-k',
+               sector: str = None,
+               sort: str = None,
+               limit: int = None) -> dict:
+        """
+        :param conditions: condition strings, all of them must pass, see Condition.parse
+        :type conditions: list
+        :param form_type: SEC form type like e.g '10-k'
+        :type form_type: str
+        :param sector: only the companies of this sector (case insensitive), None for all
+        :type sector: str
+        :param sort: metric to rank on e.g 'assets' or '-assets.yoy' for descending, first condition
+                     descending if None
+        :type sort: str
+        :param limit: max number of companies returned, self.limit if None
+        :type limit: int
+        :exception: ValueError for a bad condition, sort or an unknown field
+        :return: {'count': companies passing, 'universe': companies of the form type, 'loaded': companies
+                  with data in the frame store, 'not_loaded': companies left out as they have none, 'note',
+                  'results': [{'symbol', 'name', 'sector', 'year', 'metrics'}]} best first
+        :rtype: dict
+        """
+        if frame_store is None:
+            raise ValueError("the screener needs the frame store, CI_FRAME_STORE['ROOT'] is not set")
+        conditions = [Condition.parse(condition) for condition in conditions]
+        if sort is None:
+            sort = '-' + conditions[0].metric if conditions else None
+        ranking = None
+        if sort:
+            descending = sort.startswith('-')
+            field, _, transform = sort.lstrip('-').lower().partition('.')
+            ranking = Condition(field, transform or 'value', '>', 0.0)
+            if ranking.transform not in TRANSFORMS:
+                raise ValueError(f"unknown transform {ranking.transform!r}, one of {', '.join(TRANSFORMS)}")
+        panel = self.panel(form_type)
+        mask = np.ones(len(panel.symbols), dtype=bool)
+        if sector:
+            mask &= panel.sector_keys == CommonStock.normalize_text(sector)
+        for condition in conditions:
+            mask &= panel.evaluate(condition)
+        rows = np.flatnonzero(mask)
+        if ranking is not None:
+            keys, _ = Panel.latest(panel.metric(ranking.field, ranking.transform))
+            keys = keys[rows]
+            # NaN last whatever the direction, ties stay in symbol order
+            order = np.lexsort((-keys if descending else keys, np.isnan(keys)))
+            rows = rows[order]
+        rows = rows[:limit or self.limit]
+        metrics = {condition.metric: Panel.latest(panel.metric(condition.field, condition.transform))
+                   for condition in conditions + ([ranking] if ranking is not None else [])}
+        results = []
+        for row in rows:
+            latest = max((positions[row] for _, positions in metrics.values()), default=-1)
+            results.append({'symbol': panel.symbols[row],
+                            'name': panel.names[row],
+                            'sector': panel.sectors[row],
+                            'year': int(panel.years[latest]) if latest >= 0 else None,
+                            'metrics': {metric: (None if np.isnan(values[row]) else float(values[row]))
+                                        for metric, (values, _) in metrics.items()}})
+        loaded = panel.loaded
+        return {'count': int(mask.sum()),
+                'universe': len(panel.symbols),
+                'loaded': loaded,
+                'not_loaded': len(panel.symbols) - loaded,
+                'note': ("only the companies with data in the frame store are screened, the reports and the "
+                         "cache warmer fill it" if loaded < len(panel.symbols) else None),
+                'conditions': [repr(condition) for condition in conditions],
+                'results': results}
+
+
+screener = Screener.from_settings()
@@ -0,0 +1,269 @@
+# This file will define the in-memory search index used by the type-ahead search box
+import bisect
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from django.conf import settings
+from django.db import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+# Attribute names mirror the CommonStock model so templates can use either one
+SearchHit = namedtuple('SearchHit', ['symbol', 'Name', 'Sector', 'form_type'])
+
+
+class CommonStockSearchIndex:
+    """
+    Process local search index over the CommonStock rows so the AJAX type-ahead path never has to
+    run a LIKE '%q%' scan on the DB. Symbol and Name are case-folded and kept in sorted lists for
+    prefix lookups (bisect) and in a trigram posting list for substring lookups. Results are ranked
+    e.g
+        search_index.search('app') -> [SearchHit(symbol='APA', ...), SearchHit(symbol='AAPL', ...)]
+    The ranking is
+     1. exact symbol match
+     2. symbol prefix match
+     3. name prefix match
+     4. symbol or name substring match, for queries of at least NGRAM_SIZE characters
+    """
+    NGRAM_SIZE = 3
+    # Highest code point, used as the upper bound of a prefix range in the sorted lists
+    PREFIX_UPPER_BOUND = '\U0010ffff'
+
+    def __init__(self,
+                 max_results: int = None,
+                 stamp_file: str = None,
+                 stamp_check_seconds: float = None):
+        """
+        :param max_results: cap on the number of hits returned for a query
+        :type max_results: int
+        :param stamp_file: path of the file touched whenever the CommonStock table is reloaded, it is
+                           shared by all the worker processes
+        :type stamp_file: str
+        :param stamp_check_seconds: minimum time between 2 checks of the stamp file
+        :type stamp_check_seconds: float
+        """
+        self.max_results: int = max_results
+        self.stamp_file: str = stamp_file
+        self.stamp_check_seconds: float = stamp_check_seconds
+        self._lock = threading.Lock()
+        self._built: bool = False
+        self._built_from_stamp: float = 0.0
+        self._next_stamp_check: float = 0.0
+        self._reset()
+
+    def _reset(self):
+        self._rows: list = []
+        self._digest: str = ''
+        self._exact_symbols: dict = dict()
+        self._sorted_symbols: list = []
+        self._sorted_names: list = []
+        self._symbol_keys: list = []
+        self._name_keys: list = []
+        self._ngrams: dict = dict()
+
+    def _settings_value(self, attr: str, name: str, default):
+        value = getattr(self, attr)
+        return value if value is not None else getattr(settings, name, default)
+
+    @property
+    def limit(self) -> int:
+        return self._settings_value('max_results', 'CI_SEARCH_RESULT_LIMIT', 10)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """
+        Case fold and strip the text so 'AAPL ', 'aapl' and 'Aapl' are all the same key
+        :rtype: str
+        """
+        return (text or '').strip().casefold()
+
+    def _ngrams_of(self, text: str) -> set:
+        return {text[i:i + self.NGRAM_SIZE] for i in range(len(text) - self.NGRAM_SIZE + 1)}
+
+    def build(self,
+              rows: 'iterable of (symbol, Name, Sector, form_type)'):
+        """
+        Builds all the lookup structures from scratch and swaps them in under the lock, readers
+        will either see the old index or the new one never a half built one
+        :param rows: tuples of (symbol, Name, Sector, form_type)
+        :type rows: iterable
+        :return: None
+        :rtype: None
+        """
+        hits = sorted((SearchHit(*row) for row in rows),
+                      key=lambda hit: self.normalize(hit.symbol))
+        exact_symbols = dict()
+        symbol_keys = []
+        name_keys = []
+        ngrams = dict()
+        for row_id, hit in enumerate(hits):
+            symbol_key = self.normalize(hit.symbol)
+            name_key = self.normalize(hit.Name)
+            symbol_keys.append(symbol_key)
+            name_keys.append(name_key)
+            exact_symbols.setdefault(symbol_key, []).append(row_id)
+            # Index both fields separately so a trigram never spans the symbol/name boundary
+            for gram in self._ngrams_of(symbol_key) | self._ngrams_of(name_key):
+                ngrams.setdefault(gram, []).append(row_id)
+        # same companies give the same digest in every worker process, used as the HTTP validator
+        digest = hashlib.blake2b(repr(hits).encode('utf-8'), digest_size=8).hexdigest()
+        with self._lock:
+            self._rows = hits
+            self._digest = digest
+            self._exact_symbols = exact_symbols
+            self._symbol_keys = symbol_keys
+            self._name_keys = name_keys
+            self._sorted_symbols = sorted(zip(symbol_keys, range(len(hits))))
+            self._sorted_names = sorted(zip(name_keys, range(len(hits))))
+            self._ngrams = {gram: frozenset(ids) for gram, ids in ngrams.items()}
+            self._built = True
+        logger.info("Search index built with %s companies", len(hits))
+
+    def rebuild(self):
+        """
+        Reads all the companies from the CommonStock table and rebuilds the index
+        :return: None
+        :rtype: None
+        """
+        # Import here as the models can not be imported before the app registry is ready
+        from .models import CommonStock
+        stamp = self._read_stamp()
+        self.build(CommonStock.objects.values_list('symbol', 'Name', 'Sector', 'form_type'))
+        self._built_from_stamp = stamp
+
+    def warm(self):
+        """
+        Builds the index at process start up so the first key press does not pay for it. A
+        missing table (e.g before the first migrate) is logged and the index will be built lazily
+        :return: None
+        :rtype: None
+        """
+        try:
+            self.rebuild()
+        except DatabaseError as de:
+            logger.warning("Unable to build the search index at start up: %s", de)
+
+    def _stamp_path(self) -> str:
+        return self._settings_value('stamp_file', 'CI_SEARCH_INDEX_STAMP_FILE', None)
+
+    def _read_stamp(self) -> float:
+        stamp_path = self._stamp_path()
+        if not stamp_path:
+            return 0.0
+        try:
+            return os.stat(stamp_path).st_mtime
+        except OSError:
+            return 0.0
+
+    def mark_stale(self):
+        """
+        Called whenever the CommonStock table changes. Touches the shared stamp file so every
+        worker process rebuilds its own index on the next search, and drops this process's index
+        :return: None
+        :rtype: None
+        """
+        stamp_path = self._stamp_path()
+        if stamp_path:
+            try:
+                with open(stamp_path, 'a'):
+                    os.utime(stamp_path, None)
+            except OSError as oe:
+                logger.warning("Unable to touch the search index stamp %s: %s", stamp_path, oe)
+        with self._lock:
+            self._built = False
+
+    def ensure_fresh(self):
+        """
+        Rebuilds the index if it was never built or the stamp file says the table was reloaded.
+        The stamp file is checked at most once every stamp_check_seconds so this stays cheap
+        :return: None
+        :rtype: None
+        """
+        now = time.monotonic()
+        if self._built and now < self._next_stamp_check:
+            return
+        self._next_stamp_check = now + self._settings_value('stamp_check_seconds',
+                                                            'CI_SEARCH_INDEX_STAMP_CHECK_SECONDS',
+                                                            1.0)
+        if not self._built or self._read_stamp() > self._built_from_stamp:
+            self.rebuild()
+
+    @property
+    def digest(self) -> str:
+        """
+        Content hash of the indexed companies, changes whenever the CommonStock table does
+        :rtype: str
+        """
+        self.ensure_fresh()
+        return self._digest
+
+    def _prefix_range(self,
+                      sorted_keys: list,
+                      query: str) -> 'iterator of row ids':
+        start = bisect.bisect_left(sorted_keys, (query,))
+        end = bisect.bisect_left(sorted_keys, (query + self.PREFIX_UPPER_BOUND,))
+        return (row_id for _, row_id in sorted_keys[start:end])
+
+    def _substring_candidates(self, query: str) -> 'iterable of row ids':
+        if len(query) < self.NGRAM_SIZE:
+            # Too short for a trigram, answered from the bisect prefix ranges only instead of
+            # scanning every row
+            return ()
+        postings = []
+        for gram in self._ngrams_of(query):
+            posting = self._ngrams.get(gram)
+            if not posting:
+                return ()
+            postings.append(posting)
+        postings.sort(key=len)
+        return sorted(frozenset.intersection(*postings))
+
+    def search(self,
+               query: str,
+               limit: int = None) -> list:
+        """
+        Returns the ranked hits for the query typed by the user, capped to the result limit
+        :param query: text typed by the user, symbol or company name
+        :type query: str
+        :param limit: overrides the default cap on results
+        :type limit: int
+        :return: list of SearchHit
+        :rtype: list
+        """
+        query = self.normalize(query)
+        if not query:
+            return []
+        self.ensure_fresh()
+        limit = limit or self.limit
+        # Take a consistent snapshot of the index, build() swaps all of these together
+        with self._lock:
+            rows = self._rows
+            exact_symbols = self._exact_symbols
+            sorted_symbols = self._sorted_symbols
+            sorted_names = self._sorted_names
+            symbol_keys = self._symbol_keys
+            name_keys = self._name_keys
+            substring_candidates = self._substring_candidates(query)
+        seen = set()
+        found = []
+        tiers = (exact_symbols.get(query, ()),
+                 self._prefix_range(sorted_symbols, query),
+                 self._prefix_range(sorted_names, query),
+                 (row_id for row_id in substring_candidates
+                  if query in symbol_keys[row_id] or query in name_keys[row_id]))
+        for tier in tiers:
+            for row_id in tier:
+                if row_id in seen:
+                    continue
+                seen.add(row_id)
+                found.append(rows[row_id])
+                if len(found) >= limit:
+                    return found
+        return found
+
+
+# One index per process, shared by all the request threads
+search_index = CommonStockSearchIndex()
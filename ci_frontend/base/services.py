@@ -1,16 +1,74 @@
 # This file will define the utlity functions for base app
-import requests
+import asyncio
 import pandas as pd
-from retrying import retry
-from requests import HTTPError, Timeout, ConnectionError, URLRequired
-from plotly.offline import plot
-from plotly.graph_objs import Scatter
-from plotly import graph_objs as go
+from asgiref.sync import sync_to_async
 import logging
+from django.conf import settings
+from .backend import backend_client
+from .chart_render import ChartRenderPool
+from .downsample import (downsample,
+                         window_years,
+                         )
+from .figure_spec import scatter_spec
+from .frame_store import frame_store
+from .instrumentation import timed
+from .packet_schema import PacketSchema
+from .ratios import ratio_cache
+from .single_flight import single_flight
+from .cache import (packet_cache,
+                    chart_cache,
+                    CacheEntry,
+                    ChartCache,
+                    )
 
 logger = logging.getLogger(__name__)
 
-CI_BACKEND_REST_API_END_POINT = 'http://127.0.0.1:5000/security/'
+# Renders the chart <div>s in worker processes when CI_CHART_RENDER['PROCESSES'] is set, inline otherwise
+chart_render_pool = ChartRenderPool.from_settings()
+# Typed packet -> data frame conversion, CI_PACKET_SCHEMA['FIELDS'] limits the fields converted
+packet_schema = PacketSchema.from_settings()
+
+
+def load_packet(form_type: str,
+                security_name: str,
+                previous: CacheEntry = None) -> tuple:
+    """
+    Packet cache loader. With a cached packet the backend is asked conditionally with the stored
+    validators (ETag/Last-Modified) and, if it supports it, only for the years since the latest one we
+    have, the years received are merged into the cached packet
+    :param form_type: SEC form type like e.g '10-k'
+    :type form_type: str
+    :param security_name: ticker or listing symbol like 'aapl'
+    :type security_name: str
+    :param previous: cached entry of the packet if any, even an expired one
+    :type previous: CacheEntry
+    :return: (packet, validators), the cached packet itself if nothing changed, (None, None) if the
+             backend does not know the security
+    :rtype: tuple
+    """
+    validators = previous.validators if previous is not None else None
+    since_year = None
+    if previous is not None and previous.value:
+        try:
+            # the latest year is asked again as it may have been amended
+            since_year = max(int(year) for year in previous.value)
+        except ValueError:
+            since_year = None
+    response = backend_client.fetch_packet(form_type,
+                                           security_name,
+                                           validators=validators,
+                                           since_year=since_year)
+    if response.not_modified and previous is not None:
+        return previous.value, response.validators
+    if response.packet is None:
+        return None, None
+    if response.partial and previous is not None:
+        if not response.packet:
+            return previous.value, response.validators
+        merged = dict(previous.value)
+        merged.update(response.packet)
+        return merged, response.validators
+    return response.packet, response.validators
 
 
 class DivGenerator:
@@ -22,6 +80,8 @@ class DivGenerator:
                             'msft')
     """
     MIN_VALID_YEARS_PER_BACKEND_CALL = 10
+    # Sent with every year of the packet but not financial statistics
+    NON_CHARTABLE_FIELDS = ('filing-type', 'filing-year', 'ticker')
 
     def __init__(self,
                  form_type: str,
@@ -38,96 +98,240 @@ class DivGenerator:
         self.security_name: str = security_name
         self.packet: dict = dict()
         self.data_frame: 'DataFrame Pandas' = None
+        # fewer fiscal years than MIN_VALID_YEARS_PER_BACKEND_CALL, the report shows what there is
+        self.partial: bool = False
+        self._packet_digest: str = None
 
-    #@staticmethod
-    def retry_on_connection_exceptions(exception) -> bool:
+    def _fetch_packet_from_backend(self,
+                                   previous: CacheEntry = None) -> tuple:
         """
-        Takes in exception type from function to compare and retry if it meets the exception
-        type
-        :param exception: requests.Exception
-        :type exception: Exception
-        :return: True or False
-        :rtype: bool
+        This method will pull the data from backend the REST API server and then return
+        the value for further processing. Retries with backoff, the deadline and the circuit
+        breaker are handled by the pooled backend client, a packet we already have is only
+        revalidated or completed with the new years (see load_packet)
+        :param previous: cached entry of the packet if any
+        :type previous: CacheEntry
+        :return: (packet, validators), packet is None if the backend does not know the security
+        :rtype: tuple
         """
-        return isinstance(exception, (Timeout, ConnectionError, HTTPError))
+        return load_packet(self.form_type,
+                           self.security_name,
+                           previous)
 
-    @retry(retry_on_exception=retry_on_connection_exceptions,
-           wait_fixed=1000,
-           stop_max_attempt_number=5)
-    def _get_data_from_backend_service(self) -> dict:
+    def _get_data_from_backend_service(self):
         """
-        This method will pull the data from backend the REST API server and then return
-        the value for further processing. Includes error handling and retries for the
-        request
-        :rtype: dict
+        Gets the packet for this form type and security, the 10-k data changes at most once a year so the
+        packet is read through the packet cache and the backend is called only on a miss or an expired entry
+        :return: None
+        :rtype: None
         """
-        # for eg : 10-k form it will look like http://127.0.0.1:5000/security/10-k/msft/
-        final_url = CI_BACKEND_REST_API_END_POINT + self.form_type + '/' + self.security_name + '/'
-        # extract the JSON data and send it to the caller
-        try:
-            self.packet = requests.get(final_url,
-                                       timeout=1).json()
-        except URLRequired as ue:
-            logger.exception("URL %s is not valid err: ",
-                             final_url,
-                             ue)
-        except (Timeout, ConnectionError, HTTPError) as try_again:
-            # let retry decorator above take care of this
-            logger.exception("Unable to connect ", try_again)
-            raise try_again
+        with timed('fetch'):
+            self.packet = packet_cache.get_or_load((self.form_type, self.security_name),
+                                                   self._fetch_packet_from_backend)
 
     def _validate_incoming_data(self):
         """
         A very basic JSON/dict validator for the incoming packet from the backend. In
-        case of missing data or no data it will raise a value error stating the packet
-        is of no use. Caller needs to handle the exception
+        case of no data it will raise a value error stating the packet is of no use, with
+        fewer than MIN_VALID_YEARS_PER_BACKEND_CALL years the packet is flagged partial.
+        Caller needs to handle the exception
         :return: None
         :rtype:
         """
         # Add basic validation for the JSON/dict extracted
         # In case validation becomes large use this package
         # https://github.com/vaidik/incoming
-        if self.packet is None or len(self.packet) < self.MIN_VALID_YEARS_PER_BACKEND_CALL:
-            raise ValueError
+        if not self.packet:
+            raise ValueError(f"no data for {self.form_type} {self.security_name}")
+        self.partial = len(self.packet) < self.MIN_VALID_YEARS_PER_BACKEND_CALL
+        if self.partial:
+            logger.info("Only %s years for %s %s, reporting on them as partial data",
+                        len(self.packet), self.form_type, self.security_name)
 
     def _convert_data_to_data_frame(self) -> 'Pandas data frame':
         """
         This will take the Raw JSON data(dict form) and convert it into a pandas data frame, it will
-        one data frame generated from the JSON data for a single security type
+        one data frame generated from the JSON data for a single security type. The columns are typed
+        by the packet schema (float64 amounts, integer fiscal year index) instead of inferred
         :return: data_frame
         :rtype: Pndas data frame
         """
         # data validation is done before this function is called
-        self.data_frame = pd.DataFrame.from_dict(self.packet,
-                                                 orient='index')
+        with timed('dataframe'):
+            self.data_frame = packet_schema.to_data_frame(self.packet)
+
+    def _load_from_frame_store(self) -> bool:
+        """
+        Uses the memory mapped snapshot of the local frame store when it was checked against the backend
+        recently enough, the packet is then neither fetched nor parsed. A partial snapshot (fewer than
+        MIN_VALID_YEARS_PER_BACKEND_CALL years) is checked as often as a partial packet, the missing years
+        may come soon
+        :return: True if the data frame was loaded from the store
+        :rtype: bool
+        """
+        if frame_store is None:
+            return False
+        with timed('store'):
+            snapshot = frame_store.load(self.form_type, self.security_name)
+        if snapshot is None:
+            return False
+        partial = len(snapshot.data_frame) < self.MIN_VALID_YEARS_PER_BACKEND_CALL
+        max_age = frame_store.max_age
+        if partial and packet_cache.partial_ttl is not None:
+            max_age = min(max_age, packet_cache.partial_ttl)
+        if snapshot.age() > max_age:
+            return False
+        self.data_frame = snapshot.data_frame
+        self.partial = partial
+        return True
+
+    def _save_to_frame_store(self):
+        """
+        Appends the fiscal years the local frame store does not have yet, a failed write only costs the
+        next request a packet fetch
+        :return: None
+        :rtype: None
+        """
+        if frame_store is None:
+            return
+        try:
+            with timed('store'):
+                frame_store.update(self.form_type, self.security_name, self.data_frame)
+        except OSError as oe:
+            logger.warning("Unable to store the frame of %s %s: %s", self.form_type, self.security_name, oe)
+
+    def packet_digest(self) -> str:
+        """
+        Content hash of the data frame built from the packet, the same packet always gives the same digest
+        so it is used as the key of everything derived from the packet
+        :rtype: str
+        """
+        if self._packet_digest is None:
+            self._packet_digest = ChartCache.series_digest(self.data_frame)
+        return self._packet_digest
+
+    def _add_financial_ratios(self):
+        """
+        Adds the derived metrics (current ratio, growth, CAGR, rolling averages see
+        ratios.FinancialRatios) as extra columns of the data frame so they can be charted like any
+        other field. Memoized per packet digest
+        :return: None
+        :rtype: None
+        """
+        with timed('ratios'):
+            metrics = ratio_cache.get_or_compute(self.packet_digest(),
+                                                 self.data_frame)
+            self.data_frame = pd.concat([self.data_frame, metrics], axis=1)
 
     def get_data_generate_data_frame(self,
                                      form_type: str,
-                                     security_name: str):
+                                     security_name: str,
+                                     refresh: bool = False):
         """
         Completes the following sequence for each call
         1. Make a call to backend REST API server to get the form based data for a particular security
         2. Perform a basic validation for the incoming data packet
-        3. After verification push the packet into a Pandas data frame
+        3. After verification push the packet into a Pandas data frame and the local frame store
+        4. Add the derived financial metrics as extra columns
+        Steps 1 to 3 are skipped when the local frame store has a recent snapshot of the security, unless
+        refresh is set e.g by the cache warmer after it fetched the packet again.
+        Concurrent calls for the same security share one run of the sequence and its data frame.
+        A packet with only a few years is still reported on with self.partial set
         :param form_type: SEC form type like 10-k, 10-q and so on
         :type form_type: str
         :param security_name: Security name like 'aapl' for Apple computer
         :type security_name: str
+        :param refresh: build the data frame from the cached packet and write it to the frame store even
+                        when the stored snapshot is recent
+        :type refresh: bool
+        :exception :Throws a Value error which needs to be handled by caller when there is no data at all
+        :return: None
+        :rtype: None
+        """
+        key = ('frame', self.form_type, self.security_name) + (('refresh',) if refresh else ())
+        self.packet, self.data_frame, self.partial = single_flight.do(key,
+                                                                      lambda: self._build_data_frame(refresh))
+
+    def _build_data_frame(self,
+                          refresh: bool = False) -> tuple:
+        """
+        Steps of get_data_generate_data_frame
+        :return: (packet, data frame, partial) shared with the concurrent callers, all read only
+        :rtype: tuple
+        """
+        if refresh or not self._load_from_frame_store():
+            self._get_data_from_backend_service()
+            try:
+                self._validate_incoming_data()
+            except ValueError as ve:
+                logger.warning("Incoming packet bad, cannot continue to analyze it: %s",
+                               ve)
+                raise ve
+            self._convert_data_to_data_frame()
+            self._save_to_frame_store()
+        self._add_financial_ratios()
+        return self.packet, self.data_frame, self.partial
+
+    async def aget_data_generate_data_frame(self,
+                                            form_type: str,
+                                            security_name: str):
+        """
+        Async version of get_data_generate_data_frame for the async views served through asgi.py, the
+        blocking fetch and the pandas work run in the executor so many securities can be loaded concurrently
         :exception :Throws a Value error which needs to be handled by caller
         :return: None
         :rtype: None
         """
-        self._get_data_from_backend_service()
-        try:
-            self._validate_incoming_data()
-        except ValueError as ve:
-            logger.exception("Incoming packet bad, cannot continue to analyze it :",
-                             ve)
-            raise ve
-        self._convert_data_to_data_frame()
+        await sync_to_async(self.get_data_generate_data_frame,
+                            thread_sensitive=False)(form_type, security_name)
+
+    def available_fields(self) -> list:
+        """
+        Returns the name of every numeric column of the data frame which can be charted, the bookkeeping
+        columns sent by the backend (filing year, ticker ..) are left out
+        e.g ['accountspayablecurrent', 'accountsreceivablenetcurrent', 'assets', ...]
+        :return: field names sorted by name
+        :rtype: list
+        """
+        numeric_columns = self.data_frame.select_dtypes(include='number').columns
+        return sorted(set(numeric_columns) - set(self.NON_CHARTABLE_FIELDS))
+
+    def chart_series(self,
+                     field_name: str,
+                     start_year: int = None,
+                     end_year: int = None,
+                     max_points: int = None) -> 'Pandas series':
+        """
+        Values of the field as charted: limited to the years from start_year to end_year and downsampled
+        to max_points with the CI_CHART_DOWNSAMPLING method, so the chart payload and render time stay
+        bounded whatever the length of the history
+        e.g
+            obj.chart_series('assets', start_year=2000, max_points=100)
+        :param field_name: column of the data frame
+        :type field_name: str
+        :param start_year: first fiscal year charted, None for the oldest one
+        :type start_year: int
+        :param end_year: last fiscal year charted, None for the latest one
+        :type end_year: int
+        :param max_points: point budget, CI_CHART_DOWNSAMPLING['MAX_POINTS'] if None
+        :type max_points: int
+        :exception: ValueError if the field is not in the data frame
+        :return: series indexed by fiscal year
+        :rtype: Pandas series
+        """
+        if not {field_name}.issubset(self.data_frame.columns):
+            raise ValueError
+        config = getattr(settings, 'CI_CHART_DOWNSAMPLING', dict())
+        series = window_years(self.data_frame[field_name], start_year, end_year)
+        return downsample(series,
+                          max_points=max_points or config.get('MAX_POINTS'),
+                          method=config.get('METHOD', 'lttb'))
 
     def create_div_from_financial_paramter(self,
-                                           field_name: str) -> 'HTML <div> string':
+                                           field_name: str,
+                                           start_year: int = None,
+                                           end_year: int = None,
+                                           max_points: int = None) -> 'HTML <div> string':
         """
         Method return a HTML <div> for the field specified. This div string will be retunred to caller to be inserted
         into an HTML template. This div will be created from the data in the pandas data frame matching the column
@@ -135,40 +339,96 @@ class DivGenerator:
         e.g - field_name = "accountspayablecurrent"
         :param field_name: This is the field caller wants a graph div for
         :type field_name: str
+        :param start_year: first fiscal year charted, see chart_series
+        :type start_year: int
+        :param end_year: last fiscal year charted, see chart_series
+        :type end_year: int
+        :param max_points: point budget of the chart, see chart_series
+        :type max_points: int
         :return: HTML <div> string
         :rtype: str
         """
         # check to make sure the field_name exists in the data frame
-        if not {field_name}.issubset(self.data_frame.columns):
-            raise ValueError
+        series = self.chart_series(field_name, start_year, end_year, max_points)
+        # Same numbers for the same field means the same chart, skip the plotly serialization
+        cache_key = ChartCache.make_key(self.security_name,
+                                        self.form_type,
+                                        field_name,
+                                        series)
+        plot_div = chart_cache.get(cache_key)
+        if plot_div is not None:
+            return plot_div
+        # the same chart asked by concurrent requests is rendered once
+        return single_flight.do(('chart',) + cache_key,
+                                lambda: self._render_div(field_name, series, cache_key))
+
+    def _render_div(self,
+                    field_name: str,
+                    series: 'Pandas series',
+                    cache_key: tuple) -> 'HTML <div> string':
+        """
+        Renders the chart of create_div_from_financial_paramter and keeps it in the chart cache
+        :rtype: str
+        """
         # reduce CPU load by using logging this way where string is formed if needed
         logger.info("%s %s %s",
                     "Found ",
                     field_name,
                     " generating the <div>")
         try:
-            fig = go.Figure()
-            fig.add_trace(go.Scatter(x=self.data_frame.index,
-                                     y=self.data_frame[field_name],
-                                     name=field_name,
-                                     opacity=0.8,
-                                     line_color='deepskyblue'))
-            fig.layout.update(title_text=field_name,
-                              xaxis_rangeslider_visible=False)
-            plot_div = plot(fig,
-                            output_type='div',
-                            include_plotlyjs=False)
-            # plot_div = plot([Scatter(x=self.data_frame.index,
-            #                          y=self.data_frame[field_name],
-            #                          mode='lines',
-            #                          name=field_name,
-            #                          opacity=0.8,
-            #                          marker_color='green',
-            #                          line_color='deepskyblue')],
-            #                 output_type='div',
-            #                 include_plotlyjs=False)
-        except ValueError as ve:
-            logger.exception("Unable to create an HTML <div> for field: %s ",
-                             field_name, ve)
+            # only the 2 arrays go to the render worker, not the data frame
+            with timed('plot'):
+                plot_div = chart_render_pool.render(field_name,
+                                                    series.index.to_numpy(),
+                                                    series.to_numpy())
+        except ValueError:
+            logger.exception("Unable to create an HTML <div> for field: %s", field_name)
             return "oops statstic not found"
+        chart_cache.set(cache_key, plot_div)
         return plot_div
+
+    def create_spec_from_financial_paramter(self,
+                                            field_name: str,
+                                            start_year: int = None,
+                                            end_year: int = None,
+                                            max_points: int = None) -> dict:
+        """
+        Same chart as create_div_from_financial_paramter but returned as a compact figure spec with the
+        x/y values packed as base64 typed arrays, the browser draws it with plotly.js (figure-spec.js).
+        No plotly serialization is done on the server
+        e.g - field_name = "accountspayablecurrent"
+        :param field_name: This is the field caller wants a graph for
+        :type field_name: str
+        :param start_year: first fiscal year charted, see chart_series
+        :type start_year: int
+        :param end_year: last fiscal year charted, see chart_series
+        :type end_year: int
+        :param max_points: point budget of the chart, see chart_series
+        :type max_points: int
+        :return: {'data': [...], 'layout': {...}}
+        :rtype: dict
+        """
+        series = self.chart_series(field_name, start_year, end_year, max_points)
+        with timed('spec'):
+            return scatter_spec(series.index,
+                                pd.to_numeric(series, errors='coerce'),
+                                name=field_name,
+                                title=field_name)
+
+
+async def generate_data_frames_concurrently(generators: 'list of DivGenerator') -> list:
+    """
+    Loads the data frame of every DivGenerator concurrently, the wall time is close to the slowest single
+    fetch instead of the sum of all of them
+    e.g
+        results = await generate_data_frames_concurrently([DivGenerator('10-k', 'msft'),
+                                                           DivGenerator('10-k', 'aapl')])
+    :param generators: DivGenerator objects to load
+    :type generators: list
+    :return: None for every generator loaded fine or the exception it raised, in the same order
+    :rtype: list
+    """
+    return await asyncio.gather(*(generator.aget_data_generate_data_frame(generator.form_type,
+                                                                         generator.security_name)
+                                  for generator in generators),
+                                return_exceptions=True)
@@ -0,0 +1,151 @@
+# This file will define the request coalescing (single flight) of the expensive calls of the base app
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from .instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    """
+    One in flight call, the waiters block on done and then read result or error
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Exception = None
+
+
+class SingleFlight:
+    """
+    Makes sure only one call per key is running at a time, the threads asking for the same key while it
+    runs wait for it and all get its result (or its exception) instead of doing the same work again.
+    With across_processes the leader thread also takes an exclusive lock file per key, so the worker
+    processes of the host coalesce too: the function is then called once the lock is held and should first
+    look for the result another process may have stored meanwhile (e.g in the shared cache tier)
+    e.g
+        packet = single_flight.do(('packet', '10-k', 'msft'), load_function, across_processes=True)
+    Nothing is kept once the call is done, caching the result is the caller's job
+    """
+
+    def __init__(self,
+                 lock_dir: str = None,
+                 lock_timeout: float = 5.0,
+                 lock_poll: float = 0.01):
+        """
+        :param lock_dir: directory of the lock files, None coalesces within the process only
+        :type lock_dir: str
+        :param lock_timeout: max seconds to wait for another process, the call is made anyway after that
+        :type lock_timeout: float
+        :param lock_poll: seconds between 2 tries to take a busy lock file
+        :type lock_poll: float
+        """
+        self.lock_dir: str = str(lock_dir) if lock_dir else None
+        self.lock_timeout: float = lock_timeout
+        self.lock_poll: float = lock_poll
+        self._calls: dict = dict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> 'SingleFlight':
+        config = getattr(settings, 'CI_SINGLE_FLIGHT', dict())
+        return cls(lock_dir=config.get('LOCK_DIR'),
+                   lock_timeout=config.get('LOCK_TIMEOUT_SECONDS', 5.0))
+
+    def do(self,
+           key: tuple,
+           function: 'callable with no arguments',
+           across_processes: bool = False):
+        """
+        :param key: identifies the work e.g ('chart', 'msft', '10-k', 'assets', digest)
+        :type key: tuple
+        :param function: does the work, called by the first thread asking for the key
+        :type function: callable
+        :param across_processes: also wait for the other processes working on the key
+        :type across_processes: bool
+        :exception: whatever the function raised, in every waiting thread
+        :return: what the function returned
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            metrics.incr('ci_single_flight_coalesced_total', kind=str(key[0]))
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            if across_processes:
+                with self.process_lock(key):
+                    call.result = function()
+            else:
+                call.result = function()
+            return call.result
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    @contextmanager
+    def process_lock(self,
+                     key: tuple,
+                     timeout: float = None):
+        """
+        Exclusive lock file of the key shared by the processes of the host
+        e.g
+            with single_flight.process_lock(key, timeout=0) as acquired:
+                if acquired:
+                    ...
+        :param key: identifies the work
+        :type key: tuple
+        :param timeout: seconds to wait for the lock, lock_timeout if None, 0 to only try once
+        :type timeout: float
+        :return: context manager giving True if the lock is held, False on timeout or without a lock dir
+        """
+        if not self.lock_dir:
+            yield False
+            return
+        timeout = self.lock_timeout if timeout is None else timeout
+        digest = hashlib.blake2b(repr(key).encode('utf-8'), digest_size=12).hexdigest()
+        try:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            lock_file = open(os.path.join(self.lock_dir, digest + '.lock'), 'w')
+        except OSError as oe:
+            logger.warning("Unable to open the lock file of %s: %s", key, oe)
+            yield False
+            return
+        with lock_file:
+            give_up_at = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    acquired = True
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= give_up_at:
+                        acquired = False
+                        break
+                    time.sleep(self.lock_poll)
+            if not acquired and timeout:
+                logger.warning("Gave up waiting %.1fs for the lock of %s", timeout, key)
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+single_flight = SingleFlight.from_settings()
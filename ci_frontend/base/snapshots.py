@@ -0,0 +1,395 @@
+# This file will define the static report snapshots, rendered ahead of time and served as precompressed files
+import gzip
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+from collections import Counter
+from concurrent.futures import (ProcessPoolExecutor,
+                                as_completed,
+                                )
+import django
+from django.conf import settings
+from django.http import FileResponse
+from django.urls import reverse
+from django.utils.cache import (get_conditional_response,
+                                patch_cache_control,
+                                patch_vary_headers,
+                                )
+from django.utils.http import http_date
+from .backend import BackendUnavailable
+from .cache import (packet_cache,
+                    ChartCache,
+                    )
+from .models import CommonStock
+from .warmer import popularity
+
+try:
+    # optional, smaller than gzip and understood by every current browser
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Bump when the content or the layout of the snapshots changes, every snapshot is then rendered again
+SNAPSHOT_FORMAT = 1
+
+
+class SnapshotStore:
+    """
+    Static copies of the default report of every company, a plain, a gzip and (with the brotli package) a
+    brotli file of the page and of its charts as JSON, named after their content hash so a CDN or the
+    browsers can keep them for good
+        <root>/<form_type>/<security>/manifest.json
+        <root>/<form_type>/<security>/report-<hash>.html[.gz|.br]
+        <root>/<form_type>/<security>/charts-<hash>.json[.gz|.br]
+    The manifest is replaced atomically once the files are written. It holds the digest of the data the
+    snapshot was rendered from so an export only renders the reports whose data changed, and checked_at,
+    the last time that was verified: the report view and snapshot_charts_view serve the snapshot until
+    max_age after that. The snapshot of a company which no longer has data is deleted
+    e.g
+        snapshot_store.response(request, '10-k', 'msft') -> FileResponse or None if no fresh snapshot
+        snapshot_store.response(request, '10-k', 'msft', kind='charts')
+    """
+    MANIFEST_FILE = 'manifest.json'
+    # Content-Encoding and file suffix, best first
+    ENCODINGS = (('br', '.br'),
+                 ('gzip', '.gz'))
+    CONTENT_TYPES = {'report': 'text/html; charset=utf-8',
+                     'charts': 'application/json'}
+
+    def __init__(self,
+                 root: str,
+                 max_age: float = 24 * 60 * 60,
+                 processes: int = 4,
+                 cache_max_age: int = 5 * 60):
+        """
+        :param root: directory of the snapshots, created on first export
+        :type root: str
+        :param max_age: seconds a snapshot is served after its data was last checked
+        :type max_age: float
+        :param processes: worker processes of an export, 1 renders in the calling process
+        :type processes: int
+        :param cache_max_age: max-age sent to the browsers and the CDN with a served snapshot
+        :type cache_max_age: int
+        """
+        self.root: str = str(root)
+        self.max_age: float = max_age
+        self.processes: int = processes
+        self.cache_max_age: int = cache_max_age
+
+    @classmethod
+    def from_settings(cls) -> 'SnapshotStore or None':
+        config = getattr(settings, 'CI_SNAPSHOTS', dict())
+        if not config.get('ROOT'):
+            return None
+        return cls(root=config['ROOT'],
+                   max_age=config.get('MAX_AGE_SECONDS', 24 * 60 * 60),
+                   processes=config.get('PROCESSES', 4),
+                   cache_max_age=config.get('CACHE_MAX_AGE_SECONDS', 5 * 60))
+
+    def _path(self, form_type: str, security_name: str) -> str:
+        return os.path.join(self.root, form_type, security_name)
+
+    def manifest(self,
+                 form_type: str,
+                 security_name: str) -> 'dict or None':
+        try:
+            with open(os.path.join(self._path(form_type, security_name), self.MANIFEST_FILE)) as manifest_file:
+                return json.load(manifest_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_manifest(self, path: str, manifest: dict):
+        temp_path = os.path.join(path, self.MANIFEST_FILE + '.tmp')
+        with open(temp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(temp_path, os.path.join(path, self.MANIFEST_FILE))
+
+    @staticmethod
+    def _write_file(path: str, name: str, content: bytes):
+        if os.path.exists(os.path.join(path, name)):
+            # same name, same content
+            return
+        temp_path = os.path.join(path, name + '.tmp')
+        with open(temp_path, 'wb') as output_file:
+            output_file.write(content)
+        os.replace(temp_path, os.path.join(path, name))
+
+    def _write_variants(self,
+                        path: str,
+                        prefix: str,
+                        suffix: str,
+                        content: bytes) -> dict:
+        """
+        Writes the content and its compressed copies under a content hashed name
+        :return: {'file': name, 'hash': digest, 'encodings': [suffix of every compressed copy]}
+        :rtype: dict
+        """
+        digest = hashlib.blake2b(content, digest_size=10).hexdigest()
+        name = f'{prefix}-{digest}{suffix}'
+        self._write_file(path, name, content)
+        # mtime=0 so the same content always gives the same .gz
+        variants = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants['.br'] = brotli.compress(content, mode=brotli.MODE_TEXT)
+        for variant_suffix, compressed in variants.items():
+            self._write_file(path, name + variant_suffix, compressed)
+        return {'file': name,
+                'hash': digest,
+                'encodings': sorted(variants)}
+
+    def save(self,
+             form_type: str,
+             security_name: str,
+             source: str,
+             html: str,
+             charts: dict) -> dict:
+        """
+        Stores a new snapshot of the report and removes the files of the previous one
+        :param source: digest of the data the report was rendered from
+        :type source: str
+        :param html: report page
+        :type html: str
+        :param charts: plotly <div> per field
+        :type charts: dict
+        :return: the manifest
+        :rtype: dict
+        """
+        path = self._path(form_type, security_name)
+        os.makedirs(path, exist_ok=True)
+        now = time.time()
+        manifest = {'format': SNAPSHOT_FORMAT,
+                    'source': source,
+                    'built_at': now,
+                    'checked_at': now,
+                    'report': self._write_variants(path, 'report', '.html', html.encode('utf-8')),
+                    'charts': self._write_variants(path, 'charts', '.json',
+                                                   json.dumps({'form_type': form_type,
+                                                               'security': security_name,
+                                                               'charts': charts}).encode('utf-8'))}
+        self._write_manifest(path, manifest)
+        keep = {self.MANIFEST_FILE} | {variant['file'] + suffix
+                                       for variant in (manifest['report'], manifest['charts'])
+                                       for suffix in [''] + variant['encodings']}
+        for name in os.listdir(path):
+            if name not in keep and not name.endswith('.tmp'):
+                os.remove(os.path.join(path, name))
+        return manifest
+
+    def delete(self,
+               form_type: str,
+               security_name: str):
+        """
+        Removes the snapshot, e.g the company has no data anymore. A response already sending one of its
+        files finishes, a new one renders the report
+        """
+        path = self._path(form_type, security_name)
+        if os.path.isdir(path):
+            logger.info("Deleting the snapshot of %s %s", form_type, security_name)
+            shutil.rmtree(path, ignore_errors=True)
+
+    def mark_checked(self,
+                     form_type: str,
+                     security_name: str,
+                     manifest: dict):
+        """
+        The data did not change since the snapshot was rendered, it is served for another max_age
+        """
+        manifest['checked_at'] = time.time()
+        self._write_manifest(self._path(form_type, security_name), manifest)
+
+    def is_fresh(self, manifest: dict) -> bool:
+        return (manifest.get('format') == SNAPSHOT_FORMAT and
+                time.time() - manifest['checked_at'] < self.max_age)
+
+    @staticmethod
+    def accepted_encodings(header: str) -> set:
+        """
+        Content codings of an Accept-Encoding header the client takes, the ones with q=0 are refused
+        e.g
+            accepted_encodings('gzip;q=0, br') -> {'br'}
+        :rtype: set
+        """
+        accepted = set()
+        for part in header.split(','):
+            coding, *parameters = [item.strip() for item in part.split(';')]
+            quality = 1.0
+            for parameter in parameters:
+                name, _, value = parameter.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            if coding and quality > 0:
+                accepted.add(coding.lower())
+        return accepted
+
+    def response(self,
+                 request,
+                 form_type: str,
+                 security_name: str,
+                 kind: str = 'report') -> 'FileResponse or None':
+        """
+        A file of the snapshot in the best encoding the client accepts, or a 304 if it has it already
+        :param request: HTTP request
+        :type request: HttpRequest
+        :param kind: 'report' for the page, 'charts' for the JSON of its charts
+        :type kind: str
+        :return: response, None if there is no fresh snapshot
+        :rtype: FileResponse
+        """
+        manifest = self.manifest(form_type, security_name)
+        if manifest is None or not self.is_fresh(manifest):
+            return None
+        cached = packet_cache.peek((form_type, security_name))
+        if cached is not None and cached.value is None and time.time() < cached.fresh_until:
+            # the backend no longer knows the company, see PacketCache negative_ttl
+            self.delete(form_type, security_name)
+            return None
+        variant = manifest[kind]
+        etag = f'"{variant["hash"]}"'
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            patch_cache_control(not_modified, public=True, max_age=self.cache_max_age)
+            return not_modified
+        accepted = self.accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        encoding, suffix = next(((encoding, suffix) for encoding, suffix in self.ENCODINGS
+                                 if encoding in accepted and suffix in variant['encodings']),
+                                (None, ''))
+        try:
+            snapshot_file = open(os.path.join(self._path(form_type, security_name), variant['file'] + suffix), 'rb')
+        except FileNotFoundError:
+            # replaced by an export meanwhile, render it this time
+            return None
+        response = FileResponse(snapshot_file, content_type=self.CONTENT_TYPES[kind])
+        if encoding is not None:
+            response['Content-Encoding'] = encoding
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(manifest['built_at'])
+        patch_vary_headers(response, ('Accept-Encoding',))
+        patch_cache_control(response, public=True, max_age=self.cache_max_age)
+        return response
+
+
+snapshot_store = SnapshotStore.from_settings()
+
+
+def snapshot_securities(sector: str = None,
+                        limit: int = None) -> list:
+    """
+    :param sector: only the companies of this sector (case insensitive), None for all
+    :type sector: str
+    :param limit: only the limit most viewed companies, None for all
+    :type limit: int
+    :return: (form_type, security_name) of the companies to export
+    :rtype: list
+    """
+    object_list = CommonStock.objects.order_by('symbol_key')
+    if sector:
+        object_list = object_list.filter(Sector__iexact=sector)
+    securities = list(object_list.values_list('form_type', 'symbol_key'))
+    if limit:
+        scores = popularity.scores([security_name for _, security_name in securities])
+        securities = sorted(securities, key=lambda security: -scores.get(security[1], 0))[:limit]
+    return securities
+
+
+def export_security(form_type: str,
+                    security_name: str,
+                    force: bool = False) -> str:
+    """
+    Renders the default report of the company into a snapshot unless the data did not change since the
+    current one. Called in the export worker processes
+    :param form_type: SEC form type like e.g '10-k'
+    :type form_type: str
+    :param security_name: lower case ticker symbol like 'msft'
+    :type security_name: str
+    :param force: render even if the data did not change
+    :type force: bool
+    :exception: BackendUnavailable if the backend is down, the current snapshot is kept
+    :return: 'built', 'unchanged' or 'no data' (the snapshot is then deleted)
+    :rtype: str
+    """
+    # imported here, the views import this module to serve the snapshots and only the exports need a
+    # request built by hand
+    from django.test import RequestFactory
+    from .views import CommonStockSearchPageView
+    view = CommonStockSearchPageView()
+    view.setup(RequestFactory().get(reverse('companies'), {'q': security_name}))
+    ctx = {'output': " "}
+    report = view.report_context(ctx, security_name)
+    if report is None:
+        if ctx.get('unavailable'):
+            raise BackendUnavailable(ctx['error'])
+        snapshot_store.delete(form_type, security_name)
+        return 'no data'
+    obj, fields_selected = report
+    # the charted values only, the bookkeeping columns differ between a packet and the frame store
+    fields_available = ctx['fields_available']
+    source = hashlib.blake2b(repr((SNAPSHOT_FORMAT,
+                                   ChartCache.series_digest(obj.data_frame[fields_available]),
+                                   fields_available,
+                                   fields_selected,
+                                   obj.partial)).encode(),
+                             digest_size=16).hexdigest()
+    manifest = snapshot_store.manifest(form_type, security_name)
+    if (not force and manifest is not None and
+            manifest.get('format') == SNAPSHOT_FORMAT and manifest['source'] == source):
+        snapshot_store.mark_checked(form_type, security_name, manifest)
+        return 'unchanged'
+    html = view.render_static_report(ctx, obj, fields_selected)
+    # already in the chart cache, rendered for the page just above
+    charts = {field_name: obj.create_div_from_financial_paramter(field_name) for field_name in fields_selected}
+    snapshot_store.save(form_type, security_name, source, html, charts)
+    return 'built'
+
+
+def export_snapshots(securities: list,
+                     processes: int = None,
+                     force: bool = False) -> Counter:
+    """
+    Exports the snapshots of the companies, spread over worker processes so the plotly rendering of the
+    whole universe runs on every core. A company which fails is logged and counted, the others go on
+    e.g
+        export_snapshots(snapshot_securities(sector='Energy'), processes=8)
+    :param securities: (form_type, security_name) of the companies
+    :type securities: list
+    :param processes: worker processes, CI_SNAPSHOTS['PROCESSES'] if None
+    :type processes: int
+    :param force: render even the snapshots whose data did not change
+    :type force: bool
+    :return: number of companies per outcome ('built', 'unchanged', 'no data', 'failed')
+    :rtype: Counter
+    """
+    if snapshot_store is None:
+        raise ValueError("CI_SNAPSHOTS['ROOT'] is not set")
+    processes = snapshot_store.processes if processes is None else processes
+    counts = Counter()
+    if processes <= 1:
+        for form_type, security_name in securities:
+            try:
+                counts[export_security(form_type, security_name, force)] += 1
+            except Exception as ex:
+                counts['failed'] += 1
+                logger.warning("Snapshot of %s failed: %s", security_name, ex)
+        return counts
+    # spawn, forking a process with running threads (cache refresh, warmer) can dead lock. The workers
+    # inherit DJANGO_SETTINGS_MODULE and only need the apps loaded
+    with ProcessPoolExecutor(max_workers=processes,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=django.setup) as executor:
+        futures = {executor.submit(export_security, form_type, security_name, force): security_name
+                   for form_type, security_name in securities}
+        for future in as_completed(futures):
+            try:
+                counts[future.result()] += 1
+            except Exception as ex:
+                counts['failed'] += 1
+                logger.warning("Snapshot of %s failed: %s", futures[future], ex)
+    return counts
@@ -0,0 +1,36 @@
+// Fetches every chart of the dashboard only when its placeholder scrolls into view
+const lazy_charts = $('.lazy-chart')
+
+let load_chart = function (placeholder) {
+	const chart_div = $(placeholder)
+	$.getJSON(chart_div.data('chart-url'))
+		.done(response => {
+			if (response['spec']) {
+				chart_div.empty()
+				render_figure_spec(placeholder, response['spec'])
+			} else {
+				// jQuery runs the inline plotly <script> of the div while inserting it
+				chart_div.html(response['div'])
+			}
+		})
+		.fail(() => {
+			// the field name comes from the URL, inserted as text never as HTML
+			chart_div.empty().append($('<p class="text-muted"></p>').text(chart_div.data('field') + ' not available'))
+		})
+}
+
+if ('IntersectionObserver' in window) {
+	const observer = new IntersectionObserver((entries, observer) => {
+		entries.forEach(entry => {
+			if (entry.isIntersecting) {
+				// load only once
+				observer.unobserve(entry.target)
+				load_chart(entry.target)
+			}
+		})
+	}, {rootMargin: '200px'})
+	lazy_charts.each((_, placeholder) => observer.observe(placeholder))
+} else {
+	// old browsers get every chart right away
+	lazy_charts.each((_, placeholder) => load_chart(placeholder))
+}
@@ -0,0 +1,26 @@
+// Draws the compact figure specs sent by the server (see base/figure_spec.py) with plotly.js
+const typed_array_types = {
+	'f8': Float64Array,
+	'i4': Int32Array,
+}
+
+// {dtype: 'f8', bdata: '<base64>'} -> Float64Array, plain lists are returned as they are
+let decode_typed_array = function (encoded) {
+	if (!encoded || !encoded['bdata']) {
+		return encoded
+	}
+	const binary = atob(encoded['bdata'])
+	const bytes = new Uint8Array(binary.length)
+	for (let i = 0; i < binary.length; i++) {
+		bytes[i] = binary.charCodeAt(i)
+	}
+	return Array.from(new typed_array_types[encoded['dtype']](bytes.buffer))
+}
+
+let render_figure_spec = function (element, spec) {
+	const data = spec['data'].map(trace => Object.assign({}, trace, {
+		x: decode_typed_array(trace['x']),
+		y: decode_typed_array(trace['y']),
+	}))
+	return Plotly.newPlot(element, data, spec['layout'], {responsive: true})
+}
@@ -1,40 +1,125 @@
+// Type-ahead search box, answers come from the JSON suggest end point (see views.suggest_view)
+//  - key presses are debounced and the request of an older query is aborted when a newer one is sent
+//  - every answer is kept in a query -> results cache
+//  - a query extending a cached query whose answer was complete is filtered locally, no request at all
 const user_input = $("#user-input")
 const search_icon = $('#search-icon')
-const artists_div = $('#replaceable-content')
-const endpoint = ''
-const delay_by_in_ms = 700
+const results_div = $('#replaceable-content')
+const endpoint = user_input.data('suggest-url')
+const delay_by_in_ms = 150
+const max_cached_queries = 200
+const suggestion_cache = new Map()
 let scheduled_function = false
+let in_flight = null
 
-let ajax_call = function (endpoint, request_parameters) {
-	$.getJSON(endpoint, request_parameters)
-		.done(response => {
-			// fade out the artists_div, then:
-			artists_div.fadeTo('slow', 0).promise().then(() => {
-				// replace the HTML contents
-				artists_div.html(response['html_from_view'])
-				// fade-in the div with new contents
-				artists_div.fadeTo('slow', 1)
-				// stop animating search icon
-				search_icon.removeClass('blink')
-			})
-		})
+// same normalization as CommonStockSearchIndex.normalize
+let normalize = function (text) {
+	return (text || '').trim().toLowerCase()
 }
 
+// same ranking as the server: exact symbol, symbol prefix, name prefix, then substring
+let rank = function (query, result) {
+	const symbol = result[0].toLowerCase()
+	const name = (result[1] || '').toLowerCase()
+	if (symbol === query) {
+		return [0, symbol]
+	}
+	if (symbol.startsWith(query)) {
+		return [1, symbol]
+	}
+	if (name.startsWith(query)) {
+		return [2, name]
+	}
+	if (symbol.includes(query) || name.includes(query)) {
+		return [3, symbol]
+	}
+	return null
+}
 
-user_input.on('keyup', function () {
+// results for the query out of the cache, either an exact entry or a complete answer for a prefix of it
+let cached_results = function (query) {
+	if (suggestion_cache.has(query)) {
+		return suggestion_cache.get(query)['results']
+	}
+	for (let length = query.length - 1; length > 0; length--) {
+		const entry = suggestion_cache.get(query.slice(0, length))
+		if (entry && entry['complete']) {
+			const refined = entry['results']
+				.map(result => [rank(query, result), result])
+				.filter(ranked => ranked[0] !== null)
+				.sort((a, b) => a[0][0] - b[0][0] || (a[0][1] < b[0][1] ? -1 : a[0][1] > b[0][1] ? 1 : 0))
+				.map(ranked => ranked[1])
+			// a subset of a complete answer is complete too
+			remember(query, {results: refined, complete: true})
+			return refined
+		}
+	}
+	return null
+}
 
-	const request_parameters = {
-		q: $(this).val() // value of user_input: the HTML element with ID user-input
+let remember = function (query, answer) {
+	if (suggestion_cache.size >= max_cached_queries) {
+		// Map keeps the insertion order, drop the oldest entry
+		suggestion_cache.delete(suggestion_cache.keys().next().value)
 	}
+	suggestion_cache.set(query, answer)
+}
 
+let render_results = function (results) {
+	results_div.empty()
+	if (!results.length) {
+		results_div.append($('<p>').text('No companies found'))
+		return
+	}
+	const list = $('<ul>')
+	results.forEach(result => {
+		list.append($('<li>').text(result[0]).attr('title', result[1] + ' - ' + result[2]))
+	})
+	results_div.append(list)
+}
+
+let fetch_suggestions = function (query) {
+	if (in_flight) {
+		in_flight.abort()
+	}
 	// start animating the search icon with the CSS class
 	search_icon.addClass('blink')
+	in_flight = $.getJSON(endpoint, {q: query})
+		.done(response => {
+			remember(response['q'], {results: response['results'], complete: response['complete']})
+			// only draw the answer of what is in the box right now
+			if (normalize(user_input.val()) === response['q']) {
+				render_results(response['results'])
+			}
+		})
+		.always(() => {
+			in_flight = null
+			search_icon.removeClass('blink')
+		})
+}
+
+user_input.on('input', function () {
+	const query = normalize($(this).val())
 
 	// if scheduled_function is NOT false, cancel the execution of the function
 	if (scheduled_function) {
 		clearTimeout(scheduled_function)
+		scheduled_function = false
 	}
-
-	// setTimeout returns the ID of the function to be executed
-	scheduled_function = setTimeout(ajax_call, delay_by_in_ms, endpoint, request_parameters)
+	if (!query) {
+		if (in_flight) {
+			in_flight.abort()
+		}
+		results_div.empty()
+		return
+	}
+	const results = cached_results(query)
+	if (results !== null) {
+		if (in_flight) {
+			in_flight.abort()
+		}
+		render_results(results)
+		return
+	}
+	scheduled_function = setTimeout(fetch_suggestions, delay_by_in_ms, query)
 })
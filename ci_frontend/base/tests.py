@@ -1,3 +1,1307 @@
-from django.test import TestCase
+import asyncio
+import base64
+import gzip
+import itertools
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import (Future,
+                                ThreadPoolExecutor,
+                                )
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+import pandas as pd
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_save
+from django.test import (RequestFactory,
+                         SimpleTestCase,
+                         TestCase,
+                         TransactionTestCase,
+                         )
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from requests import HTTPError
+from requests.exceptions import (ChunkedEncodingError,
+                                 TooManyRedirects,
+                                 )
+from scripts.fake_backend import FakeBackend
+from . import (services,
+               snapshots,
+               throttle,
+               views,
+               )
+from .apps import BaseConfig
+from .backend import (BACKEND_FAILURES,
+                      backend_client,
+                      BackendClient,
+                      BackendUnavailable,
+                      CircuitBreaker,
+                      )
+from .cache import (ChartCache,
+                    LRUCache,
+                    packet_cache,
+                    PacketCache,
+                    )
+from .chart_render import ChartRenderPool
+from .comparison import BatchComparison
+from .downsample import (downsample,
+                         window_years,
+                         )
+from .figure_spec import (encode_array,
+                          encode_axis,
+                          scatter_spec,
+                          TYPED_ARRAY_DTYPES,
+                          )
+from .frame_store import (frame_store,
+                          FrameStore,
+                          )
+from .instrumentation import (metrics,
+                              MetricsRegistry,
+                              )
+from .loader import CommonStockLoader
+from .models import CommonStock
+from .packet_schema import PacketSchema
+from .plotly_bundle import plotly_bundle
+from .ratios import (FinancialRatios,
+                     RatioCache,
+                     )
+from .screener import (Condition,
+                       Screener,
+                       )
+from .search_index import (CommonStockSearchIndex,
+                           search_index,
+                           )
+from .services import (DivGenerator,
+                       load_packet,
+                       )
+from .single_flight import SingleFlight
+from .snapshots import (export_security,
+                        SnapshotStore,
+                        )
+from .throttle import (AdmissionControl,
+                       RateLimiter,
+                       )
+from .warmer import (CacheWarmer,
+                     PopularityTracker,
+                     )
 
-# Create your tests here.
+
+class FakeBackendMixin:
+    """
+    Points the backend client at a local FakeBackend, with an empty packet cache (no shared tier), a
+    closed circuit breaker, a frame store in a temporary directory, no static snapshots and no rate limits
+    """
+    years = 12
+
+    def setUp(self):
+        super().setUp()
+        self.backend = FakeBackend(years=self.years).start()
+        self.addCleanup(self.backend.stop)
+        frame_root = tempfile.mkdtemp(prefix='ci-frames-test-')
+        self.addCleanup(shutil.rmtree, frame_root, ignore_errors=True)
+        for target, attribute, value in ((backend_client, 'base_url', self.backend.url),
+                                         (backend_client, 'breaker', CircuitBreaker(5, 30.0)),
+                                         (packet_cache, 'shared_alias', None),
+                                         (frame_store, 'root', frame_root),
+                                         (views, 'snapshot_store', None)):
+            patcher = mock.patch.object(target, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(throttle.rate_limiters, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for cache in (packet_cache.local, packet_cache._failed_until):
+            cache.clear()
+            self.addCleanup(cache.clear)
+
+    @staticmethod
+    def load(security_name: str = 'msft') -> DivGenerator:
+        obj = DivGenerator('10-k', security_name)
+        obj.get_data_generate_data_frame('10-k', security_name)
+        return obj
+
+
+class SearchIndexInvalidationTests(TestCase):
+
+    def test_app_config_is_loaded(self):
+        self.assertIsInstance(apps.get_app_config('base'), BaseConfig)
+        self.assertTrue(post_save.has_listeners(CommonStock))
+
+    def test_saving_a_company_marks_the_index_stale(self):
+        with mock.patch.object(search_index, 'mark_stale') as mark_stale:
+            company = CommonStock.objects.create(symbol='ZZZZ', Name='Test Corp', Sector='Energy')
+            self.assertEqual(mark_stale.call_count, 1)
+            company.delete()
+            self.assertEqual(mark_stale.call_count, 2)
+
+
+class SearchIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        self.index = CommonStockSearchIndex(max_results=10, stamp_file='')
+        self.index.build([('AAPL', 'Apple Inc.', 'Information Technology', '10-k'),
+                          ('APA', 'Apache Corporation', 'Energy', '10-k'),
+                          ('AMAT', 'Applied Materials', 'Information Technology', '10-k'),
+                          ('MSFT', 'Microsoft Corp.', 'Information Technology', '10-k'),
+                          ('A', 'Agilent Technologies', 'Health Care', '10-k')])
+
+    def symbols(self, query, **kwargs):
+        return [hit.symbol for hit in self.index.search(query, **kwargs)]
+
+    def test_exact_then_symbol_prefix_then_name_prefix_then_substring(self):
+        self.assertEqual(self.symbols('apa'), ['APA'])
+        self.assertEqual(self.symbols('app'), ['AAPL', 'AMAT'])
+        self.assertEqual(self.symbols('a'), ['A', 'AAPL', 'AMAT', 'APA'])
+        self.assertEqual(self.symbols('ap'), ['APA', 'AAPL', 'AMAT'])
+        self.assertEqual(self.symbols('soft'), ['MSFT'])
+        self.assertEqual(self.symbols('  Micro '), ['MSFT'])
+
+    def test_results_are_capped(self):
+        self.assertEqual(self.symbols('a', limit=2), ['A', 'AAPL'])
+
+    def test_short_queries_use_the_prefix_ranges_only(self):
+        self.assertEqual(self.symbols('pl'), [])
+        self.assertEqual(self.symbols('apl'), ['AAPL'])
+        self.assertEqual(self.symbols(''), [])
+
+    def test_digest_changes_with_the_companies(self):
+        digest = self.index.digest
+        self.index.build([('AAPL', 'Apple Inc.', 'Information Technology', '10-k')])
+        self.assertNotEqual(self.index.digest, digest)
+
+
+class SuggestViewTests(SimpleTestCase):
+
+    def setUp(self):
+        index = CommonStockSearchIndex(max_results=2, stamp_file='')
+        index.build([('AAPL', 'Apple Inc.', 'Information Technology', '10-k'),
+                     ('AMAT', 'Applied Materials', 'Information Technology', '10-k'),
+                     ('APA', 'Apache Corporation', 'Energy', '10-k'),
+                     ('MSFT', 'Microsoft Corp.', 'Information Technology', '10-k')])
+        patcher = mock.patch.object(views, 'search_index', index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.url = reverse('suggest')
+
+    def test_ranked_matches_as_plain_lists(self):
+        response = self.client.get(self.url, {'q': ' APA '})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'q': 'apa',
+                                           'complete': True,
+                                           'results': [['APA', 'Apache Corporation', 'Energy']]})
+        self.assertEqual(self.client.get(self.url, {'q': 'soft'}).json()['results'][0][0], 'MSFT')
+
+    def test_capped_list_is_not_complete(self):
+        data = self.client.get(self.url, {'q': 'a'}).json()
+        self.assertEqual([result[0] for result in data['results']], ['AAPL', 'AMAT'])
+        self.assertFalse(data['complete'])
+        self.assertTrue(self.client.get(self.url, {'q': 'app'}).json()['complete'])
+
+    def test_unchanged_companies_answer_not_modified(self):
+        response = self.client.get(self.url, {'q': 'app'})
+        self.assertIn('max-age=', response['Cache-Control'])
+        not_modified = self.client.get(self.url, {'q': 'app'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.content, b'')
+        views.search_index.build([('AAPL', 'Apple Inc.', 'Information Technology', '10-k')])
+        self.assertEqual(self.client.get(self.url, {'q': 'app'}, HTTP_IF_NONE_MATCH=response['ETag']).status_code,
+                         200)
+
+
+class CommonStockLoaderTests(TransactionTestCase):
+
+    def setUp(self):
+        for symbol, name, sector in (('MSFT', 'Microsoft Corp.', 'Information Technology'),
+                                     ('AAPL', 'Apple Inc.', 'Information Technology'),
+                                     ('XOM', 'Exxon Mobil Corp.', 'Energy'),
+                                     ('GE', 'General Electric', 'Industrials')):
+            CommonStock.objects.create(symbol=symbol, Name=name, Sector=sector)
+
+    def test_rows_are_diffed_into_inserts_updates_and_deletes(self):
+        rows = [{'symbol': 'MSFT', 'Name': 'Microsoft Corp.', 'Sector': 'Information Technology'},
+                {'symbol': 'aapl', 'Name': 'Apple Inc.', 'Sector': 'Information Technology'},
+                {'symbol': 'XOM', 'Name': 'Exxon Mobil Corporation', 'Sector': 'Energy'},
+                {'symbol': 'NVDA', 'Name': 'NVIDIA Corp.', 'Sector': 'Information Technology'}]
+        with mock.patch.object(search_index, 'mark_stale') as mark_stale:
+            counts = CommonStockLoader(batch_size=2).sync(rows)
+        self.assertEqual(counts, {'created': 1, 'updated': 2, 'deleted': 1, 'unchanged': 1})
+        self.assertEqual(sorted(CommonStock.objects.values_list('symbol', 'name_key')),
+                         [('MSFT', 'microsoft corp.'), ('NVDA', 'nvidia corp.'),
+                          ('XOM', 'exxon mobil corporation'), ('aapl', 'apple inc.')])
+        # once after the commit, not once per deleted row
+        mark_stale.assert_called_once_with()
+
+    def test_same_rows_write_nothing(self):
+        rows = list(CommonStock.objects.values('symbol', 'Name', 'Sector'))
+        counts = CommonStockLoader().sync(rows)
+        self.assertEqual(counts, {'created': 0, 'updated': 0, 'deleted': 0, 'unchanged': 4})
+
+    def test_failed_sync_leaves_the_table_alone(self):
+        with mock.patch.object(CommonStock.objects, 'bulk_create', side_effect=RuntimeError('disk full')):
+            with self.assertRaises(RuntimeError):
+                CommonStockLoader().sync([{'symbol': 'NVDA', 'Name': 'NVIDIA Corp.', 'Sector': 'Information Technology'}])
+        self.assertEqual(CommonStock.objects.count(), 4)
+
+
+class ChartCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.series = pd.Series([1.0, 2.0, 3.0], index=[2017, 2018, 2019])
+
+    def test_key_follows_the_series_content(self):
+        key = ChartCache.make_key('msft', '10-k', 'assets', self.series)
+        self.assertEqual(ChartCache.make_key('msft', '10-k', 'assets', self.series.copy()), key)
+        self.assertNotEqual(ChartCache.make_key('msft', '10-k', 'assets', self.series * 2), key)
+        self.assertNotEqual(ChartCache.make_key('msft', '10-k', 'assets', self.series.set_axis([2016, 2017, 2018])),
+                            key)
+        self.assertNotEqual(ChartCache.make_key('aapl', '10-k', 'assets', self.series), key)
+
+    def test_hits_and_misses_are_counted(self):
+        cache = ChartCache(max_bytes=1024 * 1024)
+        key = ChartCache.make_key('msft', '10-k', 'assets', self.series)
+        self.assertIsNone(cache.get(key))
+        cache.set(key, '<div></div>')
+        self.assertEqual(cache.get(key), '<div></div>')
+        self.assertEqual((cache.stats.as_dict()['hits'], cache.stats.as_dict()['misses']), (1, 1))
+
+    def test_least_recently_used_charts_are_evicted_over_the_budget(self):
+        lru = LRUCache(max_bytes=250, sizeof=len)
+        lru.set('a', 'a' * 100)
+        lru.set('b', 'b' * 100)
+        lru.get('a')
+        lru.set('c', 'c' * 100)
+        self.assertIsNone(lru.get('b'))
+        self.assertIsNotNone(lru.get('a'))
+        self.assertEqual(lru.total_bytes, 200)
+        # bigger than the whole budget, never cached
+        lru.set('d', 'd' * 300)
+        self.assertIsNone(lru.get('d'))
+        self.assertEqual(len(lru), 2)
+
+
+class ChartRenderPoolTests(SimpleTestCase):
+
+    def setUp(self):
+        self.pool = ChartRenderPool(processes=2, timeout=0.05)
+        self.future = Future()
+        self.executor = mock.Mock(**{'submit.return_value': self.future})
+        self.pool._executor = self.executor
+        patcher = mock.patch('base.chart_render.render_scatter_div', return_value='<div>inline</div>')
+        self.render_inline = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_chart_still_queued_is_taken_back_and_rendered_inline(self):
+        self.assertEqual(self.pool.render('assets', [2018, 2019], [1.0, 2.0]), '<div>inline</div>')
+        self.assertTrue(self.future.cancelled())
+        self.render_inline.assert_called_once()
+
+    def test_chart_started_by_a_worker_is_never_rendered_twice(self):
+        self.future.set_running_or_notify_cancel()
+        threading.Timer(0.2, self.future.set_result, ['<div>worker</div>']).start()
+        self.assertEqual(self.pool.render('assets', [2018, 2019], [1.0, 2.0]), '<div>worker</div>')
+        self.render_inline.assert_not_called()
+
+    def test_broken_pool_is_replaced_and_the_chart_rendered_inline(self):
+        self.future.set_exception(BrokenProcessPool('worker killed'))
+        self.assertEqual(self.pool.render('assets', [2018, 2019], [1.0, 2.0]), '<div>inline</div>')
+        self.assertIsNone(self.pool._executor)
+        self.executor.shutdown.assert_called_once_with(wait=False)
+
+    def test_no_processes_renders_inline(self):
+        self.assertEqual(ChartRenderPool(processes=0).render('assets', [2019], [1.0]), '<div>inline</div>')
+        self.executor.submit.assert_not_called()
+
+
+class BatchComparisonTests(SimpleTestCase):
+
+    @staticmethod
+    def generator(security_name, data_frame):
+        return SimpleNamespace(security_name=security_name, data_frame=data_frame)
+
+    def test_securities_are_aligned_on_the_union_of_the_years(self):
+        msft = pd.DataFrame({'assets': [1.0, 2.0], 'debt': [5.0, 6.0]}, index=['2018', '2019'])
+        aapl = pd.DataFrame({'assets': [3.0, 4.0], 'ticker': ['aapl', 'aapl']}, index=[2019, 2020])
+        aligned = BatchComparison.align([self.generator('msft', msft), self.generator('aapl', aapl)],
+                                        ['assets', 'debt', 'goodwill'])
+        self.assertEqual(list(aligned.index), [2018, 2019, 2020])
+        self.assertEqual(aligned.index.name, 'fiscal_year')
+        self.assertEqual(list(aligned.columns), [('assets', 'aapl'), ('assets', 'msft'), ('debt', 'msft')])
+        np.testing.assert_array_equal(aligned[('assets', 'msft')], [1.0, 2.0, np.nan])
+        np.testing.assert_array_equal(aligned[('assets', 'aapl')], [np.nan, 3.0, 4.0])
+
+    def test_nothing_loaded_gives_an_empty_frame(self):
+        aligned = BatchComparison.align([], ['assets'])
+        self.assertTrue(aligned.empty)
+        self.assertEqual(aligned.columns.names, ['field', 'security'])
+
+
+class FigureSpecTests(SimpleTestCase):
+
+    @staticmethod
+    def decode(encoded):
+        # same as decode_typed_array in figure-spec.js
+        if not isinstance(encoded, dict):
+            return encoded
+        return np.frombuffer(base64.b64decode(encoded['bdata']), dtype=TYPED_ARRAY_DTYPES[encoded['dtype']])
+
+    def test_arrays_round_trip_with_nan(self):
+        values = [1.5, np.nan, -2.25e12]
+        np.testing.assert_array_equal(self.decode(encode_array(values, 'f8')), values)
+        self.assertEqual(encode_array([2018, 2019], 'i4'), {'dtype': 'i4', 'bdata': '4gcAAOMHAAA='})
+
+    def test_axis_packs_whole_numbers_as_int32(self):
+        self.assertEqual(encode_axis(pd.Index([2018, 2019]))['dtype'], 'i4')
+        self.assertEqual(encode_axis([2018.5, 2019.0])['dtype'], 'f8')
+        self.assertEqual(encode_axis(['2018-Q1', '2018-Q2']), ['2018-Q1', '2018-Q2'])
+
+    def test_scatter_spec_is_json_and_decodes_to_the_series(self):
+        spec = json.loads(json.dumps(scatter_spec([2018, 2019], [1.0, 2.0], 'assets', 'assets')))
+        trace = spec['data'][0]
+        self.assertEqual(list(self.decode(trace['x'])), [2018, 2019])
+        self.assertEqual(list(self.decode(trace['y'])), [1.0, 2.0])
+        self.assertEqual(spec['layout']['title']['text'], 'assets')
+
+
+class PlotlyJsViewTests(SimpleTestCase):
+
+    def test_versioned_bundle_is_gzipped_when_accepted(self):
+        url = reverse('plotly_js', args=[plotly_bundle.version])
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), plotly_bundle.source())
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(self.client.get(url).content, plotly_bundle.source())
+
+    def test_other_versions_are_redirected(self):
+        response = self.client.get(reverse('plotly_js', args=['0.0.1']))
+        self.assertRedirects(response, reverse('plotly_js', args=[plotly_bundle.version]),
+                             fetch_redirect_response=False)
+
+
+class CommonStockSearchTests(TestCase):
+
+    def setUp(self):
+        for symbol, name in (('MSFT', 'Microsoft Corp.'),
+                             ('MSI', 'Motorola Solutions'),
+                             ('MU', 'Micron Technology'),
+                             ('AAPL', 'Apple Inc.')):
+            CommonStock.objects.create(symbol=symbol, Name=name, Sector='Information Technology')
+
+    def symbols(self, query):
+        return list(CommonStock.objects.search(query).values_list('symbol', flat=True))
+
+    def test_exact_symbol_match_only(self):
+        self.assertEqual(self.symbols(' msft '), ['MSFT'])
+
+    def test_symbol_or_name_prefix(self):
+        self.assertEqual(self.symbols('ms'), ['MSFT', 'MSI'])
+        self.assertEqual(self.symbols('micr'), ['MSFT', 'MU'])
+
+    def test_substring_comes_from_the_index_not_a_like_scan(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.symbols('solutions'), ['MSI'])
+        self.assertFalse([query for query in queries.captured_queries if 'LIKE' in query['sql'].upper()])
+
+    def test_no_match(self):
+        self.assertEqual(self.symbols('zzzz'), [])
+        self.assertEqual(self.symbols('   '), [])
+
+
+class FrameStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='ci-frames-test-')
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.store = FrameStore(self.root)
+
+    @staticmethod
+    def _frame(years, assets):
+        return pd.DataFrame({'assets': assets, 'ticker': 'msft'}, index=pd.Index(years))
+
+    def test_new_years_are_appended(self):
+        self.assertEqual(self.store.update('10-k', 'msft', self._frame([2017, 2018], [1.0, 2.0])), 2)
+        self.assertEqual(self.store.update('10-k', 'msft', self._frame([2018, 2019], [2.0, 3.0])), 1)
+        snapshot = self.store.load('10-k', 'msft')
+        self.assertEqual(list(snapshot.data_frame.index), [2017, 2018, 2019])
+        self.assertEqual(list(snapshot.data_frame['assets']), [1.0, 2.0, 3.0])
+        self.assertEqual(snapshot.constants, {'ticker': 'msft'})
+
+    def test_amended_years_replace_the_stored_values(self):
+        self.store.update('10-k', 'msft', self._frame([2017, 2018], [1.0, 2.0]))
+        self.assertEqual(self.store.update('10-k', 'msft', self._frame([2018, 2019], [5.0, 3.0])), 2)
+        self.assertEqual(list(self.store.load('10-k', 'msft').data_frame['assets']), [1.0, 5.0, 3.0])
+
+    def test_unchanged_packet_writes_nothing(self):
+        self.store.update('10-k', 'msft', self._frame([2017, 2018], [1.0, 2.0]))
+        self.assertEqual(self.store.update('10-k', 'msft', self._frame([2017, 2018], [1.0, 2.0])), 0)
+
+
+class PacketRevalidationTests(FakeBackendMixin, SimpleTestCase):
+    key = ('10-k', 'msft')
+
+    @staticmethod
+    def loader(previous):
+        return load_packet('10-k', 'msft', previous)
+
+    def test_validators_are_kept_and_sent(self):
+        packet_cache.load(self.key, self.loader)
+        entry = packet_cache.peek(self.key)
+        self.assertTrue(entry.validators['etag'])
+        self.assertTrue(entry.validators['last_modified'])
+        with mock.patch.object(backend_client.session, 'get', wraps=backend_client.session.get) as get:
+            packet_cache.load(self.key, self.loader, previous=entry)
+        headers = get.call_args.kwargs['headers']
+        self.assertEqual(headers['If-None-Match'], entry.validators['etag'])
+        self.assertEqual(headers['If-Modified-Since'], entry.validators['last_modified'])
+
+    def test_not_modified_keeps_the_packet_and_renews_it(self):
+        packet = packet_cache.load(self.key, self.loader)
+        packet_cache.set(self.key, packet, ttl=0, validators=packet_cache.peek(self.key).validators)
+        expired = packet_cache.peek(self.key)
+        self.assertIs(packet_cache.load(self.key, self.loader, previous=expired), packet)
+        self.assertEqual(self.backend.not_modified_served, 1)
+        self.assertGreater(packet_cache.peek(self.key).fresh_until, expired.fresh_until)
+
+    def test_since_year_fetch_merges_new_and_amended_years(self):
+        with mock.patch.object(backend_client, 'since_year_param', 'since'):
+            packet = packet_cache.load(self.key, self.loader)
+            # a new fiscal year and different numbers for every year, only 2019 and 2020 are sent
+            self.backend.last_year, self.backend.revision = 2020, 1
+            merged = packet_cache.load(self.key, self.loader, previous=packet_cache.peek(self.key))
+        fresh = self.backend.packet('10-k', 'msft')
+        self.assertEqual(len(merged), 13)
+        self.assertEqual(merged['2008'], packet['2008'])
+        self.assertEqual(merged['2018'], packet['2018'])
+        self.assertNotEqual(merged['2018'], fresh['2018'])
+        self.assertEqual(merged['2019'], fresh['2019'])
+        self.assertEqual(merged['2020'], fresh['2020'])
+
+
+class PartialPacketTests(FakeBackendMixin, SimpleTestCase):
+    years = 3
+
+    def test_partial_snapshot_is_served_from_the_frame_store(self):
+        self.assertTrue(self.load().partial)
+        packet_cache.local.clear()
+        with mock.patch.object(services.packet_schema, 'to_data_frame') as to_data_frame:
+            obj = self.load()
+        to_data_frame.assert_not_called()
+        self.assertTrue(obj.partial)
+        self.assertEqual(len(obj.data_frame), 3)
+        self.assertEqual(self.backend.requests_served, 1)
+
+    def test_partial_packet_is_cached_for_the_partial_ttl(self):
+        self.load()
+        entry = packet_cache.peek(('10-k', 'msft'))
+        self.assertAlmostEqual(entry.fresh_until - entry.stored_at, packet_cache.partial_ttl)
+
+    def test_partial_snapshot_is_checked_again_after_the_partial_ttl(self):
+        self.load()
+        with mock.patch.object(packet_cache, 'partial_ttl', 0):
+            packet_cache.local.clear()
+            self.load()
+        self.assertEqual(self.backend.requests_served, 2)
+
+
+class PacketSchemaTests(SimpleTestCase):
+
+    def test_packet_is_typed_and_sorted(self):
+        data_frame = PacketSchema().to_data_frame({'2019': {'assets': 2, 'ticker': 'msft', 'filing-year': 2019},
+                                                   '2018': {'assets': 1, 'ticker': 'msft', 'filing-year': 2018}})
+        self.assertEqual(list(data_frame.index), [2018, 2019])
+        self.assertEqual(data_frame['assets'].dtype, 'float64')
+        self.assertEqual(data_frame['ticker'].dtype, 'category')
+
+    def test_bad_shapes_raise_value_error(self):
+        for packet in ([{'assets': 1}], {'2019': [1, 2]}, {'2019': 'assets'}):
+            with self.assertRaises(ValueError):
+                PacketSchema().to_data_frame(packet)
+
+
+class FinancialRatiosTests(SimpleTestCase):
+
+    def setUp(self):
+        # years out of order as strings, like the keys of a packet
+        self.data_frame = pd.DataFrame({'assets': [121.0, 100.0, 144.0],
+                                        'assetscurrent': [150.0, 100.0, 200.0],
+                                        'liabilitiescurrent': [0.0, 50.0, 100.0],
+                                        'stockholdersequity': [10.0, -5.0, 20.0],
+                                        'otherassetscurrent': [1.0, 2.0, 3.0],
+                                        'ticker': 'msft'},
+                                       index=['2018', '2017', '2019'])
+        self.metrics = FinancialRatios(self.data_frame).compute().loc[['2017', '2018', '2019']]
+
+    def assertColumn(self, name, expected):
+        np.testing.assert_allclose(self.metrics[name].to_numpy(), expected, equal_nan=True)
+
+    def test_current_ratio(self):
+        self.assertColumn('current_ratio', [2.0, np.nan, 2.0])
+
+    def test_growth_cagr_and_rolling_average(self):
+        self.assertColumn('assets_yoy_growth', [np.nan, 0.21, 23 / 121])
+        self.assertColumn('assets_cagr', [np.nan, 0.21, 0.2])
+        self.assertColumn('assets_rolling_3y', [np.nan, np.nan, 365 / 3])
+
+    def test_growth_from_a_negative_value_and_cagr_between_non_positive_values(self):
+        self.assertColumn('stockholdersequity_yoy_growth', [np.nan, 3.0, 1.0])
+        self.assertColumn('stockholdersequity_cagr', [np.nan, np.nan, np.nan])
+
+    def test_only_the_trend_fields_get_derived_columns(self):
+        self.assertNotIn('otherassetscurrent_yoy_growth', self.metrics.columns)
+        self.assertNotIn('ticker_cagr', self.metrics.columns)
+        self.assertEqual(len(self.metrics.columns), 1 + 3 * 4)
+        metrics = FinancialRatios(self.data_frame, ['otherassetscurrent']).compute()
+        self.assertEqual(sorted(metrics.columns), ['current_ratio', 'otherassetscurrent_cagr',
+                                                   'otherassetscurrent_rolling_3y', 'otherassetscurrent_yoy_growth'])
+
+    def test_metrics_are_memoized_per_digest(self):
+        cache = RatioCache(max_entries=2)
+        with mock.patch.object(FinancialRatios, 'compute', return_value=self.metrics) as compute:
+            cache.get_or_compute('digest', self.data_frame)
+            self.assertIs(cache.get_or_compute('digest', self.data_frame), self.metrics)
+        compute.assert_called_once()
+
+
+class DownsampleTests(SimpleTestCase):
+
+    def setUp(self):
+        values = np.sin(np.linspace(0, 12, 500)) * 100
+        values[137] = 1000.0
+        values[311] = -1000.0
+        self.series = pd.Series(values, index=range(1500, 2000))
+
+    def test_lttb_keeps_the_budget_the_ends_and_the_peaks(self):
+        kept = downsample(self.series, max_points=50, method='lttb')
+        self.assertEqual(len(kept), 50)
+        self.assertEqual(kept.index[0], 1500)
+        self.assertEqual(kept.index[-1], 1999)
+        self.assertIn(1637, kept.index)
+        self.assertIn(1811, kept.index)
+        self.assertTrue(kept.index.is_monotonic_increasing)
+
+    def test_min_max_keeps_the_extremes(self):
+        kept = downsample(self.series, max_points=50, method='minmax')
+        self.assertLessEqual(len(kept), 50)
+        self.assertEqual(kept.max(), 1000.0)
+        self.assertEqual(kept.min(), -1000.0)
+
+    def test_budget_below_the_minimum_is_raised_to_it(self):
+        self.assertEqual(len(downsample(self.series, max_points=1, method='lttb')), 3)
+        self.assertEqual(len(downsample(self.series, max_points=1, method='minmax')), 2)
+
+    def test_short_series_and_no_budget_are_left_alone(self):
+        self.assertIs(downsample(self.series, max_points=None), self.series)
+        self.assertIs(downsample(self.series, max_points=500), self.series)
+
+    def test_window_years(self):
+        self.assertEqual(list(window_years(self.series, 1990, 1995).index), [1990, 1991, 1992, 1993, 1994, 1995])
+
+
+class MetricsTests(TestCase):
+
+    @staticmethod
+    def families(text):
+        names = [line.split('{')[0].split(' ')[0] for line in text.splitlines() if not line.startswith('#')]
+        return [name.rsplit('_bucket', 1)[0].rsplit('_sum', 1)[0].rsplit('_count', 1)[0] for name in names]
+
+    def assertContiguous(self, text):
+        families = [family for family, _ in itertools.groupby(self.families(text))]
+        self.assertEqual(len(families), len(set(families)))
+        types = [line.split(' ')[2] for line in text.splitlines() if line.startswith('# TYPE')]
+        self.assertEqual(len(types), len(set(types)))
+
+    def test_exposition_groups_every_family(self):
+        registry = MetricsRegistry()
+        registry.describe('ci_test_seconds', 'Test latency')
+        registry.observe('ci_test_seconds', 0.003, stage='a')
+        registry.observe('ci_test_seconds', 0.2, stage='a')
+        registry.incr('ci_test_total', kind='x')
+        registry.add_collector(lambda: [('ci_test_events', 'counter', {'cache': 'a'}, 1),
+                                        ('ci_test_ratio', 'gauge', {'cache': 'a'}, 0.5)])
+        registry.add_collector(lambda: [('ci_test_events', 'counter', {'cache': 'b'}, 2)])
+        text = registry.render()
+        self.assertContiguous(text)
+        self.assertIn('# HELP ci_test_seconds Test latency', text)
+        self.assertIn('ci_test_seconds_bucket{stage="a",le="0.005"} 1', text)
+        self.assertIn('ci_test_seconds_bucket{stage="a",le="0.25"} 2', text)
+        self.assertIn('ci_test_seconds_bucket{stage="a",le="+Inf"} 2', text)
+        self.assertIn('ci_test_seconds_count{stage="a"} 2', text)
+        self.assertIn('ci_test_total{kind="x"} 1', text)
+
+    def test_metrics_view(self):
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertContiguous(text)
+        self.assertIn('ci_cache_events_total{cache="chart",event="hits"}', text)
+        self.assertNotIn('ci_cache_events_total{cache="chart",event="stale_hits"}', text)
+        self.assertIn('ci_cache_events_total{cache="packet",event="stale_hits"}', text)
+
+    def test_metrics_are_only_served_to_the_scrapers_and_staff(self):
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.1.2.3').status_code, 403)
+        self.client.force_login(User.objects.create(username='ops', is_staff=True))
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.1.2.3').status_code, 200)
+
+
+class TimingMiddlewareTests(TestCase):
+
+    def test_server_timing_and_request_histogram(self):
+        def requests_seen():
+            histogram = metrics._histograms.get(('ci_request_seconds', (('view', 'companies'),)))
+            return histogram.snapshot()[2] if histogram is not None else 0
+
+        seen = requests_seen()
+        response = self.client.get(reverse('companies'), {'q': 'zzzz'})
+        stages = dict(entry.split(';dur=') for entry in response['Server-Timing'].split(', '))
+        self.assertIn('db', stages)
+        self.assertGreaterEqual(float(stages['total']), float(stages['db']))
+        self.assertEqual(requests_seen(), seen + 1)
+
+    def test_server_timing_header_can_be_turned_off(self):
+        with self.settings(CI_SERVER_TIMING_HEADER=False):
+            self.assertNotIn('Server-Timing', self.client.get(reverse('companies')))
+
+
+class ScreenerTests(TestCase):
+
+    def setUp(self):
+        root = tempfile.mkdtemp(prefix='ci-frames-test-')
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        patcher = mock.patch.object(frame_store, 'root', root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for symbol, sector in (('AAPL', 'Information Technology'), ('MSFT', 'Information Technology'),
+                               ('XOM', 'Energy'), ('AMZN', 'Consumer Discretionary'), ('QTR', 'Energy')):
+            CommonStock.objects.create(symbol=symbol, Name=symbol, Sector=sector)
+        self.store('aapl', [2015, 2016, 2017, 2018, 2019], [100.0, 120.0, 150.0, 180.0, 220.0])
+        # no 2017 filing
+        self.store('msft', [2015, 2016, 2018, 2019], [100.0, 120.0, 150.0, 180.0])
+        self.store('xom', [2015, 2016, 2017, 2018, 2019], [100.0, 90.0, 80.0, 70.0, 60.0])
+        self.store('qtr', ['2019-Q1', '2019-Q2'], [1.0, 2.0])
+        self.screener = Screener(refresh_seconds=0)
+
+    @staticmethod
+    def store(security_name, years, assets):
+        frame_store.update('10-k', security_name, pd.DataFrame({'assets': assets}, index=pd.Index(years)))
+
+    def symbols(self, *conditions, **kwargs):
+        return [result['symbol'] for result in self.screener.screen(list(conditions), **kwargs)['results']]
+
+    def test_condition_parsing(self):
+        condition = Condition.parse('AccountsReceivableNetCurrent.YoY >= 10% for 5 years')
+        self.assertEqual((condition.metric, condition.op, condition.value, condition.years),
+                         ('accountsreceivablenetcurrent.yoy', '>=', 0.1, 5))
+        for text in ('assets >', 'assets.median > 1', 'assets > 1 for 0 years'):
+            with self.assertRaises(ValueError):
+                Condition.parse(text)
+
+    def test_streak_must_be_consecutive_years(self):
+        self.assertEqual(self.symbols('assets.yoy > 10% for 4 years'), ['aapl'])
+        # the missing 2017 of msft breaks its streak
+        self.assertEqual(self.symbols('assets.yoy > 10% for 2 years'), ['aapl'])
+        self.assertEqual(self.symbols('assets.yoy > 10%'), ['aapl', 'msft'])
+        self.assertEqual(self.symbols('assets >= 150 for 2 years'), ['aapl', 'msft'])
+
+    def test_sector_sort_and_latest_metrics(self):
+        data = self.screener.screen(['assets < 100'], sector='energy')
+        self.assertEqual(data['results'], [{'symbol': 'xom', 'name': 'XOM', 'sector': 'Energy', 'year': 2019,
+                                            'metrics': {'assets': 60.0}}])
+        self.assertEqual(self.symbols('assets > 0', sort='assets'), ['xom', 'msft', 'aapl'])
+        self.assertEqual(self.symbols('assets > 0', sort='-assets', limit=1), ['aapl'])
+        with self.assertRaises(ValueError):
+            self.screener.screen(['revenue > 0'])
+
+    def test_companies_without_yearly_data_are_reported_as_left_out(self):
+        data = self.screener.screen(['assets > 0'])
+        self.assertEqual((data['universe'], data['loaded'], data['not_loaded']), (5, 3, 2))
+        self.assertIsNotNone(data['note'])
+        self.store('amzn', [2019], [500.0])
+        data = self.screener.screen(['assets > 0'])
+        self.assertEqual((data['loaded'], data['not_loaded']), (4, 1))
+        self.assertEqual(data['results'][0]['symbol'], 'amzn')
+
+    def test_updated_company_is_read_again(self):
+        self.assertEqual(self.symbols('assets < 100'), ['xom'])
+        self.store('xom', [2019, 2020], [60.0, 500.0])
+        self.assertEqual(self.symbols('assets < 100'), [])
+        self.assertEqual(self.screener.screen(['assets > 400'])['results'][0]['year'], 2020)
+
+    def test_view_answers_bad_conditions_with_400(self):
+        with mock.patch.object(views, 'screener', self.screener):
+            response = self.client.get(reverse('screen'), {'where': 'assets.yoy > 10% and assets > 150'})
+            self.assertEqual([result['symbol'] for result in response.json()['results']], ['aapl', 'msft'])
+            self.assertEqual(self.client.get(reverse('screen'), {'where': 'assets >'}).status_code, 400)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+
+    def test_opens_after_the_threshold_and_lets_one_trial_through(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_seconds=0.05)
+        for _ in range(3):
+            self.assertTrue(breaker.allow_request())
+            breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow_request())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_open_circuit_fails_fast(self):
+        client = BackendClient(base_url='http://127.0.0.1:9/security/',
+                               breaker=CircuitBreaker(failure_threshold=1, reset_seconds=60))
+        client.breaker.record_failure()
+        with self.assertRaises(BackendUnavailable):
+            client.get_packet('10-k', 'msft')
+
+
+class BackendStatusTests(FakeBackendMixin, SimpleTestCase):
+    key = ('10-k', 'msft')
+
+    def setUp(self):
+        super().setUp()
+        for attribute, value in (('max_attempts', 3), ('backoff_base', 0.001)):
+            patcher = mock.patch.object(backend_client, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def loader(previous):
+        return load_packet('10-k', 'msft', previous)
+
+    def test_only_404_is_an_unknown_security(self):
+        with mock.patch.object(backend_client, 'base_url', self.backend.url + 'unknown/'):
+            self.assertIsNone(backend_client.get_packet('10-k', 'msft'))
+        self.assertEqual(backend_client.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_throttled_backend_is_retried_and_never_cached_as_not_found(self):
+        self.backend.fail_with = 429
+        with self.assertRaises(HTTPError):
+            packet_cache.get_or_load(self.key, self.loader)
+        self.assertEqual(self.backend.requests_served, 3)
+        self.assertIsNone(packet_cache.peek(self.key))
+        self.backend.fail_with = None
+        packet_cache._failed_until.clear()
+        self.assertTrue(packet_cache.get_or_load(self.key, self.loader))
+
+    def test_refused_call_fails_at_once(self):
+        self.backend.fail_with = 403
+        with self.assertRaises(BackendUnavailable):
+            packet_cache.get_or_load(self.key, self.loader)
+        self.assertEqual(self.backend.requests_served, 1)
+        self.assertIsNone(packet_cache.peek(self.key))
+
+    def test_every_outcome_settles_a_half_open_trial(self):
+        for error in (TooManyRedirects('redirected'), ChunkedEncodingError('cut short'), RuntimeError('bug')):
+            breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0)
+            breaker.record_failure()
+            client = BackendClient(base_url=self.backend.url, max_attempts=1, breaker=breaker)
+            with mock.patch.object(client.session, 'get', side_effect=error):
+                with self.assertRaises((RuntimeError,) + BACKEND_FAILURES):
+                    client.get_packet('10-k', 'msft')
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+            # the next trial is let through instead of failing fast for good
+            self.assertTrue(breaker.allow_request())
+
+
+class BackendDeadlineTests(SimpleTestCase):
+
+    def test_retries_stop_at_the_deadline(self):
+        # connections are queued by the kernel but never answered, every attempt times out
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(64)
+        self.addCleanup(listener.close)
+        client = BackendClient(base_url=f'http://127.0.0.1:{listener.getsockname()[1]}/security/',
+                               timeout=0.1,
+                               max_attempts=50,
+                               backoff_base=0.01,
+                               deadline=0.3,
+                               breaker=CircuitBreaker(failure_threshold=100, reset_seconds=60))
+        start = time.monotonic()
+        with self.assertRaises(BACKEND_FAILURES):
+            client.get_packet('10-k', 'msft')
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+class BackendUnavailableViewTests(FakeBackendMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        CommonStock.objects.create(symbol='MSFT', Name='Microsoft Corp.', Sector='Information Technology')
+        backend_client.breaker.state = CircuitBreaker.OPEN
+        backend_client.breaker._opened_at = time.monotonic()
+
+    def test_report_says_the_data_is_unavailable(self):
+        response = self.client.get(reverse('companies'), {'q': 'msft', 'stream': '0'})
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+        self.assertContains(response, 'temporarily unavailable', status_code=503)
+
+    def test_chart_is_a_503(self):
+        response = self.client.get(reverse('chart', args=['10-k', 'msft', 'assets']))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['error'], 'data temporarily unavailable')
+        self.assertIn('Retry-After', response)
+
+    def test_failure_is_remembered_briefly(self):
+        backend_client.breaker.record_success()
+        with mock.patch.object(backend_client, 'base_url', 'http://127.0.0.1:9/security/'), \
+                mock.patch.object(backend_client, 'max_attempts', 1), \
+                mock.patch.object(packet_cache, 'failure_ttl', 60):
+            for _ in range(2):
+                with self.assertRaises(BACKEND_FAILURES):
+                    self.load()
+        self.assertGreaterEqual(packet_cache.stats.as_dict()['failure_hits'], 1)
+
+
+class ChartViewTests(FakeBackendMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        CommonStock.objects.create(symbol='MSFT', Name='Microsoft Corp.', Sector='Information Technology')
+
+    def chart(self, field='accountspayablecurrent', symbol='msft', **params):
+        return self.client.get(reverse('chart', args=['10-k', symbol, field]), params)
+
+    def test_spec_carries_the_field_series(self):
+        response = self.chart(format='spec')
+        self.assertEqual(response.status_code, 200)
+        trace = response.json()['spec']['data'][0]
+        expected = self.load().data_frame['accountspayablecurrent']
+        self.assertEqual(list(FigureSpecTests.decode(trace['x'])), list(expected.index))
+        self.assertEqual(list(FigureSpecTests.decode(trace['y'])), list(expected))
+
+    def test_div_is_the_default_format(self):
+        body = self.chart().json()
+        self.assertEqual(body['field'], 'accountspayablecurrent')
+        self.assertIn('<div', body['div'])
+
+    def test_window_and_point_budget(self):
+        trace = self.chart(format='spec', start='2012', end='2019', points='3').json()['spec']['data'][0]
+        years = list(FigureSpecTests.decode(trace['x']))
+        self.assertEqual(len(years), 3)
+        self.assertEqual((years[0], years[-1]), (2012, 2019))
+        self.assertEqual(self.chart(start='last year').status_code, 400)
+
+    def test_symbol_case_does_not_matter(self):
+        self.assertEqual(self.chart(symbol='MSFT').status_code, 200)
+        self.chart(symbol='msft')
+        self.assertEqual(self.backend.requests_served, 1)
+
+    def test_unknown_security_and_field_are_404(self):
+        self.assertEqual(self.chart(symbol='zzzz').json()['error'], 'security not found')
+        response = self.chart(field='nosuchfield')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()['error'], 'statistic not found')
+
+
+class CacheWarmerTests(FakeBackendMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        for symbol in ('AAPL', 'MSFT', 'XOM'):
+            CommonStock.objects.create(symbol=symbol, Name=symbol, Sector='Energy')
+        self.warmer = CacheWarmer(concurrency=4, fields=[], slow_seconds=1.0, max_pause=60.0)
+        self.waits = []
+        patcher = mock.patch.object(self.warmer._stop, 'wait', side_effect=self.waits.append)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_refetched_packet_reaches_the_frame_store(self):
+        self.load()
+        self.backend.revision = 1
+        packet_cache.local.clear()
+        self.warmer.warm_one('10-k', 'msft')
+        fresh = self.backend.packet('10-k', 'msft')
+        stored = frame_store.load('10-k', 'msft').data_frame
+        self.assertEqual(stored.loc[2019, 'assets'], fresh['2019']['assets'])
+        self.assertEqual(self.load().data_frame.loc[2019, 'assets'], fresh['2019']['assets'])
+
+    def test_cached_packet_is_not_fetched_again(self):
+        self.warmer.warm_one('10-k', 'msft')
+        self.warmer.warm_one('10-k', 'msft')
+        self.assertEqual(self.backend.requests_served, 1)
+
+    def test_most_asked_securities_come_first(self):
+        tracker = PopularityTracker(flush_seconds=0)
+        with mock.patch.object(packet_cache, 'shared_alias', 'default'), \
+                mock.patch('base.warmer.popularity', tracker):
+            for security_name in ('xom', 'msft', 'xom'):
+                tracker.record(security_name)
+            self.assertEqual(tracker.scores(['msft', 'xom', 'aapl']), {'msft': 1, 'xom': 2})
+            self.assertEqual(self.warmer.candidates(), [('10-k', 'xom'), ('10-k', 'msft'), ('10-k', 'aapl')])
+
+    def test_slow_backend_halves_the_concurrency_and_backs_off(self):
+        calls = []
+        candidates = [('10-k', f'sym{index}') for index in range(8)]
+        slow = lambda form_type, security_name: calls.append(security_name) or 2.0
+        with mock.patch.object(self.warmer, 'candidates', return_value=candidates), \
+                mock.patch.object(self.warmer, 'warm_one', side_effect=slow), \
+                mock.patch.object(self.warmer._stop, 'wait', side_effect=lambda pause: self.waits.append((len(calls),
+                                                                                                          pause))):
+            counts = self.warmer.run_once()
+        # batches of 4, 2, 1 and 1 securities, the pause doubles after each
+        self.assertEqual(self.waits, [(4, 1.0), (6, 2.0), (7, 4.0), (8, 8.0)])
+        self.assertEqual(counts, {'warmed': 8, 'failed': 0, 'paused_seconds': 15.0})
+
+    def test_fast_backend_keeps_the_full_concurrency_and_failures_are_counted(self):
+        def warm_one(form_type, security_name):
+            if security_name == 'sym5':
+                raise BackendUnavailable('down')
+            return 0.0
+
+        candidates = [('10-k', f'sym{index}') for index in range(4)]
+        with mock.patch.object(self.warmer, 'candidates', return_value=candidates), \
+                mock.patch.object(self.warmer, 'warm_one', side_effect=warm_one):
+            self.assertEqual(self.warmer.run_once(), {'warmed': 4, 'failed': 0, 'paused_seconds': 0.0})
+        with mock.patch.object(self.warmer, 'candidates', return_value=candidates + [('10-k', 'sym5')]), \
+                mock.patch.object(self.warmer, 'warm_one', side_effect=warm_one):
+            self.assertEqual(self.warmer.run_once(), {'warmed': 4, 'failed': 1, 'paused_seconds': 1.0})
+
+
+class RateLimitTests(FakeBackendMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        CommonStock.objects.create(symbol='MSFT', Name='Microsoft Corp.', Sector='Information Technology')
+
+    def test_client_budget(self):
+        limiter = RateLimiter('test', rate=1, burst=2, global_rate=100, global_burst=100)
+        self.assertEqual(limiter.check('ip:1'), 0)
+        self.assertEqual(limiter.check('ip:1'), 0)
+        self.assertGreater(limiter.check('ip:1'), 0)
+        # every client has its own bucket
+        self.assertEqual(limiter.check('ip:2'), 0)
+
+    def test_global_budget_gives_the_client_token_back(self):
+        limiter = RateLimiter('test', rate=1, burst=2, global_rate=0.01, global_burst=1)
+        self.assertEqual(limiter.check('ip:1'), 0)
+        self.assertGreater(limiter.check('ip:2'), 0)
+        limiter.global_bucket.tokens = 1
+        self.assertEqual(limiter.check('ip:2'), 0)
+
+    def test_report_over_budget_is_a_429(self):
+        throttle.rate_limiters['report'] = RateLimiter('report', rate=0.01, burst=2, global_rate=100,
+                                                       global_burst=100)
+        for _ in range(2):
+            self.assertEqual(self.client.get(reverse('companies'), {'q': 'msft', 'stream': '0'}).status_code, 200)
+        response = self.client.get(reverse('companies'), {'q': 'msft', 'stream': '0'})
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+
+    def test_chart_over_budget_is_a_json_429(self):
+        throttle.rate_limiters['chart'] = RateLimiter('chart', rate=0.01, burst=1, global_rate=100,
+                                                      global_burst=100)
+        url = reverse('chart', args=['10-k', 'msft', 'assets'])
+        self.assertEqual(self.client.get(url).status_code, 200)
+        response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json()['error'], 'too many requests')
+        self.assertIn('Retry-After', response)
+
+
+class AdmissionControlTests(FakeBackendMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        CommonStock.objects.create(symbol='MSFT', Name='Microsoft Corp.', Sector='Information Technology')
+        self.admission = AdmissionControl(max_reports=1, queue_seconds=0, retry_after=7, stale_reports=4)
+        patcher = mock.patch.object(views, 'admission', self.admission)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_no_free_slot_is_a_503(self):
+        release = self.admission.acquire()
+        self.addCleanup(release)
+        response = self.client.get(reverse('companies'), {'q': 'msft', 'stream': '0'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+        response = self.client.get(reverse('chart', args=['10-k', 'msft', 'assets']),
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['error'], 'server busy')
+
+    def test_shed_report_is_served_stale(self):
+        fresh = self.client.get(reverse('companies'), {'q': 'msft', 'stream': '0'})
+        release = self.admission.acquire()
+        self.addCleanup(release)
+        response = self.client.get(reverse('companies'), {'q': 'msft', 'stream': '0'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, fresh.content)
+        self.assertIn('Warning', response)
+
+    def test_streamed_report_holds_its_slot_until_sent(self):
+        response = self.client.get(reverse('companies'), {'q': 'msft', 'stream': '1'})
+        self.assertTrue(response.streaming)
+        self.assertIsNone(self.admission.acquire())
+        b''.join(response.streaming_content)
+        release = self.admission.acquire()
+        self.assertIsNotNone(release)
+        release()
+
+
+class CompareViewTests(FakeBackendMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        for symbol in ('AAPL', 'MSFT'):
+            CommonStock.objects.create(symbol=symbol, Name=symbol, Sector='Information Technology')
+        self.admission = AdmissionControl(max_reports=1, queue_seconds=0, retry_after=7, stale_reports=4)
+        patcher = mock.patch.object(views, 'admission', self.admission)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.params = {'symbols': 'msft,aapl', 'fields': 'assets,liabilities'}
+
+    def test_charts_are_drawn_off_the_event_loop(self):
+        loops = []
+        create_divs = BatchComparison.create_divs
+
+        def on_worker_thread(comparison):
+            try:
+                loops.append(asyncio.get_running_loop())
+            except RuntimeError:
+                loops.append(None)
+            return create_divs(comparison)
+
+        with mock.patch.object(BatchComparison, 'create_divs', on_worker_thread):
+            response = self.client.get(reverse('compare'), self.params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['securities'], ['aapl', 'msft'])
+        self.assertEqual(len(response.context['output']), 2)
+        self.assertEqual(loops, [None])
+        # the slot is given back
+        release = self.admission.acquire()
+        self.assertIsNotNone(release)
+        release()
+
+    def test_compare_spends_the_report_budget(self):
+        throttle.rate_limiters['report'] = RateLimiter('report', rate=0.01, burst=1, global_rate=100,
+                                                       global_burst=100)
+        self.assertEqual(self.client.get(reverse('compare'), self.params).status_code, 200)
+        response = self.client.get(reverse('compare'), self.params)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        # the empty form costs nothing
+        self.assertEqual(self.client.get(reverse('compare')).status_code, 200)
+
+    def test_no_free_slot_is_shed(self):
+        release = self.admission.acquire()
+        self.addCleanup(release)
+        response = self.client.get(reverse('compare'), self.params)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+        self.assertEqual(self.backend.requests_served, 0)
+
+
+class PacketCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = PacketCache(local_max_entries=2, ttl=60, stale_ttl=60)
+        self.loads = []
+
+    def loader(self, previous):
+        self.loads.append(previous)
+        return {'2019': {'assets': len(self.loads)}}, None
+
+    def test_fresh_entry_is_served_without_loading(self):
+        first = self.cache.get_or_load(('10-k', 'msft'), self.loader)
+        self.assertIs(self.cache.get_or_load(('10-k', 'msft'), self.loader), first)
+        self.assertEqual(len(self.loads), 1)
+        self.assertEqual(self.cache.stats.as_dict()['hits'], 1)
+
+    def test_expired_entry_is_loaded_again_with_the_previous_one(self):
+        self.cache.set(('10-k', 'msft'), {'2018': {}}, ttl=0, stale_ttl=0)
+        value = self.cache.get_or_load(('10-k', 'msft'), self.loader)
+        self.assertEqual(value, {'2019': {'assets': 1}})
+        self.assertEqual(self.loads[0].value, {'2018': {}})
+
+    def test_stale_entry_is_served_while_refreshed_in_the_background(self):
+        refreshed = threading.Event()
+
+        def slow_loader(previous):
+            refreshed.wait(5)
+            return self.loader(previous)
+
+        stale = {'2018': {}}
+        self.cache.set(('10-k', 'msft'), stale, ttl=0, stale_ttl=60)
+        self.assertIs(self.cache.get_or_load(('10-k', 'msft'), slow_loader), stale)
+        # a single refresh for the key, however many stale hits
+        self.assertIs(self.cache.get_or_load(('10-k', 'msft'), slow_loader), stale)
+        refreshed.set()
+        for _ in range(100):
+            if self.cache.peek(('10-k', 'msft')).value is not stale:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.cache.peek(('10-k', 'msft')).value, {'2019': {'assets': 1}})
+        self.assertEqual(len(self.loads), 1)
+        self.assertEqual(self.cache.stats.as_dict()['stale_hits'], 2)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        for symbol in ('msft', 'aapl', 'goog'):
+            self.cache.set(('10-k', symbol), {symbol: {}})
+        self.assertIsNone(self.cache.peek(('10-k', 'msft')))
+        self.assertIsNotNone(self.cache.peek(('10-k', 'goog')))
+
+
+class SingleFlightTests(SimpleTestCase):
+    callers = 8
+
+    def _run_concurrently(self, function):
+        started = threading.Barrier(self.callers)
+
+        def call():
+            started.wait()
+            return function()
+
+        with ThreadPoolExecutor(max_workers=self.callers) as executor:
+            futures = [executor.submit(call) for _ in range(self.callers)]
+        return futures
+
+    def test_concurrent_callers_share_one_call(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        def work():
+            calls.append(1)
+            time.sleep(0.2)
+            return object()
+
+        futures = self._run_concurrently(lambda: single_flight.do(('test', 'key'), work))
+        results = {id(future.result()) for future in futures}
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 1)
+
+    def test_every_caller_gets_the_error(self):
+        single_flight = SingleFlight()
+
+        def work():
+            time.sleep(0.2)
+            raise ValueError('no data')
+
+        futures = self._run_concurrently(lambda: single_flight.do(('test', 'key'), work))
+        for future in futures:
+            self.assertIsInstance(future.exception(), ValueError)
+
+
+class ConcurrentReportTests(FakeBackendMixin, SimpleTestCase):
+
+    def test_concurrent_reports_make_one_backend_call(self):
+        self.backend.latency_ms = 200
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            generators = list(executor.map(lambda _: self.load(), range(6)))
+        self.assertEqual(self.backend.requests_served, 1)
+        self.assertTrue(all(obj.data_frame is generators[0].data_frame for obj in generators))
+
+
+class NoDataTests(FakeBackendMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        CommonStock.objects.create(symbol='MSFT', Name='Microsoft Corp.', Sector='Information Technology')
+
+    def test_unknown_security_is_cached_for_the_negative_ttl(self):
+        # the fake backend answers 404 to any other path
+        with mock.patch.object(backend_client, 'base_url', self.backend.url + 'unknown/'), \
+                mock.patch.object(backend_client.session, 'get', wraps=backend_client.session.get) as get:
+            for _ in range(2):
+                with self.assertRaises(ValueError):
+                    self.load()
+        self.assertEqual(get.call_count, 1)
+        entry = packet_cache.peek(('10-k', 'msft'))
+        self.assertIsNone(entry.value)
+        self.assertAlmostEqual(entry.fresh_until - entry.stored_at, packet_cache.negative_ttl)
+        self.assertEqual(entry.stale_until, entry.fresh_until)
+
+    def test_empty_packet_report_says_there_is_no_data(self):
+        self.backend.years = 0
+        response = self.client.get(reverse('companies'), {'q': 'msft', 'stream': '0'})
+        self.assertContains(response, 'No financial data available for MSFT')
+
+    def test_partial_packet_report_is_rendered_with_a_note(self):
+        self.backend.years = 3
+        response = self.client.get(reverse('companies'), {'q': 'msft', 'stream': '0'})
+        self.assertContains(response, 'Partial data, only 3 fiscal years available')
+        self.assertContains(response, 'lazy-chart')
+
+
+class SnapshotTests(FakeBackendMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        CommonStock.objects.create(symbol='MSFT', Name='Microsoft Corp.', Sector='Information Technology')
+        root = tempfile.mkdtemp(prefix='ci-snapshots-test-')
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.store = SnapshotStore(root)
+        for target in (snapshots, views):
+            patcher = mock.patch.object(target, 'snapshot_store', self.store)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.assertEqual(export_security('10-k', 'msft'), 'built')
+
+    def get_report(self, **headers):
+        return self.client.get(reverse('companies'), {'q': 'msft'}, **headers)
+
+    def test_accepted_encodings(self):
+        self.assertEqual(SnapshotStore.accepted_encodings('gzip, deflate'), {'gzip', 'deflate'})
+        self.assertEqual(SnapshotStore.accepted_encodings('gzip;q=0, br;q=0.5'), {'br'})
+        self.assertEqual(SnapshotStore.accepted_encodings(''), set())
+
+    def test_unchanged_data_is_not_rendered_again(self):
+        built_at = self.store.manifest('10-k', 'msft')['built_at']
+        self.assertEqual(export_security('10-k', 'msft'), 'unchanged')
+        self.assertEqual(self.store.manifest('10-k', 'msft')['built_at'], built_at)
+
+    def test_report_is_served_precompressed(self):
+        response = self.get_report(HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        html = gzip.decompress(b''.join(response.streaming_content))
+        self.assertIn(b'streamed-chart', html)
+        self.assertEqual(self.get_report(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_refused_encoding_is_not_sent(self):
+        response = self.get_report(HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertIn(b'streamed-chart', b''.join(response.streaming_content))
+
+    def test_other_parameters_render_the_report(self):
+        response = self.client.get(reverse('companies'), {'q': 'msft', 'fields': 'assets', 'stream': '0'})
+        self.assertFalse(response.streaming)
+
+    def test_charts_json_is_served(self):
+        response = self.client.get(reverse('snapshot_charts', args=['10-k', 'msft']))
+        self.assertEqual(response['Content-Type'], 'application/json')
+        charts = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(set(charts['charts']), set(settings.CI_REPORT_DEFAULT_FIELDS))
+        self.assertEqual(self.client.get(reverse('snapshot_charts', args=['10-k', 'aapl'])).status_code, 404)
+
+    def test_snapshot_of_a_company_without_data_is_deleted(self):
+        packet_cache.local.clear()
+        with mock.patch.object(backend_client, 'base_url', self.backend.url + 'unknown/'), \
+                mock.patch.object(frame_store, 'max_age', 0):
+            self.assertEqual(export_security('10-k', 'msft'), 'no data')
+        self.assertIsNone(self.store.manifest('10-k', 'msft'))
+
+    def test_cached_no_data_is_not_served_from_the_snapshot(self):
+        packet_cache.set(('10-k', 'msft'), None, ttl=300, stale_ttl=0)
+        self.assertIsNone(self.store.response(RequestFactory().get('/'), '10-k', 'msft'))
+        self.assertIsNone(self.store.manifest('10-k', 'msft'))
+
+    def test_backend_down_keeps_the_snapshot(self):
+        packet_cache.local.clear()
+        backend_client.breaker.state = CircuitBreaker.OPEN
+        backend_client.breaker._opened_at = time.monotonic()
+        with mock.patch.object(frame_store, 'max_age', 0):
+            with self.assertRaises(BackendUnavailable):
+                export_security('10-k', 'msft')
+        self.assertIsNotNone(self.store.manifest('10-k', 'msft'))
@@ -0,0 +1,376 @@
+# This file will define the rate limiting and the admission control (load shedding) of the base app views
+import functools
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.http import (HttpResponse,
+                         JsonResponse,
+                         )
+from .backend import backend_client
+from .cache import LRUCache
+from .instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average and bursts of up to burst requests, the bucket refills
+    continuously so there is no window edge to game
+    e.g
+        bucket = TokenBucket(rate=2, burst=10)
+        bucket.take() -> 0.0 if allowed, seconds to wait otherwise
+    """
+
+    def __init__(self,
+                 rate: float,
+                 burst: float):
+        """
+        :param rate: tokens added per second
+        :type rate: float
+        :param burst: max tokens held, a new bucket starts full
+        :type burst: float
+        """
+        self.rate: float = rate
+        self.burst: float = burst
+        self.tokens: float = burst
+        self.updated_at: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, tokens: float = 1.0) -> float:
+        """
+        :param tokens: cost of the request
+        :type tokens: float
+        :return: 0 if the tokens were taken, else the seconds until they will be available
+        :rtype: float
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate if self.rate > 0 else float('inf')
+
+    def give_back(self, tokens: float = 1.0):
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + tokens)
+
+
+class RateLimiter:
+    """
+    Token buckets for one budget (e.g the type-ahead or the report path): one per client and one shared by
+    all the clients, a request needs a token from both. The buckets live in the worker process, the rates
+    are per process. The least recently seen clients are forgotten past max_clients, they come back with
+    a full bucket
+    """
+
+    def __init__(self,
+                 name: str,
+                 rate: float,
+                 burst: float,
+                 global_rate: float,
+                 global_burst: float,
+                 max_clients: int = 10000):
+        """
+        :param name: name of the budget, used in the metrics
+        :type name: str
+        :param rate: requests per second allowed to a single client
+        :type rate: float
+        :param burst: requests a single client can make at once
+        :type burst: float
+        :param global_rate: requests per second allowed to all the clients together
+        :type global_rate: float
+        :param global_burst: requests all the clients together can make at once
+        :type global_burst: float
+        :param max_clients: clients tracked at most
+        :type max_clients: int
+        """
+        self.name: str = name
+        self.rate: float = rate
+        self.burst: float = burst
+        self.global_bucket: TokenBucket = TokenBucket(global_rate, global_burst)
+        self._clients: LRUCache = LRUCache(max_entries=max_clients)
+        self._lock = threading.Lock()
+
+    def _client_bucket(self, client: str) -> TokenBucket:
+        bucket = self._clients.get(client)
+        if bucket is None:
+            with self._lock:
+                bucket = self._clients.get(client)
+                if bucket is None:
+                    bucket = TokenBucket(self.rate, self.burst)
+                    self._clients.set(client, bucket)
+        return bucket
+
+    def check(self, client: str) -> float:
+        """
+        :param client: identifies the client e.g 'ip:10.0.0.1'
+        :type client: str
+        :return: 0 if the request may go on, else the seconds the client should wait
+        :rtype: float
+        """
+        bucket = self._client_bucket(client)
+        wait = bucket.take()
+        if wait:
+            metrics.incr('ci_rate_limited_total', budget=self.name, scope='client')
+            return wait
+        wait = self.global_bucket.take()
+        if wait:
+            # the client did nothing wrong, its token is not lost
+            bucket.give_back()
+            metrics.incr('ci_rate_limited_total', budget=self.name, scope='global')
+        return wait
+
+
+def _rate_limiters() -> dict:
+    config = getattr(settings, 'CI_RATE_LIMIT', dict())
+    return {name: RateLimiter(name,
+                              rate=budget['RATE'],
+                              burst=budget['BURST'],
+                              global_rate=budget['GLOBAL_RATE'],
+                              global_burst=budget['GLOBAL_BURST'],
+                              max_clients=config.get('MAX_CLIENTS', 10000))
+            for name, budget in config.get('BUDGETS', dict()).items()}
+
+
+# One limiter per budget, a budget missing from CI_RATE_LIMIT['BUDGETS'] is not limited
+rate_limiters = _rate_limiters()
+
+
+def _wants_json(request) -> bool:
+    # the type-ahead and the lazy charts of the dashboard
+    return request.is_ajax() or 'application/json' in request.META.get('HTTP_ACCEPT', '')
+
+
+def client_key(request) -> str:
+    """
+    The signed in user, or the client address. The first address of X-Forwarded-For is only used with
+    CI_RATE_LIMIT['TRUST_X_FORWARDED_FOR'], i.e behind a proxy which sets it, as a client can send any
+    :rtype: str
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    address = request.META.get('REMOTE_ADDR', '')
+    if getattr(settings, 'CI_RATE_LIMIT', dict()).get('TRUST_X_FORWARDED_FOR'):
+        address = request.META.get('HTTP_X_FORWARDED_FOR', address).split(',')[0].strip() or address
+    return f'ip:{address}'
+
+
+def throttle(request,
+             budget: str) -> 'HTTP Response or None':
+    """
+    Spends a token of the budget for the client of the request
+    e.g
+        too_many = throttle(request, 'report')
+        if too_many is not None:
+            return too_many
+    :param request: HTTP request
+    :type request: HttpRequest
+    :param budget: key of CI_RATE_LIMIT['BUDGETS']
+    :type budget: str
+    :return: None if the request may go on, else a 429 response with Retry-After
+    :rtype: HttpResponse
+    """
+    limiter = rate_limiters.get(budget)
+    if limiter is None:
+        return None
+    wait = limiter.check(client_key(request))
+    if not wait:
+        return None
+    if _wants_json(request):
+        response = JsonResponse(data={'error': 'too many requests'},
+                                status=429)
+    else:
+        response = HttpResponse('Too many requests, please try again shortly.',
+                                content_type='text/plain; charset=utf-8',
+                                status=429)
+    response['Retry-After'] = str(max(1, math.ceil(wait)))
+    return response
+
+
+def rate_limited(budget: str):
+    """
+    Decorator of the function views, see throttle
+    e.g
+        @rate_limited('suggest')
+        def suggest_view(request):
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            too_many = throttle(request, budget)
+            if too_many is not None:
+                return too_many
+            return view(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class AdmissionControl:
+    """
+    Bounds the reports and lazy charts built at the same time in this process so an overload turns into
+    fast refusals instead of every request queueing on the backend. A report is admitted when one of the
+    max_reports slots frees up within queue_seconds and the backend has fewer than max_backend_in_flight
+    requests pending, otherwise the last rendered copy of the same report is served (stale) or a 503 with
+    Retry-After is returned. A streamed report renders its charts while it is sent, its slot is held until
+    the response is sent or closed
+    e.g
+        with admission.admit() as admitted:
+            if not admitted:
+                return admission.shed(request)
+        release = admission.acquire()
+        ...
+        response.streaming_content = HeldUntilSent(response.streaming_content, release)
+    """
+
+    def __init__(self,
+                 max_reports: int = 8,
+                 max_backend_in_flight: int = 16,
+                 queue_seconds: float = 0.1,
+                 retry_after: int = 5,
+                 stale_reports: int = 128):
+        """
+        :param max_reports: reports built at the same time, 0 for no limit
+        :type max_reports: int
+        :param max_backend_in_flight: pending backend requests above which new reports are refused, 0 for
+                                      no limit
+        :type max_backend_in_flight: int
+        :param queue_seconds: max time a report waits for a free slot
+        :type queue_seconds: float
+        :param retry_after: seconds sent in the Retry-After header of the 503
+        :type retry_after: int
+        :param stale_reports: last rendered reports kept to be served when shedding, 0 for none
+        :type stale_reports: int
+        """
+        self.max_reports: int = max_reports
+        self.max_backend_in_flight: int = max_backend_in_flight
+        self.queue_seconds: float = queue_seconds
+        self.retry_after: int = retry_after
+        self._slots = threading.BoundedSemaphore(max_reports) if max_reports else None
+        self._stale: LRUCache = LRUCache(max_entries=stale_reports) if stale_reports else None
+
+    @classmethod
+    def from_settings(cls) -> 'AdmissionControl':
+        config = getattr(settings, 'CI_ADMISSION', dict())
+        return cls(max_reports=config.get('MAX_CONCURRENT_REPORTS', 8),
+                   max_backend_in_flight=config.get('MAX_BACKEND_IN_FLIGHT', 16),
+                   queue_seconds=config.get('QUEUE_SECONDS', 0.1),
+                   retry_after=config.get('RETRY_AFTER_SECONDS', 5),
+                   stale_reports=config.get('STALE_REPORTS', 128))
+
+    def acquire(self) -> 'callable or None':
+        """
+        Takes a slot, see admit
+        :return: function giving the slot back, to be called once, None if the report is refused
+        :rtype: callable
+        """
+        if self.max_backend_in_flight and backend_client.in_flight >= self.max_backend_in_flight:
+            return None
+        if self._slots is None:
+            return lambda: None
+        if not self._slots.acquire(timeout=self.queue_seconds):
+            return None
+        return self._slots.release
+
+    @contextmanager
+    def admit(self):
+        """
+        :return: context manager giving True if the report can be built, the slot is held until it exits
+        """
+        release = self.acquire()
+        if release is None:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            release()
+
+    @staticmethod
+    def report_key(request) -> str:
+        # ?stream= only changes how the same page is sent
+        query = request.GET.copy()
+        query.pop('stream', None)
+        return request.path + '?' + query.urlencode()
+
+    def keep(self,
+             request,
+             response: 'HTTP Response'):
+        """
+        Keeps a copy of a successfully rendered report to serve it while shedding
+        """
+        if self._stale is not None and response.status_code == 200 and not response.streaming:
+            self._stale.set(self.report_key(request), response.content)
+
+    def shed(self, request) -> 'HTTP Response':
+        """
+        :return: the last rendered copy of the report marked stale, else a 503 with Retry-After, JSON for
+                 the requests of the dashboard scripts
+        :rtype: HttpResponse
+        """
+        content = self._stale.get(self.report_key(request)) if self._stale is not None else None
+        if content is not None:
+            metrics.incr('ci_shed_total', outcome='stale')
+            response = HttpResponse(content, content_type='text/html; charset=utf-8')
+            response['Warning'] = '110 - "Response is Stale"'
+            response['Cache-Control'] = 'no-store'
+            return response
+        metrics.incr('ci_shed_total', outcome='unavailable')
+        logger.warning("Shedding the report %s, the server is overloaded", request.get_full_path())
+        if _wants_json(request):
+            response = JsonResponse(data={'error': 'server busy'},
+                                    status=503)
+        else:
+            response = HttpResponse('The server is busy, please try again shortly.',
+                                    content_type='text/plain; charset=utf-8',
+                                    status=503)
+        response['Retry-After'] = str(self.retry_after)
+        return response
+
+
+class HeldUntilSent:
+    """
+    Streaming content which calls release once every chunk is sent or the response is closed (e.g the
+    client went away), whichever comes first. The WSGI server closes every response, sent or not
+    e.g
+        response.streaming_content = HeldUntilSent(response.streaming_content, release)
+    """
+
+    def __init__(self,
+                 chunks: 'iterator',
+                 release: 'callable'):
+        self._chunks = iter(chunks)
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._chunks)
+        except BaseException:
+            # StopIteration once all is sent, or the rendering failed
+            self.close()
+            raise
+
+    def close(self):
+        release, self._release = self._release, None
+        try:
+            close = getattr(self._chunks, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            if release is not None:
+                release()
+
+
+admission = AdmissionControl.from_settings()
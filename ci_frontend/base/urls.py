@@ -7,4 +7,29 @@ urlpatterns = [
     path('',
          views.CommonStockSearchPageView.as_view(),
          name='companies'),
+    # Type-ahead suggestions as JSON, e.g ?q=micro
+    path('suggest/',
+         views.suggest_view,
+         name='suggest'),
+    # One chart of the dashboard, fetched lazily by the page
+    path('chart/<str:form_type>/<str:security_name>/<str:field_name>/',
+         views.chart_view,
+         name='chart'),
+    # Charts of the static snapshot of a report, see snapshots.py
+    path('snapshot/<str:form_type>/<str:security_name>/charts.json',
+         views.snapshot_charts_view,
+         name='snapshot_charts'),
+    # Local copy of plotly.js, cached by the browsers for good
+    path('plotly/<str:version>/plotly.min.js',
+         views.plotly_js_view,
+         name='plotly_js'),
+    # Many companies side by side, e.g ?symbols=msft,aapl or ?sector=Energy
+    path('compare/',
+         views.compare_view,
+         name='compare'),
+    # Companies passing conditions over their fiscal years as JSON,
+    # e.g ?where=assets.yoy > 10% for 3 years&sector=Energy
+    path('screen/',
+         views.screener_view,
+         name='screen'),
 ]
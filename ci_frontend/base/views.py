@@ -1,10 +1,30 @@
-from django.shortcuts import render
+from django.shortcuts import (render,
+                              redirect,
+                              )
+from django.utils.cache import (get_conditional_response,
+                                patch_cache_control,
+                                patch_vary_headers,
+                                )
+from django.views.decorators.cache import cache_control
 from django.views import generic
-from django.http import HttpResponse
-from django.db.models import Q
+from django.http import (HttpResponse,
+                         HttpResponseForbidden,
+                         StreamingHttpResponse,
+                         )
+from django.utils.html import (escape,
+                               json_script,
+                               )
 from django.template.loader import render_to_string
 from django.http import JsonResponse
+from django.conf import settings
+from django.urls import reverse
+from django.utils.http import urlencode
+from asgiref.sync import sync_to_async
+from concurrent.futures import (ThreadPoolExecutor,
+                                as_completed,
+                                )
 import logging
+import re
 
 logger = logging.getLogger(__name__)
 
@@ -12,8 +32,36 @@ logger = logging.getLogger(__name__)
 # financial parameter is a 1 graph, we will not use any inbuilt DB to retrive
 # any data. Only the REST API backend will be used to get the data about
 # each security back. This is for form 10-k only as of now
+from .backend import BACKEND_FAILURES
+from .cache import packet_cache
 from .models import CommonStock
 from .services import DivGenerator
+from .search_index import search_index
+from .comparison import BatchComparison
+from .screener import screener
+from .plotly_bundle import plotly_bundle
+from .instrumentation import (metrics,
+                              timed,
+                              )
+from .warmer import popularity
+from .snapshots import snapshot_store
+from .throttle import (admission,
+                       HeldUntilSent,
+                       rate_limited,
+                       throttle,
+                       )
+
+# Renders the charts of the streamed reports, shared by all the requests so the CPU heavy plotly
+# serialization can not grow past the configured number of threads
+_chart_executor = ThreadPoolExecutor(max_workers=settings.CI_REPORT_STREAM_WORKERS,
+                                     thread_name_prefix='chart-render')
+STREAM_MARKER = '<!-- ci:charts -->'
+# query parameters of a report which can be answered by its static snapshot
+SNAPSHOT_PARAMS = {'q', 'stream'}
+# query parameters of the chart year window and point budget -> DivGenerator.chart_series arguments
+CHART_WINDOW_PARAMS = {'start': 'start_year',
+                       'end': 'end_year',
+                       'points': 'max_points'}
 
 
 class CommonStockSearchPageView(generic.ListView):
@@ -36,6 +84,144 @@ class CommonStockSearchPageView(generic.ListView):
     # HTTP get response object returned back to user
     context_object_name = 'output'
 
+    def get(self, request, *args, **kwargs):
+        """
+        The type-ahead (AJAX) and the report requests spend separate rate limit budgets. A default report
+        with a fresh static snapshot is served from it, any other report is only built when the admission
+        control lets it in, see throttle.AdmissionControl
+        """
+        if request.is_ajax():
+            return throttle(request, 'suggest') or super().get(request, *args, **kwargs)
+        if not request.GET.get('q'):
+            return super().get(request, *args, **kwargs)
+        too_many = throttle(request, 'report')
+        if too_many is not None:
+            return too_many
+        snapshot = self._snapshot_response(request)
+        if snapshot is not None:
+            return snapshot
+        release = admission.acquire()
+        if release is None:
+            return admission.shed(request)
+        try:
+            response = super().get(request, *args, **kwargs)
+        except BaseException:
+            release()
+            raise
+        if response.streaming:
+            # the charts of a streamed report are rendered while it is sent, the slot is held until then
+            response.streaming_content = HeldUntilSent(response.streaming_content, release)
+            return response
+        release()
+        admission.keep(request, response)
+        return response
+
+    def _snapshot_response(self, request) -> 'HTTP Response or None':
+        """
+        The exported snapshot of the report (see snapshots.py) when only the company is asked for, the
+        snapshots are of the default fields and chart window
+        :rtype: FileResponse
+        """
+        if snapshot_store is None or not set(request.GET).issubset(SNAPSHOT_PARAMS):
+            return None
+        company = CommonStock.objects.search(request.GET['q']).values_list('form_type', 'symbol_key').first()
+        if company is None:
+            return None
+        response = snapshot_store.response(request, *company)
+        if response is not None:
+            popularity.record(company[1])
+        return response
+
+    def _requested_fields(self) -> list:
+        """
+        Fields picked by the user on the dashboard, either repeated ?fields=a&fields=b or ?fields=a,b,
+        the configured default fields otherwise
+        :rtype: list
+        """
+        fields = [field_name for value in self.request.GET.getlist('fields')
+                  for field_name in _split_param(value)]
+        return fields or settings.CI_REPORT_DEFAULT_FIELDS
+
+    def _streaming(self) -> bool:
+        """
+        ?stream=1 or ?stream=0 overrides the CI_REPORT_STREAMING setting
+        :rtype: bool
+        """
+        stream = self.request.GET.get('stream')
+        if stream is None:
+            return settings.CI_REPORT_STREAMING
+        return stream.lower() in ('1', 'true', 'yes')
+
+    def _chart_window(self) -> dict:
+        """
+        Year window and point budget asked on the report, passed on to every chart. Bad values are ignored
+        :rtype: dict
+        """
+        try:
+            return _chart_window(self.request.GET)
+        except ValueError:
+            return dict()
+
+    @staticmethod
+    def _render_chart_chunk(obj: DivGenerator,
+                            position: int,
+                            field_name: str,
+                            window: dict,
+                            chart_format: str = None) -> str:
+        """
+        HTML of a single streamed chart, the CSS order puts it back in place whatever the order the
+        charts finish in. A spec is drawn by an inline call to render_figure_spec (figure-spec.js)
+        chart_format overrides CI_CHART_FORMAT
+        :rtype: str
+        """
+        element_id = f'streamed-chart-{position}'
+        opening = f'<div id="{element_id}" class="streamed-chart" style="order: {position}">'
+        try:
+            if (chart_format or settings.CI_CHART_FORMAT) == 'spec':
+                spec = obj.create_spec_from_financial_paramter(field_name, **window)
+                return (opening + '</div>' +
+                        json_script(spec, element_id + '-spec') +
+                        f'<script>render_figure_spec(document.getElementById("{element_id}"), '
+                        f'JSON.parse(document.getElementById("{element_id}-spec").textContent))</script>')
+            return opening + obj.create_div_from_financial_paramter(field_name, **window) + '</div>'
+        except ValueError:
+            logger.warning("Failed to stream the chart of %s for %s", field_name, obj.security_name)
+            return opening + f'<p class="text-muted">{escape(field_name)} not available</p></div>'
+
+    def _stream_report(self,
+                       ctx: dict,
+                       obj: DivGenerator,
+                       fields_selected: list) -> StreamingHttpResponse:
+        """
+        Sends the page shell right away then every chart as soon as it is rendered, the charts are rendered
+        concurrently by _chart_executor so the user waits for the first chart instead of all of them
+        :param ctx: template context of the report
+        :type ctx: dict
+        :param obj: DivGenerator with the data frame loaded
+        :type obj: DivGenerator
+        :param fields_selected: fields to chart in the page order
+        :type fields_selected: list
+        :return: chunked HTML response
+        :rtype: StreamingHttpResponse
+        """
+        ctx['stream_marker'] = STREAM_MARKER
+        shell = render_to_string("base/ajax-test.html", context=ctx, request=self.request)
+        head, tail = shell.split(STREAM_MARKER, 1)
+        window = self._chart_window()
+        futures = [_chart_executor.submit(self._render_chart_chunk, obj, position, field_name, window)
+                   for position, field_name in enumerate(fields_selected)]
+
+        def chunks():
+            yield head
+            for future in as_completed(futures):
+                yield future.result()
+            yield tail
+
+        response = StreamingHttpResponse(chunks(), content_type='text/html; charset=utf-8')
+        # proxies like nginx would otherwise buffer the whole page
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
     def render_to_response(self,
                            context,
                            **response_kwargs) -> 'AJAX html/HTTP Response HTML':
@@ -57,9 +243,9 @@ class CommonStockSearchPageView(generic.ListView):
         # ======= AJAX ONLY PART ===========
         if self.request.is_ajax():
             # Avoid any logging here as this is hit too much with per key pressed
+            # Answered from the in-memory index, ranked and capped, the DB is not touched
             query = self.request.GET.get('q')
-            object_list = CommonStock.objects.filter(
-                Q(symbol__icontains=query) | Q(Name__icontains=query))
+            object_list = search_index.search(query)
             html = render_to_string(
                 template_name="base/ajax-results-partial.html",
                 context={"companies": object_list}
@@ -74,26 +260,383 @@ class CommonStockSearchPageView(generic.ListView):
             # Make sure to check query, if the user has not typed any name then
             # template should render the html page with Search bar blank
             if query:
-                object_list = CommonStock.objects.filter(
-                    Q(symbol__icontains=query) | Q(Name__icontains=query))
-                if object_list:
-                    extracted_dict = object_list.values('symbol', 'form_type')[0]
-                    obj = DivGenerator(extracted_dict['form_type'],
-                                       extracted_dict['symbol'].lower())
-                    obj.get_data_generate_data_frame(extracted_dict['form_type'],
-                                                     extracted_dict['symbol'].lower())
-                    buf = []
-                    try:
-                        buf.append(obj.create_div_from_financial_paramter('accountspayablecurrent'))
-                        buf.append(obj.create_div_from_financial_paramter('accountsreceivablenetcurrent'))
-                    except ValueError as ve:
-                        logger.exception("Failed to generate <div> for form:%s BE: %s field:%s ",
-                                         extracted_dict['form_type'],
-                                         extracted_dict['symbol'].lower(),
-                                         'accountspayablecurrent')
-
-                    ctx['output'] = buf
-                    ctx['companies'] = object_list
-                    logger.debug(f"returning the analytical report for {extracted_dict['symbol'].lower()}")
+                report = self.report_context(ctx, query)
+                if report is not None:
+                    obj, fields_selected = report
+                    popularity.record(obj.security_name)
+                    logger.debug(f"returning the analytical report for {obj.security_name}")
+                    if self._streaming():
+                        return self._stream_report(ctx, obj, fields_selected)
+                elif ctx.get('unavailable'):
+                    response = render(self.request,
+                                      "base/ajax-test.html", context=ctx, status=503)
+                    response['Retry-After'] = _retry_after()
+                    return response
             return render(self.request,
                           "base/ajax-test.html", context=ctx)
+
+    def report_context(self,
+                       ctx: dict,
+                       query: str) -> 'tuple or None':
+        """
+        Loads the data of the company matching the query and fills the template context of its report
+        :param ctx: template context, filled in place
+        :type ctx: dict
+        :param query: symbol or company name typed by the user
+        :type query: str
+        :return: (DivGenerator with the data frame loaded, fields to chart) or None if no company matched
+                 or it has no data (ctx['error'] then says so, and ctx['unavailable'] is set when the
+                 backend is down)
+        :rtype: tuple
+        """
+        # Exact/prefix lookups on the indexed case-folded columns, see CommonStockQuerySet.search
+        object_list = CommonStock.objects.search(query)
+        if not object_list:
+            return None
+        extracted_dict = object_list.values('symbol', 'form_type')[0]
+        form_type = extracted_dict['form_type']
+        security_name = CommonStock.normalize_text(extracted_dict['symbol'])
+        ctx['query'] = query
+        ctx['companies'] = object_list
+        obj = DivGenerator(form_type,
+                           security_name)
+        try:
+            obj.get_data_generate_data_frame(form_type,
+                                             security_name)
+        except ValueError:
+            # no data at all, the "not found" is cached for a while by the packet cache
+            ctx['error'] = f"No financial data available for {security_name.upper()}"
+            return None
+        except BACKEND_FAILURES as failure:
+            # not cached as "no data", the packet cache only skips the backend for FAILURE_TTL_SECONDS
+            logger.warning("Backend failed for %s %s: %s", form_type, security_name, failure)
+            ctx['error'] = (f"Financial data for {security_name.upper()} is temporarily unavailable, "
+                            f"please try again shortly")
+            ctx['unavailable'] = True
+            return None
+        if obj.partial:
+            ctx['partial_years'] = len(obj.data_frame)
+        fields_available = obj.available_fields()
+        fields_selected = [field_name for field_name in self._requested_fields()
+                           if field_name in fields_available]
+        # Only the placeholders are sent here, each chart is fetched by chart_view when it
+        # scrolls into view so the time to first byte does not grow with the number of fields
+        window = self._chart_window()
+        chart_query = '?' + urlencode(dict({'format': settings.CI_CHART_FORMAT},
+                                           **{param: window[argument]
+                                              for param, argument in CHART_WINDOW_PARAMS.items()
+                                              if argument in window}))
+        ctx['charts'] = [{'field': field_name,
+                          'url': reverse('chart', args=[form_type, security_name, field_name]) + chart_query}
+                         for field_name in fields_selected]
+        ctx['fields_available'] = fields_available
+        ctx['fields_selected'] = fields_selected
+        return obj, fields_selected
+
+    def render_static_report(self,
+                             ctx: dict,
+                             obj: DivGenerator,
+                             fields_selected: list) -> str:
+        """
+        The whole report page with every chart rendered in place as a plotly <div>, nothing is fetched
+        by the page afterwards so it can be exported as a static file, see snapshots.py
+        :param ctx: template context filled by report_context
+        :type ctx: dict
+        :param obj: DivGenerator with the data frame loaded
+        :type obj: DivGenerator
+        :param fields_selected: fields to chart in the page order
+        :type fields_selected: list
+        :return: HTML page
+        :rtype: str
+        """
+        ctx['stream_marker'] = STREAM_MARKER
+        shell = render_to_string("base/ajax-test.html", context=ctx, request=self.request)
+        window = self._chart_window()
+        charts = ''.join(self._render_chart_chunk(obj, position, field_name, window, chart_format='div')
+                         for position, field_name in enumerate(fields_selected))
+        return shell.replace(STREAM_MARKER, charts, 1)
+
+
+@rate_limited('suggest')
+def suggest_view(request) -> 'JSON Response':
+    """
+    Type-ahead suggestions as plain [symbol, name, sector] lists, the search box renders them itself.
+    complete is true when every match is in the list (not capped), the browser then answers the longer
+    queries starting with q from its own cache without calling the server again.
+    Answers carry an ETag of the indexed companies and may be cached for CI_SUGGEST_MAX_AGE seconds
+    e.g
+        /base/suggest/?q=micro -> {"q": "micro", "complete": true, "results": [["MSFT", "Microsoft Corp.", ..]]}
+    :param request: HTTP request
+    :type request: HttpRequest
+    :return: JSON with the ranked matches
+    :rtype: JSON
+    """
+    query = search_index.normalize(request.GET.get('q'))
+    etag = f'"{search_index.digest}"'
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        patch_cache_control(not_modified, public=True, max_age=settings.CI_SUGGEST_MAX_AGE)
+        return not_modified
+    limit = search_index.limit
+    # one extra hit tells whether the list was capped
+    hits = search_index.search(query, limit=limit + 1)
+    response = JsonResponse(data={'q': query,
+                                  'complete': len(hits) <= limit,
+                                  'results': [[hit.symbol, hit.Name, hit.Sector] for hit in hits[:limit]]})
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=settings.CI_SUGGEST_MAX_AGE)
+    return response
+
+
+def screener_view(request) -> 'JSON Response':
+    """
+    Screens every company of the universe on conditions over its fiscal years, all the conditions must
+    pass. Conditions are given as several where parameters or joined with 'and'
+    e.g
+        /base/screen/?sector=Information Technology&where=accountsreceivablenetcurrent.yoy > 10% for 5 years
+        /base/screen/?where=assets > 1000000000 and liabilitiescurrent.yoy < 0&sort=-assets&limit=10
+    :param request: HTTP request
+    :type request: HttpRequest
+    :return: JSON with the companies passing best first, see Screener.screen, 400 for a bad condition
+    :rtype: JSON
+    """
+    conditions = [condition
+                  for where in request.GET.getlist('where')
+                  for condition in re.split(r'\s+and\s+', where, flags=re.IGNORECASE) if condition.strip()]
+    limit = request.GET.get('limit', '')
+    try:
+        with timed('screen'):
+            data_dict = screener.screen(conditions,
+                                        form_type=request.GET.get('form_type', '10-k'),
+                                        sector=request.GET.get('sector', '').strip() or None,
+                                        sort=request.GET.get('sort', '').strip() or None,
+                                        limit=int(limit) if limit.isdigit() else None)
+    except ValueError as ve:
+        return JsonResponse(data={'error': str(ve)},
+                            status=400)
+    return JsonResponse(data=data_dict)
+
+
+@rate_limited('chart')
+def snapshot_charts_view(request,
+                         form_type: str,
+                         security_name: str) -> 'JSON Response':
+    """
+    Charts of the exported snapshot of a company's default report as a static precompressed JSON file, for
+    offline copies and CDNs, see snapshots.py
+    e.g
+        /base/snapshot/10-k/msft/charts.json -> {"form_type": "10-k", "security": "msft", "charts": {..}}
+    :param request: HTTP request
+    :type request: HttpRequest
+    :param form_type: SEC form type like e.g '10-k'
+    :type form_type: str
+    :param security_name: ticker symbol like 'msft'
+    :type security_name: str
+    :return: the JSON file, 404 if there is no fresh snapshot
+    :rtype: JSON
+    """
+    security_name = CommonStock.normalize_text(security_name)
+    response = snapshot_store.response(request, form_type, security_name, kind='charts') if snapshot_store else None
+    if response is None:
+        return JsonResponse(data={'error': 'no snapshot'},
+                            status=404)
+    return response
+
+
+@rate_limited('chart')
+def chart_view(request,
+               form_type: str,
+               security_name: str,
+               field_name: str) -> 'JSON Response':
+    """
+    Returns the chart of a single field of a security, the dashboard calls it lazily for every
+    placeholder as it scrolls into view. Rate limited and admitted like the reports as it may fetch and
+    render as much
+    e.g
+        /base/chart/10-k/msft/accountspayablecurrent/ -> {"field": "accountspayablecurrent", "div": "<div>.."}
+    :param request: HTTP request
+    :type request: HttpRequest
+    :param form_type: SEC form type like e.g '10-k'
+    :type form_type: str
+    :param security_name: ticker symbol like 'msft'
+    :type security_name: str
+    :param field_name: column of the data frame to chart
+    :type field_name: str
+    :return: JSON with the HTML <div> of the chart, 404 if the security or the field is unknown, 400 for a
+             bad ?start=<year>&end=<year>&points=<max points> window, 503 with Retry-After while the
+             backend is down or the server is overloaded
+    :rtype: JSON
+    """
+    try:
+        window = _chart_window(request.GET)
+    except ValueError as ve:
+        return JsonResponse(data={'field': field_name, 'error': str(ve)},
+                            status=400)
+    # /MSFT/ and /msft/ are the same security, and the same cache and frame store entries
+    security_name = CommonStock.normalize_text(security_name)
+    if not CommonStock.objects.filter(symbol_key=security_name,
+                                      form_type=form_type).exists():
+        return JsonResponse(data={'field': field_name, 'error': 'security not found'},
+                            status=404)
+    chart_format = request.GET.get('format', 'div')
+    obj = DivGenerator(form_type,
+                       security_name)
+    try:
+        with admission.admit() as admitted:
+            if not admitted:
+                return admission.shed(request)
+            obj.get_data_generate_data_frame(form_type,
+                                             security_name)
+            if chart_format == 'spec':
+                data_dict = {'field': field_name,
+                             'spec': obj.create_spec_from_financial_paramter(field_name, **window)}
+            else:
+                data_dict = {'field': field_name,
+                             'div': obj.create_div_from_financial_paramter(field_name, **window)}
+    except ValueError:
+        logger.warning("Failed to generate <div> for form:%s BE: %s field:%s",
+                       form_type, security_name, field_name)
+        return JsonResponse(data={'field': field_name, 'error': 'statistic not found'},
+                            status=404)
+    except BACKEND_FAILURES as failure:
+        logger.warning("Backend failed for the chart of %s %s: %s", form_type, security_name, failure)
+        response = JsonResponse(data={'field': field_name, 'error': 'data temporarily unavailable'},
+                                status=503)
+        response['Retry-After'] = _retry_after()
+        return response
+    return JsonResponse(data=data_dict)
+
+
+@cache_control(public=True, max_age=365 * 24 * 60 * 60, immutable=True)
+def plotly_js_view(request,
+                   version: str) -> 'HTTP Response JS':
+    """
+    Serves the plotly.js bundle shipped with the installed plotly package instead of the CDN. The URL
+    carries the plotly version (see context_processors.plotly_js) so browsers can cache it forever
+    :param request: HTTP request
+    :type request: HttpRequest
+    :param version: plotly version in the URL, a stale one is redirected to the current URL
+    :type version: str
+    :return: minified plotly.js, gzipped if the browser accepts it
+    :rtype: JS
+    """
+    if version != plotly_bundle.version:
+        return redirect('plotly_js', version=plotly_bundle.version)
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        response = HttpResponse(plotly_bundle.gzipped(), content_type='application/javascript')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(plotly_bundle.source(), content_type='application/javascript')
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+def metrics_view(request) -> 'HTTP Response text':
+    """
+    Prometheus scrape end point with the request/stage latency histograms, backend retries and cache hit
+    counters of this process. Only served to the CI_METRICS_ALLOWED_ADDRESSES and to the staff users
+    :param request: HTTP request
+    :type request: HttpRequest
+    :return: metrics in the Prometheus text format, 403 for anybody else
+    :rtype: text
+    """
+    user = getattr(request, 'user', None)
+    if (request.META.get('REMOTE_ADDR') not in settings.CI_METRICS_ALLOWED_ADDRESSES and
+            not (user is not None and user.is_staff)):
+        return HttpResponseForbidden('Forbidden', content_type='text/plain; charset=utf-8')
+    return HttpResponse(metrics.render(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _chart_window(query: 'QueryDict') -> dict:
+    """
+    Reads the year window and point budget of a chart, e.g ?start=2005&end=2019&points=100
+    :param query: GET parameters of the request
+    :type query: QueryDict
+    :exception: ValueError for a value which is not a positive whole number
+    :return: keyword arguments of DivGenerator.create_div_from_financial_paramter
+    :rtype: dict
+    """
+    window = dict()
+    for param, argument in CHART_WINDOW_PARAMS.items():
+        value = query.get(param)
+        if not value:
+            continue
+        if not value.isdigit() or int(value) <= 0:
+            raise ValueError(f"{param} must be a positive whole number")
+        window[argument] = int(value)
+    return window
+
+
+def _retry_after() -> str:
+    # a failed fetch is not retried before the packet cache forgets the failure
+    return str(max(1, int(packet_cache.failure_ttl)))
+
+
+def _split_param(value: str) -> list:
+    return [part.strip() for part in (value or '').split(',') if part.strip()]
+
+
+def _securities_to_compare(symbols: list,
+                           sector: str) -> list:
+    """
+    Looks up the form type of the securities to compare, either the listed symbols or every company
+    in the sector. Capped to CI_COMPARE_MAX_SECURITIES
+    :return: (form_type, security_name) tuples
+    :rtype: list
+    """
+    object_list = CommonStock.objects.all()
+    if symbols:
+        object_list = object_list.filter(symbol_key__in=[CommonStock.normalize_text(symbol) for symbol in symbols])
+    if sector:
+        object_list = object_list.filter(Sector__iexact=sector)
+    object_list = object_list.order_by('symbol_key').values_list('form_type', 'symbol_key')
+    return list(object_list[:settings.CI_COMPARE_MAX_SECURITIES])
+
+
+async def compare_view(request) -> 'HTTP Response HTML':
+    """
+    Compares many companies on the same fields with one chart per field and one line per company
+    e.g
+        /base/compare/?symbols=msft,aapl,goog&fields=accountspayablecurrent
+        /base/compare/?sector=Information Technology
+    This is an async view, under asgi.py all the backend fetches run concurrently so the page takes about
+    as long as the slowest company instead of the sum of all of them. It spends the report rate limit
+    budget and an admission slot like a report, and the charts are drawn in a worker thread so the event
+    loop keeps serving the other requests
+    :param request: HTTP request
+    :type request: HttpRequest
+    :return: HTTP Response
+    :rtype: HTML
+    """
+    symbols = _split_param(request.GET.get('symbols'))
+    sector = request.GET.get('sector', '').strip()
+    fields = _split_param(request.GET.get('fields')) or settings.CI_REPORT_DEFAULT_FIELDS
+    ctx = {'output': [],
+           'fields': fields,
+           'failed': {}}
+    if not (symbols or sector):
+        return render(request,
+                      "base/compare.html", context=ctx)
+    # request.user may load the session from the DB
+    too_many = await sync_to_async(throttle)(request, 'report')
+    if too_many is not None:
+        return too_many
+    # may wait up to queue_seconds for a slot, never on the event loop
+    release = await sync_to_async(admission.acquire, thread_sensitive=False)()
+    if release is None:
+        return admission.shed(request)
+    try:
+        securities = await sync_to_async(_securities_to_compare)(symbols, sector)
+        comparison = BatchComparison(securities, fields)
+        await comparison.load()
+        # building and serializing the plotly figures is CPU bound
+        ctx['output'] = await sync_to_async(comparison.create_divs, thread_sensitive=False)()
+        ctx['securities'] = [security_name for _, security_name in securities]
+        ctx['failed'] = comparison.failed
+        response = await sync_to_async(render)(request,
+                                               "base/compare.html", context=ctx)
+    finally:
+        release()
+    admission.keep(request, response)
+    return response
@@ -0,0 +1,264 @@
+# This file will define the background cache warmer for the popular securities
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from .backend import BackendUnavailable
+from .cache import packet_cache
+from .instrumentation import metrics
+from .models import CommonStock
+from .services import (DivGenerator,
+                       load_packet,
+                       )
+
+logger = logging.getLogger(__name__)
+
+
+class PopularityTracker:
+    """
+    Counts the reports asked per security so the warmer can start with the most wanted ones. The counts
+    are buffered in process and added to the shared cache every flush_seconds so a report costs a dict
+    increment, and all the worker processes (and the warmer run as a script) see the same ranking
+    e.g
+        popularity.record('msft')
+        popularity.scores(['msft', 'aapl']) -> {'msft': 12, 'aapl': 3}
+    """
+    KEY_PREFIX = 'ci:popularity'
+
+    def __init__(self,
+                 flush_seconds: float = 10.0):
+        """
+        :param flush_seconds: max time a count stays in the process before it is added to the shared cache
+        :type flush_seconds: float
+        """
+        self.flush_seconds: float = flush_seconds
+        self._pending: Counter = Counter()
+        self._last_flush: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _key(self, security_name: str) -> str:
+        return f'{self.KEY_PREFIX}:{security_name}'
+
+    def record(self, security_name: str):
+        with self._lock:
+            self._pending[security_name] += 1
+            due = time.monotonic() - self._last_flush >= self.flush_seconds
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            self._last_flush = time.monotonic()
+        shared = packet_cache.shared
+        if shared is None or not pending:
+            # without a shared tier the counts only live in this process
+            with self._lock:
+                self._pending.update(pending)
+            return
+        for security_name, count in pending.items():
+            key = self._key(security_name)
+            # add() is a no-op if the key exists, incr() then works on every cache backend
+            shared.add(key, 0, timeout=None)
+            try:
+                shared.incr(key, count)
+            except ValueError:
+                # evicted between add() and incr()
+                shared.set(key, count, timeout=None)
+
+    def scores(self, security_names: list) -> dict:
+        """
+        :param security_names: lower case ticker symbols
+        :type security_names: list
+        :return: reports asked per security, the securities never asked are left out
+        :rtype: dict
+        """
+        with self._lock:
+            scores = Counter(self._pending)
+        shared = packet_cache.shared
+        if shared is not None:
+            keys = {self._key(security_name): security_name for security_name in security_names}
+            for key, count in shared.get_many(list(keys)).items():
+                scores[keys[key]] += count
+        return dict(scores)
+
+
+popularity = PopularityTracker()
+
+
+class CacheWarmer:
+    """
+    Walks the CommonStock table from the most to the least asked security and makes sure its packet is in
+    the packet cache and the derived metrics and default charts of the report are computed, so interactive
+    requests find warm data. A packet is fetched again refresh_ahead seconds before it turns stale so the
+    users never wait for the backend or see a stale packet
+    The backend is called by at most concurrency threads, when it gets slow (a fetch over slow_seconds)
+    or fails the warmer halves its concurrency and pauses with exponential backoff, interactive requests
+    always win
+    Run it as a script on a schedule (warms the shared packet tier for every worker)
+        python manage.py runscript warm-caches
+    or in every worker process with CI_WARMER['IN_PROCESS'] (also warms the per process ratio/chart caches)
+    e.g
+        CacheWarmer.from_settings().run_once()
+    """
+
+    def __init__(self,
+                 concurrency: int = 4,
+                 limit: int = None,
+                 fields: list = None,
+                 refresh_ahead: float = 60 * 60,
+                 slow_seconds: float = 1.0,
+                 max_pause: float = 60.0,
+                 interval: float = 5 * 60):
+        """
+        :param concurrency: max backend fetches in flight
+        :type concurrency: int
+        :param limit: only the limit most popular securities are warmed, None for all
+        :type limit: int
+        :param fields: charts rendered per security, the report default fields if None
+        :type fields: list
+        :param refresh_ahead: seconds before the packet turns stale it is fetched again
+        :type refresh_ahead: float
+        :param slow_seconds: a fetch slower than this means the backend is struggling
+        :type slow_seconds: float
+        :param max_pause: cap of the backoff pause between batches
+        :type max_pause: float
+        :param interval: seconds between 2 passes when run forever
+        :type interval: float
+        """
+        self.concurrency: int = max(1, concurrency)
+        self.limit: int = limit
+        self.fields: list = fields if fields is not None else list(settings.CI_REPORT_DEFAULT_FIELDS)
+        self.refresh_ahead: float = refresh_ahead
+        self.slow_seconds: float = slow_seconds
+        self.max_pause: float = max_pause
+        self.interval: float = interval
+        self._stop = threading.Event()
+        self._thread: threading.Thread = None
+
+    @classmethod
+    def from_settings(cls) -> 'CacheWarmer':
+        config = getattr(settings, 'CI_WARMER', dict())
+        return cls(concurrency=config.get('CONCURRENCY', 4),
+                   limit=config.get('LIMIT'),
+                   refresh_ahead=config.get('REFRESH_AHEAD_SECONDS', 60 * 60),
+                   slow_seconds=config.get('SLOW_SECONDS', 1.0),
+                   max_pause=config.get('MAX_PAUSE_SECONDS', 60.0),
+                   interval=config.get('INTERVAL_SECONDS', 5 * 60))
+
+    def candidates(self) -> list:
+        """
+        :return: (form_type, security_name) of every company, most asked first then by symbol
+        :rtype: list
+        """
+        securities = [(form_type, symbol_key)
+                      for symbol_key, form_type in CommonStock.objects.order_by('symbol_key').values_list('symbol_key',
+                                                                                                          'form_type')]
+        scores = popularity.scores([security_name for _, security_name in securities])
+        # sorted() is stable so securities with the same score stay in symbol order
+        securities = sorted(securities, key=lambda security: -scores.get(security[1], 0))
+        return securities[:self.limit] if self.limit else securities
+
+    def needs_fetch(self, key: tuple) -> bool:
+        entry = packet_cache.peek(key)
+        return entry is None or time.time() >= entry.fresh_until - self.refresh_ahead
+
+    def warm_one(self,
+                 form_type: str,
+                 security_name: str) -> float:
+        """
+        Fetches the packet if missing or about to turn stale then runs the report pipeline for the default
+        fields so the ratio and chart caches of this process are filled. A fetched packet is written to the
+        frame store too, the reports read the store before the packet cache
+        :return: seconds spent waiting for the backend, 0 if the packet was cached
+        :rtype: float
+        """
+        key = (form_type, security_name)
+        fetch_seconds = 0.0
+        fetched = self.needs_fetch(key)
+        if fetched:
+            start = time.monotonic()
+            # conditional, an unchanged packet costs the backend a 304
+            packet = packet_cache.load(key, lambda previous: load_packet(form_type, security_name, previous))
+            fetch_seconds = time.monotonic() - start
+            if packet is None:
+                return fetch_seconds
+            metrics.incr('ci_warmer_fetches_total')
+        generator = DivGenerator(form_type, security_name)
+        try:
+            generator.get_data_generate_data_frame(form_type, security_name, refresh=fetched)
+        except ValueError:
+            # not enough years to report on, nothing to render
+            return fetch_seconds
+        if settings.CI_CHART_FORMAT == 'div':
+            for field_name in self.fields:
+                if field_name in generator.data_frame.columns:
+                    generator.create_div_from_financial_paramter(field_name)
+        return fetch_seconds
+
+    def run_once(self) -> dict:
+        """
+        One pass over the candidates in batches of at most concurrency securities
+        :return: number of securities warmed and failed, and the total backoff pause
+        :rtype: dict
+        """
+        counts = {'warmed': 0, 'failed': 0, 'paused_seconds': 0.0}
+        candidates = self.candidates()
+        concurrency = self.concurrency
+        pause = 0.0
+        position = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency,
+                                thread_name_prefix='cache-warmer') as executor:
+            while position < len(candidates) and not self._stop.is_set():
+                batch = candidates[position:position + concurrency]
+                position += len(batch)
+                futures = [executor.submit(self.warm_one, form_type, security_name)
+                           for form_type, security_name in batch]
+                struggling = False
+                for (form_type, security_name), future in zip(batch, futures):
+                    try:
+                        struggling |= future.result() > self.slow_seconds
+                        counts['warmed'] += 1
+                    except BackendUnavailable as bu:
+                        struggling = True
+                        counts['failed'] += 1
+                        logger.warning("Warming %s paused, backend unavailable: %s", security_name, bu)
+                    except Exception as ex:
+                        struggling = True
+                        counts['failed'] += 1
+                        logger.warning("Warming %s failed: %s", security_name, ex)
+                if struggling:
+                    concurrency = max(1, concurrency // 2)
+                    pause = min(self.max_pause, max(pause * 2, 1.0))
+                    counts['paused_seconds'] += pause
+                    self._stop.wait(pause)
+                else:
+                    concurrency = min(self.concurrency, concurrency + 1)
+                    pause = 0.0
+        logger.info("Cache warming pass done %s", counts)
+        return counts
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as ex:
+                # e.g the DB is not migrated yet, try again next interval
+                logger.exception("Cache warming pass failed: %s", ex)
+            self._stop.wait(self.interval)
+
+    def start(self) -> 'CacheWarmer':
+        """
+        Runs the warmer forever in a daemon thread of this process
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run_forever,
+                                            name='cache-warmer',
+                                            daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
@@ -14,3 +14,13 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ci_frontend.settings')
 
 application = get_asgi_application()
+
+# Build the type-ahead search index before the first request comes in
+from base.search_index import search_index  # noqa: E402
+search_index.warm()
+
+# Keep the packets and charts of the popular securities warm in the background
+from django.conf import settings  # noqa: E402
+if settings.CI_WARMER.get('IN_PROCESS'):
+    from base.warmer import CacheWarmer  # noqa: E402
+    CacheWarmer.from_settings().start()
@@ -10,6 +10,10 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+import atexit
+import shutil
+import sys
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -39,11 +43,13 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     # Extensions installed via pip
     'django_extensions',
-    'base',
+    'base.apps.BaseConfig',
 ]
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # First so the timings cover the rest of the middleware too
+    'base.middleware.TimingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -67,6 +73,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'base.context_processors.plotly_js',
             ],
         },
     },
@@ -85,6 +92,23 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Shared by all the worker processes, swap for memcached/redis when running on many hosts
+    'ci_shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / '.ci_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -124,6 +148,174 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+######### COMMON INVESTOR SETUP ######################
+# Max number of companies returned to the type-ahead search box per key press
+CI_SEARCH_RESULT_LIMIT = 10
+# Touched whenever the commonstock table is reloaded so every worker rebuilds its search index
+CI_SEARCH_INDEX_STAMP_FILE = BASE_DIR / '.search_index_stamp'
+CI_SEARCH_INDEX_STAMP_CHECK_SECONDS = 1.0
+# Seconds browsers and proxies may reuse a type-ahead answer, revalidated with its ETag after that
+CI_SUGGEST_MAX_AGE = 5 * 60
+
+# Derived metrics (ratios, growth, CAGR ..) are memoized per packet, max packets kept per process
+CI_RATIO_CACHE_ENTRIES = 512
+
+# Backend REST API server, every call is retried with exponential backoff and jitter until
+# MAX_ATTEMPTS or DEADLINE_SECONDS, the circuit breaker fails calls fast while the backend is down
+CI_BACKEND = {
+    'BASE_URL': 'http://127.0.0.1:5000/security/',
+    'TIMEOUT_SECONDS': 1.0,
+    'POOL_SIZE': 20,
+    'MAX_ATTEMPTS': 5,
+    'BACKOFF_BASE_SECONDS': 0.1,
+    'BACKOFF_MAX_SECONDS': 2.0,
+    'DEADLINE_SECONDS': 4.0,
+    'BREAKER_FAILURE_THRESHOLD': 5,
+    'BREAKER_RESET_SECONDS': 30.0,
+    # query parameter of the backend returning only the fiscal years since the given one, None if it
+    # has none. Packets are revalidated with ETag/Last-Modified either way
+    'SINCE_YEAR_PARAM': None,
+}
+
+# Packets from the backend REST API server, 10-k data changes at most once a year. The shared
+# tier is a CACHES alias so all the worker processes share the fetched packets, None disables it
+CI_PACKET_CACHE = {
+    'LOCAL_MAX_ENTRIES': 256,
+    'TTL_SECONDS': 24 * 60 * 60,
+    'STALE_SECONDS': 7 * 24 * 60 * 60,
+    'SHARED_CACHE_ALIAS': 'ci_shared',
+    # unknown securities are remembered for a short while, packets with fewer fiscal years than
+    # DivGenerator.MIN_VALID_YEARS_PER_BACKEND_CALL are rendered as partial and fetched again sooner
+    'NEGATIVE_TTL_SECONDS': 5 * 60,
+    'PARTIAL_TTL_SECONDS': 60 * 60,
+    'PARTIAL_BELOW_ENTRIES': 10,
+    # a fetch which failed with the backend down is not tried again for the same security for a few
+    # seconds, the report says the data is temporarily unavailable
+    'FAILURE_TTL_SECONDS': 10,
+}
+# Packets are turned into typed data frames (float64 amounts, integer fiscal years). FIELDS limits the
+# fields converted e.g the ones charted and used by the ratios, None converts them all. Installing orjson
+# speeds up the decoding of the packets, the standard library json is used without it
+CI_PACKET_SCHEMA = {
+    'FIELDS': None,
+}
+# Local columnar store of the data frames (memory mapped float64 per security), reports read it instead
+# of fetching and parsing the packet until MAX_AGE_SECONDS, new fiscal years are appended. No ROOT disables it
+CI_FRAME_STORE = {
+    'ROOT': BASE_DIR / '.ci_frames',
+    'MAX_AGE_SECONDS': 24 * 60 * 60,
+}
+# Concurrent fetches/renders of the same key are coalesced into one, packet fetches also across the worker
+# processes of the host through a lock file per key. No LOCK_DIR coalesces within each process only
+CI_SINGLE_FLIGHT = {
+    'LOCK_DIR': BASE_DIR / '.ci_locks',
+    'LOCK_TIMEOUT_SECONDS': 5.0,
+}
+# Rendered chart <div> HTML, kept per process and bounded by memory
+CI_CHART_CACHE = {
+    'MAX_BYTES': 64 * 1024 * 1024,
+}
+
+# Background warming of the caches for the most asked securities, see base.warmer. IN_PROCESS runs it
+# in a thread of every worker, otherwise schedule python manage.py runscript warm-caches
+CI_WARMER = {
+    'IN_PROCESS': False,
+    'CONCURRENCY': 4,
+    'LIMIT': None,
+    'REFRESH_AHEAD_SECONDS': 60 * 60,
+    'SLOW_SECONDS': 1.0,
+    'MAX_PAUSE_SECONDS': 60.0,
+    'INTERVAL_SECONDS': 5 * 60,
+}
+
+# Chart <div> rendering (plotly figure + JSON) in a pool of worker processes so many field reports use every
+# core, the request threads wait on the workers. 0 PROCESSES renders inline, a failing worker or a chart not
+# picked up by a worker within TIMEOUT_SECONDS falls back to inline rendering
+CI_CHART_RENDER = {
+    'PROCESSES': 0,
+    'TIMEOUT_SECONDS': 10.0,
+}
+
+# Per stage timings of every request sent back in a Server-Timing header, see base.middleware
+CI_SERVER_TIMING_HEADER = True
+# /metrics is only served to these client addresses (the Prometheus scraper) and to signed in staff users
+CI_METRICS_ALLOWED_ADDRESSES = ['127.0.0.1', '::1']
+
+# Fields charted on a report when the user does not ask for specific ones
+CI_REPORT_DEFAULT_FIELDS = [
+    'accountspayablecurrent',
+    'accountsreceivablenetcurrent',
+]
+# Charted series are cut down to MAX_POINTS points with a shape preserving method ('lttb' or 'minmax'),
+# a chart can ask for less with ?points=
+CI_CHART_DOWNSAMPLING = {
+    'MAX_POINTS': 500,
+    'METHOD': 'lttb',
+}
+# 'spec' ships compact typed array figures drawn by the browser, 'div' ships plotly HTML
+CI_CHART_FORMAT = 'spec'
+# Reports are streamed, the page shell first then each chart as it is rendered, instead of lazy loading
+# every chart with its own request. ?stream=1/0 overrides it per request
+CI_REPORT_STREAMING = False
+# Threads rendering the charts of the streamed reports, shared by every request of a process
+CI_REPORT_STREAM_WORKERS = 4
+# Token bucket rate limits per client (signed in user or address) and for all the clients together,
+# RATE in requests per second and BURST in requests, per worker process. Over the limit a 429 with
+# Retry-After is returned. Only trust X-Forwarded-For behind a proxy which sets it
+CI_RATE_LIMIT = {
+    'BUDGETS': {
+        # type-ahead, a request per key pressed (debounced by the browser)
+        'suggest': {'RATE': 10, 'BURST': 30, 'GLOBAL_RATE': 500, 'GLOBAL_BURST': 1000},
+        # full reports, each one may fan out to the backend
+        'report': {'RATE': 0.5, 'BURST': 5, 'GLOBAL_RATE': 20, 'GLOBAL_BURST': 40},
+        # lazy charts of the dashboard, one request per chart scrolled into view
+        'chart': {'RATE': 5, 'BURST': 40, 'GLOBAL_RATE': 200, 'GLOBAL_BURST': 400},
+    },
+    'MAX_CLIENTS': 10000,
+    'TRUST_X_FORWARDED_FOR': False,
+}
+# Load shedding of the reports and the lazy charts: at most MAX_CONCURRENT_REPORTS are built at once per
+# process (waiting up to QUEUE_SECONDS for a slot, a streamed report holds it until sent) and none while
+# MAX_BACKEND_IN_FLIGHT backend requests are pending. A refused report is answered with its last rendered
+# copy (one of STALE_REPORTS kept) or a 503 with Retry-After
+CI_ADMISSION = {
+    'MAX_CONCURRENT_REPORTS': 8,
+    'MAX_BACKEND_IN_FLIGHT': 16,
+    'QUEUE_SECONDS': 0.1,
+    'RETRY_AFTER_SECONDS': 5,
+    'STALE_REPORTS': 128,
+}
+# Static snapshots of the default report of every company, exported by
+#   python manage.py runscript export-snapshots
+# and served by the report view (the charts as JSON at /base/snapshot/<form_type>/<symbol>/charts.json) for
+# MAX_AGE_SECONDS after their data was last checked. Precompressed with gzip, and brotli too when the brotli
+# package is installed. No ROOT disables them
+CI_SNAPSHOTS = {
+    'ROOT': BASE_DIR / '.ci_snapshots',
+    'MAX_AGE_SECONDS': 24 * 60 * 60,
+    'PROCESSES': 4,
+    'CACHE_MAX_AGE_SECONDS': 5 * 60,
+}
+# Max companies in one comparison, a whole sector of the S&P 500 fits
+CI_COMPARE_MAX_SECURITIES = 80
+# Cross company screens run on an in memory panel of the frame store, checked for updated companies every
+# REFRESH_SECONDS. Only the companies already in the frame store are screened (see CI_WARMER to fill it for
+# every company). LIMIT is the default number of companies returned
+CI_SCREENER = {
+    'REFRESH_SECONDS': 60,
+    'LIMIT': 50,
+}
+
+# python manage.py test never touches the stamp, lock, cache, frame and snapshot files of the running site
+if len(sys.argv) > 1 and sys.argv[1] == 'test':
+    CI_TEST_DIR = Path(tempfile.mkdtemp(prefix='ci-test-'))
+    atexit.register(shutil.rmtree, CI_TEST_DIR, ignore_errors=True)
+    CI_SEARCH_INDEX_STAMP_FILE = CI_TEST_DIR / '.search_index_stamp'
+    CACHES['ci_shared']['LOCATION'] = CI_TEST_DIR / '.ci_cache'
+    CI_FRAME_STORE['ROOT'] = CI_TEST_DIR / '.ci_frames'
+    CI_SINGLE_FLIGHT['LOCK_DIR'] = CI_TEST_DIR / '.ci_locks'
+    CI_SNAPSHOTS['ROOT'] = CI_TEST_DIR / '.ci_snapshots'
+
 ######### LOGGING SETUP ######################
 LOGGING = {
     'version': 1,
@@ -17,8 +17,13 @@ from django.contrib import admin
 from django.urls import ( path,
                           include,
                           )
+from base.views import metrics_view
 
 urlpatterns = [
     path('base/', include('base.urls')),
     path('admin/', admin.site.urls),
+    # Prometheus scrape end point
+    path('metrics',
+         metrics_view,
+         name='metrics'),
 ]
@@ -0,0 +1,229 @@
+# bench-hot-paths.py
+# Reproducible benchmark of the search and report hot paths against a local fake backend (see fake_backend.py)
+# with a configurable latency and payload size. For every scenario the p50/p99 latency, the throughput and
+# the peak of Python memory allocations are measured and written as JSON so runs can be compared across commits
+# Hint: run with django-extensions from the ci_frontend directory
+# python manage.py runscript bench-hot-paths
+# python manage.py runscript bench-hot-paths --script-args="--latency-ms 50 --years 30 --output before.json"
+# python manage.py runscript bench-hot-paths --script-args="--compare before.json"
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from django.test import Client
+from base.backend import backend_client
+from base.cache import (chart_cache,
+                        packet_cache,
+                        )
+from base.frame_store import frame_store
+from base.models import CommonStock
+from base.services import DivGenerator
+from base.throttle import (admission,
+                           rate_limiters,
+                           )
+from scripts.fake_backend import FakeBackend
+
+DEFAULT_OUTPUT_DIR = 'bench_results'
+TYPE_AHEAD_QUERIES = ('a', 'ap', 'app', 'micro', 'msft', 'soft', 'bank', 'zzzz')
+MEMORY_PASS_ITERATIONS = 10
+base_logger = logging.getLogger('base')
+
+
+def _parse_args(args: tuple) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='bench-hot-paths')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='fake backend latency per call')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='random extra fake backend latency')
+    parser.add_argument('--years', type=int, default=12, help='fiscal years per packet')
+    parser.add_argument('--fields', type=int, default=39, help='fields per fiscal year')
+    parser.add_argument('--iterations', type=int, default=50, help='calls per scenario')
+    parser.add_argument('--concurrency', type=int, default=4, help='threads calling a scenario at once')
+    parser.add_argument('--symbols', type=int, default=20, help='distinct companies used by the report scenarios')
+    parser.add_argument('--output', default=None, help='JSON results file, bench_results/<commit>.json if not set')
+    parser.add_argument('--compare', default=None, help='earlier JSON results file to compare with')
+    # runscript hands over --script-args="--a 1 --b 2" as a single string
+    return parser.parse_args(' '.join(args).split())
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _percentile(samples: list, percent: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(percent / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def _clear_caches():
+    packet_cache.local.clear()
+    chart_cache.lru.clear()
+    if frame_store is not None:
+        shutil.rmtree(frame_store.root, ignore_errors=True)
+
+
+def _measure(name: str,
+             call: 'callable taking the iteration number',
+             iterations: int,
+             concurrency: int,
+             before_each: 'callable' = None,
+             warm: bool = False) -> dict:
+    """
+    Runs the call iterations times spread over concurrency threads and returns the latency percentiles in
+    ms and the throughput in calls per second. The peak of the traced memory in KB is taken in a separate
+    sequential pass as tracemalloc slows every allocation down. A cold scenario (before_each clearing the
+    caches) runs one call at a time, a thread clearing the caches while the others fill them would measure
+    neither a cold nor a warm call
+    """
+    if before_each is not None:
+        concurrency = 1
+
+    def timed(iteration: int) -> float:
+        if before_each is not None:
+            before_each()
+        start = time.perf_counter()
+        call(iteration)
+        return time.perf_counter() - start
+
+    # warm up imports and lazily built structures so they are not counted, a warm scenario gets every
+    # iteration run once so the measured pass only sees cache hits
+    for iteration in range(iterations if warm else 1):
+        timed(iteration)
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(timed, range(iterations)))
+    wall = time.perf_counter() - wall_start
+    tracemalloc.start()
+    for iteration in range(min(iterations, MEMORY_PASS_ITERATIONS)):
+        timed(iteration)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {'iterations': iterations,
+              'concurrency': concurrency,
+              'p50_ms': statistics.median(samples) * 1000,
+              'p99_ms': _percentile(samples, 99) * 1000,
+              'mean_ms': statistics.mean(samples) * 1000,
+              'throughput_rps': iterations / wall,
+              'peak_memory_kb': peak / 1024}
+    print(f"{name:<36} p50 {result['p50_ms']:9.3f}ms  p99 {result['p99_ms']:9.3f}ms  "
+          f"{result['throughput_rps']:9.1f}/s  peak {result['peak_memory_kb']:9.1f}KB")
+    return result
+
+
+def _scenarios(options: argparse.Namespace,
+               symbols: list) -> dict:
+    client = Client(HTTP_HOST='localhost')
+
+    def type_ahead(iteration: int):
+        client.get('/base/', {'q': TYPE_AHEAD_QUERIES[iteration % len(TYPE_AHEAD_QUERIES)]},
+                   HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def report(iteration: int):
+        client.get('/base/', {'q': symbols[iteration % len(symbols)]})
+
+    def data_frame(iteration: int):
+        symbol = symbols[iteration % len(symbols)]
+        DivGenerator('10-k', symbol).get_data_generate_data_frame('10-k', symbol)
+
+    loaded = DivGenerator('10-k', symbols[0])
+    loaded.get_data_generate_data_frame('10-k', symbols[0])
+    fields = loaded.available_fields()
+
+    def chart_div(iteration: int):
+        loaded.create_div_from_financial_paramter(fields[iteration % len(fields)])
+
+    return {
+        # name: (call, before_each, warm)
+        'type_ahead': (type_ahead, None, True),
+        'report_cold': (report, _clear_caches, False),
+        'report_warm': (report, None, True),
+        'get_data_generate_data_frame_cold': (data_frame, _clear_caches, False),
+        'get_data_generate_data_frame_warm': (data_frame, None, True),
+        'create_div_cold': (chart_div, chart_cache.lru.clear, False),
+        'create_div_warm': (chart_div, None, True),
+    }
+
+
+def _compare(results: dict,
+             baseline_path: str):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f"\nCompared with {baseline_path} (commit {baseline.get('commit')}), negative is faster")
+    for name, result in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        changes = ['{} {:+.1f}%'.format(metric, 100.0 * (result[metric] - before[metric]) / before[metric])
+                   for metric in ('p50_ms', 'p99_ms', 'peak_memory_kb') if before[metric]]
+        print(f"{name:<36} " + '  '.join(changes))
+
+
+def run(*args) -> 'None':
+    """
+    Runs every scenario against a fresh fake backend and writes the results as JSON
+    :param args: command line options, see _parse_args
+    :type args: tuple
+    :return: None
+    :rtype: None
+    """
+    options = _parse_args(args)
+    backend = FakeBackend(latency_ms=options.latency_ms,
+                          jitter_ms=options.jitter_ms,
+                          years=options.years,
+                          fields=options.fields).start()
+    # Point this process at the fake backend and keep the benchmark away from the shared cache tier
+    original = (backend_client.base_url, packet_cache.shared_alias, base_logger.level)
+    backend_client.base_url = backend.url
+    packet_cache.shared_alias = None
+    if frame_store is not None:
+        original_frame_root, frame_store.root = frame_store.root, tempfile.mkdtemp(prefix='bench-frames-')
+    # per chart INFO logging would be measured as well otherwise
+    base_logger.setLevel(logging.WARNING)
+    # every call comes from one address, measure the reports instead of the 429/503 of the rate limits and
+    # the load shedding
+    original_limits = (dict(rate_limiters), admission._slots, admission.max_backend_in_flight)
+    rate_limiters.clear()
+    admission._slots, admission.max_backend_in_flight = None, 0
+    _clear_caches()
+    symbols = list(CommonStock.objects.order_by('symbol_key').values_list('symbol_key', flat=True)[:options.symbols])
+    try:
+        scenarios = _scenarios(options, symbols)
+        results = {'commit': _git_commit(),
+                   'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'python': platform.python_version(),
+                   'config': {key: value for key, value in vars(options).items()
+                              if key not in ('output', 'compare')},
+                   'scenarios': dict()}
+        for name, (call, before_each, warm) in scenarios.items():
+            results['scenarios'][name] = _measure(name, call, options.iterations, options.concurrency,
+                                                  before_each, warm)
+        results['backend'] = {'requests': backend.requests_served,
+                              'bytes': backend.bytes_served}
+    finally:
+        backend_client.base_url, packet_cache.shared_alias, _ = original
+        base_logger.setLevel(original[2])
+        rate_limiters.update(original_limits[0])
+        _, admission._slots, admission.max_backend_in_flight = original_limits
+        if frame_store is not None:
+            shutil.rmtree(frame_store.root, ignore_errors=True)
+            frame_store.root = original_frame_root
+        backend.stop()
+    output = options.output or os.path.join(DEFAULT_OUTPUT_DIR, f"{results['commit']}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results written to {output}")
+    if options.compare:
+        _compare(results, options.compare)
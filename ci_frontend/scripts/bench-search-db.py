@@ -0,0 +1,65 @@
+# bench-search-db.py
+# Measures the full page search lookups of the CommonStock table as the table grows, to show the indexed
+# case-folded key columns keep the latency flat where the old icontains scan grows with the table
+# Hint: run with django-extensions, nothing is left in the DB as every size runs in a rolled back transaction
+# python manage.py runscript bench-search-db
+# python manage.py runscript bench-search-db --script-args 500 5000 50000
+import statistics
+import time
+from django.db import transaction
+from django.db.models import Q
+from base.models import CommonStock
+
+DEFAULT_SIZES = (500, 5000, 50000)
+REPEAT = 200
+QUERY = 'msft'
+
+
+def _time_query(make_queryset: 'callable returning a QuerySet') -> float:
+    """
+    Median latency in micro seconds of evaluating the queryset REPEAT times
+    """
+    samples = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        list(make_queryset()[:10])
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1e6
+
+
+def _fill_table(rows: int):
+    missing = rows - CommonStock.objects.count()
+    stocks = [CommonStock(symbol=f'ZZ{index:06d}',
+                          Name=f'Synthetic Filer {index} Holdings Inc',
+                          Sector='Synthetic')
+              for index in range(max(missing, 0))]
+    for stock in stocks:
+        stock.normalize()
+    CommonStock.objects.bulk_create(stocks, batch_size=500)
+
+
+def run(*args) -> 'None':
+    """
+    Prints the median latency of the exact, prefix and legacy icontains lookups for every table size
+    :param args: table sizes to measure, DEFAULT_SIZES otherwise
+    :type args: tuple
+    :return: None
+    :rtype: None
+    """
+    sizes = [int(size) for size in args] or DEFAULT_SIZES
+    lookups = {
+        'exact symbol_key': lambda: CommonStock.objects.filter(symbol_key=QUERY),
+        'prefix key range': lambda: CommonStock.objects.filter(
+            Q(symbol_key__gte='micro', symbol_key__lt='micro\U0010ffff') |
+            Q(name_key__gte='micro', name_key__lt='micro\U0010ffff')),
+        'substring fallback': lambda: CommonStock.objects.search('zzz-not-listed'),
+        'legacy icontains': lambda: CommonStock.objects.filter(
+            Q(symbol__icontains=QUERY) | Q(Name__icontains=QUERY)),
+    }
+    print(f"{'rows':>8} " + ' '.join(f"{name:>18}" for name in lookups) + '   (median us)')
+    for size in sizes:
+        with transaction.atomic():
+            _fill_table(size)
+            timings = [_time_query(make_queryset) for make_queryset in lookups.values()]
+            print(f"{size:>8} " + ' '.join(f"{timing:>18.1f}" for timing in timings))
+            transaction.set_rollback(True)
@@ -0,0 +1,30 @@
+# export-snapshots.py
+# Renders the default report of the companies into static precompressed files served by the report view while
+# fresh, only the reports whose data changed since the last export are rendered again. Schedule it (cron) once
+# new 10-k data is expected, the reports are rendered by several worker processes
+# Hint: run with django-extensions, optional arguments are the sector ('all' for every company), the number of
+# most viewed companies (0 for all) and the worker processes
+# python manage.py runscript export-snapshots
+# python manage.py runscript export-snapshots --script-args "Information Technology" 50 8
+import time
+from base.snapshots import (export_snapshots,
+                            snapshot_securities,
+                            )
+
+
+def run(*args) -> 'None':
+    """
+    Single export pass
+    :param args: optional sector, max number of companies and worker processes
+    :type args: tuple
+    :return: None
+    :rtype: None
+    """
+    sector = args[0] if len(args) > 0 and args[0].lower() != 'all' else None
+    limit = int(args[1]) if len(args) > 1 and int(args[1]) > 0 else None
+    processes = max(1, int(args[2])) if len(args) > 2 else None
+    securities = snapshot_securities(sector=sector, limit=limit)
+    start = time.monotonic()
+    counts = export_snapshots(securities, processes=processes)
+    print(f"Exported {len(securities)} companies in {time.monotonic() - start:.1f}s: {counts['built']} built, "
+          f"{counts['unchanged']} unchanged, {counts['no data']} without data, {counts['failed']} failed")
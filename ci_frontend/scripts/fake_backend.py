@@ -0,0 +1,183 @@
+# fake_backend.py
+# Local stand-in for the backend REST API server, answers /security/<form_type>/<symbol>/ with a made up
+# but deterministic packet shaped like the real one (one dict per fiscal year). Used by the benchmarks and
+# handy to run the site without the real backend. Like a well behaved backend it sends ETag/Last-Modified,
+# answers conditional requests with 304 and takes ?since=<year> to send only the years from that one on
+# Hint: run with django-extensions, the arguments are port, latency in ms and years per packet
+# python manage.py runscript fake_backend --script-args 5000 50 12
+import json
+import random
+import threading
+import time
+import zlib
+from email.utils import formatdate
+from urllib.parse import (parse_qs,
+                          urlsplit,
+                          )
+from http.server import (BaseHTTPRequestHandler,
+                         ThreadingHTTPServer,
+                         )
+from base.packet_schema import FINANCIAL_FIELDS as KNOWN_FIELDS
+
+
+class FakeBackend:
+    """
+    Threaded HTTP server standing in for the backend REST API server
+    e.g
+        backend = FakeBackend(latency_ms=50, years=12).start()
+        backend.url -> 'http://127.0.0.1:40123/security/'
+        backend.stop()
+    """
+
+    def __init__(self,
+                 port: int = 0,
+                 latency_ms: float = 0.0,
+                 jitter_ms: float = 0.0,
+                 years: int = 12,
+                 fields: int = len(KNOWN_FIELDS),
+                 last_year: int = 2019):
+        """
+        :param port: port to listen on, 0 picks a free one
+        :type port: int
+        :param latency_ms: time every response is delayed by
+        :type latency_ms: float
+        :param jitter_ms: random extra delay between 0 and jitter_ms
+        :type jitter_ms: float
+        :param years: fiscal years per packet, drives the payload size with fields
+        :type years: int
+        :param fields: fields per year, synthetic ones are added past the known 10-k fields
+        :type fields: int
+        :param last_year: most recent fiscal year of every packet
+        :type last_year: int
+        """
+        self.port: int = port
+        self.latency_ms: float = latency_ms
+        self.jitter_ms: float = jitter_ms
+        self.years: int = years
+        self.last_year: int = last_year
+        self.field_names: tuple = (KNOWN_FIELDS + tuple(f'syntheticfield{index:04d}'
+                                                        for index in range(max(fields - len(KNOWN_FIELDS), 0))))[:fields]
+        self.requests_served: int = 0
+        self.bytes_served: int = 0
+        self.not_modified_served: int = 0
+        # bump it to make every packet look changed, last_year += 1 adds a fiscal year instead
+        self.revision: int = 0
+        # error status (e.g 429, 503) sent instead of the packets while set
+        self.fail_with: int = None
+        self.started_at: float = time.time()
+        self._server: ThreadingHTTPServer = None
+        self._thread: threading.Thread = None
+        self._counter_lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_address[1]}/security/'
+
+    def packet(self,
+               form_type: str,
+               symbol: str) -> dict:
+        """
+        Same symbol always gives the same numbers, growing a few percent a year
+        :rtype: dict
+        """
+        rng = random.Random(zlib.crc32(f'{form_type}/{symbol}/{self.revision}'.encode()))
+        bases = [rng.randint(10 ** 6, 10 ** 10) for _ in self.field_names]
+        packet = dict()
+        for offset in range(self.years):
+            year = self.last_year - self.years + 1 + offset
+            growth = 1.0 + 0.05 * offset
+            year_data = {field_name: int(base * growth * rng.uniform(0.9, 1.1))
+                         for field_name, base in zip(self.field_names, bases)}
+            year_data.update({'filing-type': form_type,
+                              'filing-year': year,
+                              'ticker': symbol})
+            packet[str(year)] = year_data
+        return packet
+
+    def _make_handler(self) -> type:
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                parts = [part for part in url.path.split('/') if part]
+                if len(parts) != 3 or parts[0] != 'security':
+                    self.send_error(404)
+                    return
+                if backend.fail_with:
+                    with backend._counter_lock:
+                        backend.requests_served += 1
+                    self.send_error(backend.fail_with)
+                    return
+                delay = backend.latency_ms + random.uniform(0, backend.jitter_ms)
+                if delay:
+                    time.sleep(delay / 1000.0)
+                packet = backend.packet(parts[1], parts[2])
+                since = parse_qs(url.query).get('since')
+                if since:
+                    packet = {year: data for year, data in packet.items() if int(year) >= int(since[0])}
+                body = json.dumps(packet).encode('utf-8')
+                etag = '"{:08x}"'.format(zlib.crc32(body))
+                # counted before the response is sent, a client reading the counters right after its
+                # call always sees it
+                if self.headers.get('If-None-Match') == etag:
+                    with backend._counter_lock:
+                        backend.requests_served += 1
+                        backend.not_modified_served += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                with backend._counter_lock:
+                    backend.requests_served += 1
+                    backend.bytes_served += len(body)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', formatdate(backend.started_at, usegmt=True))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # keep the benchmark output clean
+                pass
+
+        return Handler
+
+    def start(self) -> 'FakeBackend':
+        self.started_at = time.time()
+        self._server = ThreadingHTTPServer(('127.0.0.1', self.port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='fake-backend',
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def run(*args) -> 'None':
+    """
+    Serves the fake backend in the foreground until interrupted
+    :param args: optional port, latency in ms and years per packet
+    :type args: tuple
+    :return: None
+    :rtype: None
+    """
+    port, latency_ms, years = (list(args) + ['5000', '0', '12'][len(args):])[:3]
+    backend = FakeBackend(port=int(port),
+                          latency_ms=float(latency_ms),
+                          years=int(years)).start()
+    print(f"Fake backend listening on {backend.url} latency {latency_ms}ms, Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        backend.stop()
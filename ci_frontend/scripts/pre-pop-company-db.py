@@ -2,43 +2,34 @@
 # This file will help pre populate the CommonStock DB which contains the name of all companies in S&P 500
 # Once this DB is populated it will help search a company from the search page to make sure a valid
 # ticker symbol/Company is searched for
-import csv
 import os
-from base.models import CommonStock
+from base.loader import CommonStockLoader
 
 
 # Mechanism or steps
-# 1. Read the CSV file, this is a static file for now but will be made to pull from S3 bucket later Issue:#2
-# 2. After the file is read get the 3 values out and store to the DB CommonStock
-# 3. Remeber this is astandalone script for setup only if the DB is empty
+# 1. Stream the CSV file, this is a static file for now but will be made to pull from S3 bucket later Issue:#2
+# 2. Diff the symbol, Name and Sector values against what is already in the DB CommonStock
+# 3. Apply only the inserts/updates/deletes in bulk inside a single transaction, searches keep working
+#    against the old rows until the new ones are committed
+# Hint: the script is run with django-extensions, another file (e.g every SEC filer) can be passed
+# python manage.py runscript pre-pop-company-db
+# python manage.py runscript pre-pop-company-db --script-args /path/to/companies.csv
 
-def run() -> 'None':
+def run(*args) -> 'None':
     """
     Function will read the CSV file and pre-populate the DB. This DB will be used to run the user seraches
     for a company name(e.g. 'Apple Computers') or company ticker symbol(e.g. 'aapl')
+    :param args: optional path of the CSV file, the S&P 500 constituents file otherwise
+    :type args: tuple
     :return: None
     :rtype: None
     """
-    with open(os.getcwd() + '/scripts/constituents_csv.csv') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        # Run past the first row as it's the header
-        next(csv_reader)
-        # Clear all the initial entries
-        print(f"Deleted {CommonStock.objects.all().delete()} objects")
-        for count,row in enumerate(csv_reader):
-            print(f"Processing symbol:{row[0]} | Name:{row[1]} | Sector:{row[2]} row: {count}")
-            # Save the data to the DB, rememeber the form_type is set to default 10-k in models
-            # that is why only CSV read fields are saved here
-            # Table 'commonstock' will look like
-            # index | ticker symbol | Name            | Sector                 | form_type
-            # 9665 | YUM            | Yum! Brands Inc | Consumer Discretionary | 10-k
-            # Hint: commands to see in dbshell
-            # python manage.py dbshell >> Start the shell
-            # SELECT * FROM commonstock;  >> Display all the values in commonstock table
-            CommonStock(symbol=row[0],
-                        Name=row[1],
-                        Sector=row[2]).save()
-
-
-
-
+    csv_path = args[0] if args else os.getcwd() + '/scripts/constituents_csv.csv'
+    # Table 'commonstock' will look like, the form_type is set to default 10-k in models
+    # index | ticker symbol | Name            | Sector                 | form_type
+    # 9665 | YUM            | Yum! Brands Inc | Consumer Discretionary | 10-k
+    # Hint: commands to see in dbshell
+    # python manage.py dbshell >> Start the shell
+    # SELECT * FROM commonstock;  >> Display all the values in commonstock table
+    counts = CommonStockLoader().sync(CommonStockLoader.read_csv(csv_path))
+    print(f"Synced {csv_path}: {counts}")
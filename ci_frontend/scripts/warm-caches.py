@@ -0,0 +1,25 @@
+# warm-caches.py
+# Walks the companies from the most to the least asked and fetches the packets missing from the shared packet
+# cache or about to turn stale, backing off when the backend is slow. Schedule it (cron) a few times a day
+# Hint: run with django-extensions, optional arguments are the number of companies and the concurrency
+# python manage.py runscript warm-caches
+# python manage.py runscript warm-caches --script-args 100 8
+from base.warmer import CacheWarmer
+
+
+def run(*args) -> 'None':
+    """
+    Single warming pass
+    :param args: optional max number of companies and max concurrent backend calls
+    :type args: tuple
+    :return: None
+    :rtype: None
+    """
+    warmer = CacheWarmer.from_settings()
+    if len(args) > 0:
+        warmer.limit = int(args[0])
+    if len(args) > 1:
+        warmer.concurrency = max(1, int(args[1]))
+    counts = warmer.run_once()
+    print(f"Warmed {counts['warmed']} companies, {counts['failed']} failed, "
+          f"paused {counts['paused_seconds']:.1f}s for the backend")